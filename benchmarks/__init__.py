@@ -0,0 +1 @@
+"""Benchmarks for fg_map_ingest"""
@@ -0,0 +1,170 @@
+"""Time every phase of an ingest on a synthetic library.
+
+Usage:
+    python -m benchmarks.phases [--maps N] [--layers N] [--occluders N]
+        [--db-bulk N] [--file-size KB] [--repeat N] [--jobs N] [--lazy-db]
+
+Every run ingests a freshly generated library (see benchmarks.synthetic)
+into a fresh campaign, running the same phases as fg_map_ingest.main in the
+same order: the DB parse, building the maps, setting missing IDs, planning
+the ingest and executing the plan. The copies, sidecar saves, DB update and
+DB save the execute phase runs concurrently are timed as well. The best
+wall time of each is printed as JSON, so the output of two runs can be
+compared to spot regressions. After every run the library is planned
+again, which fails if an unchanged library would be written again.
+
+"""
+
+
+# Imports
+
+from argparse import ArgumentParser
+import json
+import os
+import tempfile
+
+import fg_map_ingest
+from fg_map_ingest import CampaignDB, IngestPlan, IngestSession, IngestStats
+
+from benchmarks.synthetic import add_arguments, generate_library
+
+
+# Globals
+
+PHASES = ('db_parse', 'build_maps', 'set_missing_ids', 'plan', 'execute')
+# Steps of the execute phase, they run concurrently
+EXECUTE_STEPS = ('copy_maps', 'save_sidecars', 'update_db', 'save_db')
+
+
+# Private Functions
+
+def _check_rebuild(map_dir, campaign_dir, jobs, lazy_db):
+    """Fail if rebuilding a just ingested library would write anything"""
+    session = _session()
+    db = CampaignDB(campaign_dir, lazy=lazy_db)
+    session.build_maps(map_dir, db, jobs=jobs)
+    session.set_missing_ids()
+    plan = IngestPlan.build(session, db, check='stat')
+    if plan.db_changes or plan.copies or plan.sidecars:
+        raise RuntimeError(
+            "Rebuilding an unchanged library would write:\n{}".format(
+                plan.format_diff()
+            )
+        )
+
+
+def _run(map_dir, campaign_dir, jobs, lazy_db):
+    """Ingest a library once and return the wall time of every phase
+
+    The wall times of the execute steps are included, 0 for steps that had
+    nothing to do.
+
+    """
+    session = _session()
+    stats = IngestStats()
+
+    with stats.phase('db_parse'):
+        db = CampaignDB(campaign_dir, lazy=lazy_db)
+    with stats.phase('build_maps'):
+        session.build_maps(map_dir, db, jobs=jobs)
+    with stats.phase('set_missing_ids'):
+        session.set_missing_ids()
+    with stats.phase('plan'):
+        plan = IngestPlan.build(session, db, check='stat')
+    with stats.phase('execute'):
+        report, _, _ = plan.execute(session, db, jobs=jobs, stats=stats)
+    if report.failures:
+        raise RuntimeError("Copying failed: {}".format(report.failures))
+    return {
+        phase: stats.phases.get(phase, 0.0)
+        for phase in PHASES + EXECUTE_STEPS
+    }
+
+
+def _session():
+    """Return a session with the command line's default settings"""
+    return IngestSession(
+        runtime_defaults={
+            'player_drawing': True,
+            'grid': True,
+            'grid_size': (100, 100),
+            'grid_offset': (0, 0),
+            'grid_snap': True,
+            'brush_size': None
+        }
+    )
+
+
+# Public Functions
+
+def main():
+    parser = ArgumentParser()
+    add_arguments(parser)
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="the number of timed ingests. Defaults to 3."
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=4,
+        help="the number of concurrent copies and scans. Defaults to 4."
+    )
+    parser.add_argument(
+        "--lazy-db",
+        action='store_true',
+        help="loads db.xml lazily, as with fg_map_ingest --lazy-db."
+    )
+    args = parser.parse_args()
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+
+    # Keep the per-map log lines out of the timings
+    fg_map_ingest.logger.disabled = True
+
+    runs = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for repeat in range(args.repeat):
+            map_dir, campaign_dir = generate_library(
+                os.path.join(temp_dir, str(repeat)), maps=args.maps,
+                layers=args.layers, occluders=args.occluders,
+                db_bulk=args.db_bulk, file_size=args.file_size
+            )
+            db_size = os.path.getsize(os.path.join(campaign_dir, 'db.xml'))
+            runs.append(_run(map_dir, campaign_dir, args.jobs, args.lazy_db))
+            _check_rebuild(map_dir, campaign_dir, args.jobs, args.lazy_db)
+
+    def best(phases):
+        return {
+            phase: round(min(run[phase] for run in runs), 4)
+            for phase in phases
+        }
+
+    results = {
+        'config': {
+            'maps': args.maps,
+            'layers': args.layers,
+            'occluders': args.occluders,
+            'db_bulk': args.db_bulk,
+            'file_size_kb': args.file_size,
+            'db_size_mb': round(db_size / 1024 ** 2, 2),
+            'jobs': args.jobs,
+            'lazy_db': args.lazy_db,
+            'repeat': args.repeat,
+        },
+        'phases': best(PHASES),
+        'execute_steps': best(EXECUTE_STEPS),
+        'total': round(
+            min(sum(run[phase] for phase in PHASES) for run in runs), 4
+        ),
+    }
+    print(json.dumps(results, indent=4))
+
+
+# Main
+
+if __name__ == '__main__':
+    main()
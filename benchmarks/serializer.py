@@ -0,0 +1,139 @@
+"""Compare the streaming db.xml serializer against the minidom round trip.
+
+Usage:
+    python -m benchmarks.serializer [--entries N] [--repeat N]
+
+Both paths write the same synthetic campaign database to a temporary file.
+Peak memory is measured with tracemalloc, so it covers the Python objects
+each path allocates, not the file written.
+
+"""
+
+
+# Imports
+
+from argparse import ArgumentParser
+import json
+import os
+import re
+import tempfile
+import time
+import tracemalloc
+from xml.dom import minidom
+import xml.etree.ElementTree as ET
+
+import fg_map_ingest
+
+
+# Globals
+
+NEWLINE_FIX = re.compile(r'\n[\t]*\n[\t]*')
+
+
+# Private Functions
+
+def _build_db(entries):
+    """Build a campaign db root with images and formatted text bulk"""
+    root = ET.Element('root', version='4.1')
+    image = ET.SubElement(root, 'image')
+    story = ET.SubElement(root, 'encounter')
+    for i in range(entries):
+        entry = ET.SubElement(image, 'id-{:05d}'.format(i + 1))
+        image_elem = ET.SubElement(entry, 'image', type='image')
+        layers = ET.SubElement(image_elem, 'layers')
+        for layer_id in range(3):
+            layer = ET.SubElement(layers, 'layer')
+            ET.SubElement(layer, 'id').text = str(layer_id)
+            ET.SubElement(layer, 'bitmap').text = (
+                'campaign/images/Map {}/Layer {}.jpg'.format(i, layer_id)
+            )
+        ET.SubElement(entry, 'name', type='string').text = 'Map {}'.format(i)
+
+        text_entry = ET.SubElement(story, 'id-{:05d}'.format(i + 1))
+        text = ET.SubElement(text_entry, 'text', type='formattedtext')
+        for paragraph in range(5):
+            p = ET.SubElement(text, 'p')
+            p.text = 'Read aloud & <describe> paragraph {} '.format(paragraph)
+            bold = ET.SubElement(p, 'b')
+            bold.text = 'important'
+            bold.tail = ' and the rest of the sentence.' * 4
+    return root
+
+
+def _legacy_save(root, filepath):
+    """The serializer CampaignDB.save_db used before streaming"""
+    with open(filepath, 'w') as f:
+        f.write(
+            NEWLINE_FIX.sub(
+                '',
+                minidom.parseString(
+                    ET.tostring(root)
+                ).toprettyxml(indent="\t")
+            )
+        )
+
+
+def _streaming_save(root, filepath):
+    """The streaming serializer CampaignDB.save_db uses now"""
+    with open(filepath, 'w') as f:
+        fg_map_ingest._write_pretty_xml(root, f)
+
+
+def _measure(func, root, filepath, repeat):
+    """Return the best wall time and the peak traced memory of a save"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(root, filepath)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func(root, filepath)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak
+
+
+# Public Functions
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--entries",
+        type=int,
+        default=2000,
+        help="the number of image and story entries. Defaults to 2000."
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="the number of timed runs per serializer. Defaults to 3."
+    )
+    args = parser.parse_args()
+
+    root = _build_db(args.entries)
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        outputs = {}
+        for name, func in (
+                ('minidom', _legacy_save), ('streaming', _streaming_save)
+        ):
+            filepath = os.path.join(temp_dir, name + '.xml')
+            wall_time, peak = _measure(func, root, filepath, args.repeat)
+            with open(filepath, 'rb') as f:
+                outputs[name] = f.read()
+            results[name] = {
+                'wall_time': round(wall_time, 4),
+                'peak_memory_mb': round(peak / 1024 ** 2, 2),
+                'size_mb': round(len(outputs[name]) / 1024 ** 2, 2),
+            }
+        results['identical'] = outputs['minidom'] == outputs['streaming']
+
+    print(json.dumps(results, indent=4))
+
+
+# Main
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+"""Generate synthetic map libraries and campaign databases.
+
+Usage:
+    python -m benchmarks.synthetic DIRECTORY [--maps N] [--layers N]
+        [--occluders N] [--db-bulk N] [--file-size KB]
+
+Creates DIRECTORY/maps, a map library with one directory per map and one
+gridless image per layer, and DIRECTORY/campaign, a campaign dir with a
+db.xml and an images folder. Half of the maps already have an entry in
+db.xml, as if they were ingested before. The images are valid JPEG headers
+padded to the requested size, so they can be copied and probed but not
+decoded.
+
+"""
+
+
+# Imports
+
+from argparse import ArgumentParser
+import os
+import xml.etree.ElementTree as ET
+
+import fg_map_ingest
+
+
+# Globals
+
+IMAGE_SIZE = (3000, 2000)  # Pixel size written to the JPEG headers
+LAYER_NAMES = ('Day', 'Night', 'Dusk', 'Fog', 'Snow', 'Rain')
+
+
+# Private Functions
+
+def _jpeg_header(width, height):
+    """Return the SOI, APP0 and SOF0 segments of a JPEG image"""
+    return (
+        b'\xff\xd8'
+        b'\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00'
+        b'\xff\xc0\x00\x11\x08' +
+        height.to_bytes(2, 'big') + width.to_bytes(2, 'big') +
+        b'\x03\x01\x22\x00\x02\x11\x01\x03\x11\x01'
+    )
+
+
+def _layer_name(layer_id):
+    """Return a unique layer name, cycling through LAYER_NAMES"""
+    name = LAYER_NAMES[layer_id % len(LAYER_NAMES)]
+    if layer_id >= len(LAYER_NAMES):
+        name += ' {}'.format(layer_id // len(LAYER_NAMES) + 1)
+    return name
+
+
+def _occluder(occluder_id):
+    """Return an occluder element with a small polygon"""
+    occluder = ET.Element('occluder')
+    ET.SubElement(occluder, 'id').text = str(occluder_id)
+    x = occluder_id * 10
+    ET.SubElement(occluder, 'points').text = ','.join(
+        str(_) for _ in (x, 0, x + 10, 0, x + 10, 10, x, 10, x, 0)
+    )
+    return occluder
+
+
+def _write_db(filepath, maps, layers, occluders, db_bulk):
+    """Write a db.xml with entries for every other map and story bulk"""
+    root = ET.Element('root', version='4.1', release='8|CoreRPG:4.1')
+    image = ET.SubElement(root, 'image')
+    for i in range(0, maps, 2):
+        entry = ET.SubElement(image, 'id-{:05d}'.format(i + 1))
+        image_elem = ET.SubElement(entry, 'image', type='image')
+        for name, text in (
+                ('allowplayerdrawing', 'on'), ('grid', 'on'),
+                ('gridsize', '100,100'), ('gridoffset', '0,0'),
+                ('gridsnap', 'on'), ('brushsize', '10.0,10.0')
+        ):
+            ET.SubElement(image_elem, name).text = text
+        layers_elem = ET.SubElement(image_elem, 'layers')
+        for layer_id in range(layers):
+            layer = ET.SubElement(layers_elem, 'layer')
+            ET.SubElement(layer, 'name').text = _layer_name(layer_id)
+            ET.SubElement(layer, 'id').text = str(layer_id)
+            ET.SubElement(layer, 'type').text = 'image'
+            ET.SubElement(layer, 'bitmap').text = (
+                'campaign/images/Map {:05d}/{}.jpg'.format(
+                    i, _layer_name(layer_id)
+                )
+            )
+        for occluder_id in range(occluders):
+            layer = ET.SubElement(layers_elem, 'layer')
+            ET.SubElement(layer, 'id').text = str(layers + occluder_id)
+            ET.SubElement(layer, 'type').text = 'image'
+            ET.SubElement(layer, 'bitmap')
+            ET.SubElement(layer, 'occluders').append(_occluder(occluder_id))
+        ET.SubElement(entry, 'locked', type='number').text = '0'
+        ET.SubElement(entry, 'name', type='string').text = (
+            'Map {:05d}'.format(i)
+        )
+
+    story = ET.SubElement(root, 'encounter')
+    for i in range(db_bulk):
+        entry = ET.SubElement(story, 'id-{:05d}'.format(i + 1))
+        ET.SubElement(entry, 'name', type='string').text = (
+            'Story {}'.format(i)
+        )
+        text = ET.SubElement(entry, 'text', type='formattedtext')
+        for paragraph in range(5):
+            p = ET.SubElement(text, 'p')
+            p.text = 'Read aloud & <describe> paragraph {} '.format(paragraph)
+            bold = ET.SubElement(p, 'b')
+            bold.text = 'important'
+            bold.tail = ' and the rest of the sentence.' * 4
+
+    with open(filepath, 'w') as f:
+        fg_map_ingest._write_pretty_xml(root, f)
+
+
+# Public Functions
+
+def generate_library(
+        directory, maps=100, layers=2, occluders=10, db_bulk=1000,
+        file_size=256
+):
+    """Generate a synthetic map library and campaign dir.
+
+    Args:
+        directory (str): Directory to create the library and campaign in.
+        maps (int): Number of map directories.
+        layers (int): Number of gridless image layers per map.
+        occluders (int): Number of occluders per map, both in the DB
+            entries and in the occluders.xml sidecar of the other maps.
+        db_bulk (int): Number of non-image story entries in db.xml.
+        file_size (int): Size of every layer image in KB.
+
+    Returns:
+        str, str: The map library directory and the campaign dir.
+
+    """
+    map_dir = os.path.join(directory, 'maps')
+    campaign_dir = os.path.join(directory, 'campaign')
+    os.makedirs(os.path.join(campaign_dir, 'images'), exist_ok=True)
+
+    header = _jpeg_header(*IMAGE_SIZE)
+    padding = b'\0' * max(0, file_size * 1024 - len(header) - 2)
+    image = header + padding + b'\xff\xd9'
+    for i in range(maps):
+        map_name = 'Map {:05d}'.format(i)
+        for layer_id in range(layers):
+            layer_dir = os.path.join(map_dir, map_name, _layer_name(layer_id))
+            os.makedirs(layer_dir, exist_ok=True)
+            filename = '{} {} 30x20 gridless.jpg'.format(
+                map_name, _layer_name(layer_id)
+            )
+            with open(os.path.join(layer_dir, filename), 'wb') as f:
+                f.write(image)
+        if i % 2 and occluders:
+            xml_root = ET.Element('saved-occluders')
+            for occluder_id in range(occluders):
+                xml_root.append(_occluder(occluder_id))
+            filepath = os.path.join(map_dir, map_name, 'occluders.xml')
+            with open(filepath, 'w') as f:
+                fg_map_ingest._write_pretty_xml(xml_root, f)
+
+    _write_db(
+        os.path.join(campaign_dir, 'db.xml'), maps, layers, occluders, db_bulk
+    )
+    return map_dir, campaign_dir
+
+
+def add_arguments(parser):
+    """Add the library size arguments to an ArgumentParser"""
+    parser.add_argument(
+        "--maps",
+        type=int,
+        default=100,
+        help="the number of maps in the library. Defaults to 100."
+    )
+    parser.add_argument(
+        "--layers",
+        type=int,
+        default=2,
+        help="the number of image layers per map. Defaults to 2."
+    )
+    parser.add_argument(
+        "--occluders",
+        type=int,
+        default=10,
+        help="the number of occluders per map. Defaults to 10."
+    )
+    parser.add_argument(
+        "--db-bulk",
+        type=int,
+        default=1000,
+        help="the number of non-image story entries in db.xml. Defaults to "
+             "1000."
+    )
+    parser.add_argument(
+        "--file-size",
+        type=int,
+        default=256,
+        help="the size of every layer image in KB. Defaults to 256."
+    )
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument(
+        "directory",
+        help="the directory to create the library and campaign in"
+    )
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    map_dir, campaign_dir = generate_library(
+        args.directory, maps=args.maps, layers=args.layers,
+        occluders=args.occluders, db_bulk=args.db_bulk,
+        file_size=args.file_size
+    )
+    print(map_dir)
+    print(campaign_dir)
+
+
+# Main
+
+if __name__ == '__main__':
+    main()
@@ -3,19 +3,56 @@
 
 # Imports
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser, Namespace
+from array import array
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+import cProfile
+import hashlib
+import io
+import itertools
 import json
 from json.decoder import JSONDecodeError
 import logging
+import mmap
 import os
 import re
+import select
 import shutil
-from xml.dom import minidom
+import struct
+import tempfile
+import threading
+import time
 import xml.etree.ElementTree as ET
+import zipfile
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.inotify_init1
+except (AttributeError, ImportError, OSError, TypeError):  # Not Linux
+    libc = None
+
+try:
+    import numpy as np
+except ImportError:  # Only needed for --simplify-occluders
+    np = None
+
+try:
+    from PIL import Image
+except ImportError:  # Only needed for --optimize-images
+    Image = None
 
 
 # Globals
 
+ARCHIVE_SUFFIX = '.zip'
 BOOLEAN_MAP = {
     'on': True,
     'off': False
@@ -24,6 +61,10 @@ BOOLEAN_MAP_INVERSE = {
     True: 'on',
     False: 'off'
 }
+COPY_CHECKS = ('exists', 'stat', 'hash')
+COPY_CHUNK_SIZE = 8 * 1024 * 1024  # Bytes read at a time by copies
+COPY_JOURNAL_INTERVAL = 64 * 1024 * 1024  # Bytes between journal updates
+CAMPAIGN_IMAGE_PREFIX = 'campaign/images'  # Where db.xml finds campaign images
 CAMPAIGN_DIRS = (
     os.path.join(
         '{APPDATA}', 'Roaming', 'SmiteWorks', 'Fantasy Grounds',
@@ -33,9 +74,69 @@ CAMPAIGN_DIRS = (
         '{HOME}', 'SmiteWorks', 'Fantasy Grounds', 'campaigns', '{campaign}'
     )
 )
+DEFAULT_GRID_SIZE = 100
+GRIDLESS_SUFFIX = 'gridless.jpg'
+# Map size in grid squares, e.g. 'Cave 30x20 gridless.jpg'
+GRID_DIMENSIONS = re.compile(
+    r'(?<![\d.])(\d{1,3})\s*[x\u00d7]\s*(\d{1,3})(?!\d)', re.IGNORECASE
+)
+# Grid square size in pixels, e.g. 'Cave 140px gridless.jpg'
+GRID_PIXELS = re.compile(r'(?<![\d.])(\d{2,3})\s*px\b', re.IGNORECASE)
+GRID_TOLERANCE = 0.05  # Relative difference allowed between cell width/height
+FICLONE = 0x40049409  # Linux ioctl for cloning a file's extents
+HASH_CHUNK_SIZE = 1024 * 1024
+IMAGE_FORMATS = {  # Output format to file extension
+    'jpeg': '.jpg',
+    'webp': '.webp'
+}
+IMAGE_SECTION_START = re.compile(rb'<image\s*(/?)>')
+IMAGE_TAG = re.compile(rb'<(/?)image\b[^>]*?(/?)>')
+# inotify(7) flags
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len
+INOTIFY_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF
+)
+# Start of frame markers, except DHT (C4), JPG (C8) and DAC (CC)
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+LINK_MODES = ('copy', 'hardlink', 'reflink')
+MANIFEST_FILENAME = 'fg_map_ingest.json'
+MAP_ENTRY_TAG = re.compile(r'id-\d+$')
+MODULE_IMAGE_PREFIX = 'images'  # Where a module's db.xml finds its images
+MANIFEST_VERSION = 1
+MTIME_TOLERANCE = 2.0  # Seconds, FAT and SMB shares store coarse mtimes
 NEWLINE_FIX = re.compile(r'\n[\t]*\n[\t]*')
+OPTIMIZE_CACHE_DIR = 'fg_map_ingest_cache'
+PARTIAL_COPY_SUFFIX = '.part'  # Interrupted copies are resumed from these
+PIPELINE_STAGES = ('scan', 'build', 'optimize', 'copy', 'write')
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+ROOT_START_TAG = re.compile(rb'<([^?!/\s>]+)[^>]*>')
+SIDECAR_FILES = ('settings.json', 'occluders.xml')
+STORED_EXTENSIONS = frozenset(('.jpg', '.jpeg', '.png', '.webp'))
+STREAM_BATCH_SIZE = 64  # Maps held in memory at once when streaming
+XML_DECLARATION = '<?xml version="1.0" ?>\n'
+XML_ENCODING_DECLARATION = re.compile(
+    rb'<\?xml[^>]*encoding\s*=\s*["\']([A-Za-z0-9._-]+)["\']'
+)
+XML_WRITE_BUFFER = 8192  # Pieces buffered before applying NEWLINE_FIX
+WATCH_POLL_INTERVAL = 0.25  # Seconds between scans without inotify
+TOP_LEVEL_IMAGE_START = re.compile(rb'\n\t<image\s*(/?)>')
 TEST_DIR = '/Volumes/backup/Project Backup/D&D Games/maps/neutral party'
 
+_archives = {}  # Zip archive path to its (pid, mtime_ns, size) and ZipFile
+_archives_lock = threading.Lock()
+
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
@@ -45,19 +146,31 @@ logger.addHandler(logging.NullHandler())
 class CampaignDB(object):
     """Object representing the campaign database"""
 
-    def __init__(self, campaign_dir):
+    def __init__(self, campaign_dir, lazy=False):
+        """Load the campaign database.
+
+        Args:
+            campaign_dir (str): The campaign dir holding db.xml.
+            lazy (bool): Only load the image section of db.xml into memory.
+                Everything else stays on disk and is copied back byte for
+                byte when saving. Falls back to a full load if the image
+                section cannot be located.
+
+        """
 
         logger.info("Initializing CampaignDB object for %s", campaign_dir)
 
         self.campaign_dir = campaign_dir
         self._filepath = os.path.join(self.campaign_dir, 'db.xml')
+        self._maps = None
+        self.lazy = lazy
         try:
-            self._xml = ET.parse(self.filepath)
+            if self.lazy:
+                self._load_lazy()
+            else:
+                self._load()
         except FileNotFoundError:
             raise ValueError("No db.xml file found.")
-        else:
-            self._root = self._xml.getroot()
-        self._maps = {}
 
     # Properties
 
@@ -71,19 +184,17 @@ class CampaignDB(object):
 
     @property
     def maps(self):
-        if not self._maps:
+        """MapRegistry of the image entries in the DB"""
+        if self._maps is None:
             logger.info("Retrieving map data from DB")
             self._maps = self._get_maps()
         return self._maps
 
     @property
     def pretty_xml(self):
-        return NEWLINE_FIX.sub(
-            '',
-            minidom.parseString(
-                ET.tostring(self.root)
-            ).toprettyxml(indent="\t")
-        )
+        f = io.StringIO()
+        _write_pretty_xml(self.root, f)
+        return f.getvalue()
 
     @property
     def root(self):
@@ -91,57 +202,322 @@ class CampaignDB(object):
 
     # Private Methods
 
-    def _add_maps(self, maps):
+    def _add_maps(self, maps, elements=()):
         """Add given Map objects to the database.
 
         Args:
             maps (list[Map]): List of map objects.
+            elements (list[Element]): Existing image entries to add back.
 
         """
-        maps = sorted(maps, key=lambda x: x.id)
-        for map in maps:
-            self.image.append(map.xml)
+        elements = list(elements) + [map.xml for map in maps]
+        elements.sort(key=lambda x: int(x.tag.split('-')[-1]))
+        for element in elements:
+            self.image.append(element)
+
+    @classmethod
+    def _declared_encoding(cls, data):
+        """Return the encoding named in the XML declaration, or utf-8"""
+        match = XML_ENCODING_DECLARATION.match(data)
+        if match:
+            return match.group(1).decode('ascii').lower()
+        return 'utf-8'
+
+    @classmethod
+    def _find_image_end(cls, data, start_match):
+        """Return the offset just past the end tag of an image element
+
+        Args:
+            data (bytes|mmap): The raw contents of db.xml.
+            start_match (re.Match): Match of the image start tag.
+
+        Returns:
+            int|None: The end offset, or None if the element never closes.
+
+        """
+        if start_match.group(1):
+            return start_match.end()
+        # The top level image has no attributes, map entries hold
+        # <image type="image"> elements which also close with </image>.
+        depth = 0
+        for tag in IMAGE_TAG.finditer(data, start_match.start()):
+            if tag.group(2):
+                continue
+            depth += -1 if tag.group(1) else 1
+            if depth == 0:
+                return tag.end()
+        return None
 
     def _get_maps(self):
-        image_dict = {}
+        """Build the MapRegistry in a single pass over the image entries"""
+        registry = MapRegistry()
         for image_id in self.image:
-            image_map = {}
-            image = image_id.find('image')
-            image_map['map_id'] = int(image_id.tag.split('-')[-1])
-            image_map['name'] = image_id.find('name').text
-            image_map['player_drawing'] = (
-                BOOLEAN_MAP[image.find('allowplayerdrawing').text]
+            record = self._parse_map_entry(image_id)
+            if record is None:
+                logger.warning(
+                    "Skipping malformed image entry %s", image_id.tag
+                )
+                continue
+            registry.add(record)
+
+            logger.debug(
+                "Registered campaign information for %s", record.name
             )
-            image_map['grid'] = (
-                BOOLEAN_MAP[image.find('grid').text]
+
+        for name, map_ids in sorted(registry.duplicate_names.items()):
+            logger.warning(
+                "Map name %s is used by more than one image entry (IDs %s), "
+                "using ID %s", name, ', '.join(str(_) for _ in map_ids),
+                registry[name].map_id
             )
-            image_map['grid_size'] = self._translate_xml_xy(
-                image.find('gridsize').text
+        for map_id, names in sorted(registry.duplicate_ids.items()):
+            logger.warning(
+                "Image ID %s is used by more than one image entry (%s)",
+                map_id, ', '.join(names)
             )
+
+        return registry
+
+    def _load(self):
+        """Parse all of db.xml"""
+        with open(self.filepath, 'rb') as f:
+            data = f.read()
+            stat = os.fstat(f.fileno())
+        self._xml = ET.ElementTree(ET.fromstring(data))
+        self._root = self._xml.getroot()
+
+        # Where the image section sits in the file, for splicing on save
+        self._encoding = self._declared_encoding(data)
+        self._image_span = self._locate_image(data)
+        self._source_stat = (stat.st_mtime_ns, stat.st_size)
+
+    def _load_lazy(self):
+        """Parse only the image section of db.xml.
+
+        The file is memory mapped. The image section is first looked up by
+        its indentation, failing that the file is run through a pull parser
+        which drops elements outside the image section as soon as they are
+        complete. Either way only the root and the image subtree stay in
+        memory.
+
+        """
+        with open(self.filepath, 'rb') as f:
+            stat = os.fstat(f.fileno())
             try:
-                image_map['grid_offset'] = self._translate_xml_xy(
-                    image.find('gridoffset').text
-                )
-            except AttributeError:
-                image_map['grid_offset'] = (0, 0)
-            image_map['grid_snap'] = (
-                BOOLEAN_MAP[image.find('gridsnap').text]
-            )
-            image_map['brush_size'] = self._translate_xml_xy(
-                image.find('brushsize').text
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # Empty file
+                data = b''
+            try:
+                self._encoding = self._declared_encoding(data)
+                scanned = self._scan_image(data)
+                if scanned is not None:
+                    self._root, self._image_span = scanned
+                else:
+                    self._root = self._iterparse_image(data)
+                    self._image_span = self._locate_image(data)
+                self._xml = ET.ElementTree(self._root)
+            finally:
+                if isinstance(data, mmap.mmap):
+                    data.close()
+        self._source_stat = (stat.st_mtime_ns, stat.st_size)
+
+        if self._image_span is None:
+            logger.info(
+                "Image section of %s not found, loading it fully", self.filepath
             )
-            image_map['occluders'] = []
-            for layer in image.find('layers'):
-                occluder = layer.find('occluders')
-                if occluder:
-                    image_map['occluders'].append(occluder)
-            image_dict[image_map['name']] = image_map
+            self.lazy = False
+            self._load()
 
-            logger.debug(
-                "Registered campaign information for %s", image_map['name']
-            )
+    @classmethod
+    def _iterparse_image(cls, data):
+        """Parse raw XML keeping only the root and its image child.
+
+        Parsing stops as soon as the image element is complete, the rest of
+        the file is never needed since it is copied back as raw bytes.
+
+        Args:
+            data (bytes|mmap): The raw contents of db.xml.
+
+        Returns:
+            Element: The root, holding at most the top level image element.
+
+        """
+        parser = ET.XMLPullParser(events=('start', 'end'))
+        stack = []
+        root = image = None
+
+        def _handle_events():
+            """Returns True once the image element is complete"""
+            nonlocal root, image
+            for event, elem in parser.read_events():
+                if event == 'start':
+                    if root is None:
+                        root = elem
+                    elif (
+                        image is None and len(stack) == 1 and
+                        elem.tag == 'image'
+                    ):
+                        image = elem
+                    stack.append(elem)
+                    continue
+                stack.pop()
+                if elem is image:
+                    return True
+                if not stack:
+                    continue
+                if image is not None and len(stack) > 1 and stack[1] is image:
+                    continue
+                # Events arrive in batches, so later siblings may already
+                # have been appended and elem is not necessarily the last.
+                stack[-1].remove(elem)
+
+        for offset in range(0, len(data), HASH_CHUNK_SIZE):
+            parser.feed(data[offset:offset + HASH_CHUNK_SIZE])
+            if _handle_events():
+                return root
+        parser.close()
+        _handle_events()
+        return root
+
+    def _locate_image(self, data):
+        """Find the byte span of the top level image element in the raw DB.
+
+        The span runs from the '<' of the start tag to the '>' of the end
+        tag. It is only returned if the bytes in it parse to exactly the
+        image element that was loaded, otherwise None is returned and saving
+        falls back to writing the whole DB.
+
+        Args:
+            data (bytes): The raw contents of db.xml.
+
+        Returns:
+            tuple[int, int]|None: Start and end offsets.
+
+        """
+        image = self.image
+        try:
+            ascii_compatible = '<image>'.encode(self._encoding) == b'<image>'
+        except LookupError:
+            ascii_compatible = False
+        if image is None or not ascii_compatible:
+            return None
+
+        digest = _element_digest(image)
+        for start_match in IMAGE_SECTION_START.finditer(data):
+            start = start_match.start()
+            end = self._find_image_end(data, start_match)
+            if end is None:
+                continue
+
+            try:
+                section = ET.fromstring(data[start:end].decode(self._encoding))
+            except (ET.ParseError, UnicodeDecodeError):
+                continue
+            if _element_digest(section) == digest:
+                return start, end
+
+        logger.debug("Could not locate the image section in %s", self.filepath)
+        return None
+
+    @classmethod
+    def _parse_map_entry(cls, image_id):
+        """Parse an id-NNNNN image entry into a MapRecord.
+
+        Every element is visited once. Settings missing from the entry are
+        left as None, so the Map falls back to its defaults.
+
+        Returns:
+            MapRecord|None: None if the entry has no usable ID or name.
+
+        """
+        try:
+            map_id = int(image_id.tag.split('-')[-1])
+        except ValueError:
+            return None
+
+        name = image = None
+        for child in image_id:
+            if child.tag == 'name':
+                name = child.text
+            elif child.tag == 'image':
+                image = child
+        if name is None:
+            return None
+
+        record = MapRecord(map_id, name, element=image_id)
+        if image is None:
+            return record
+
+        for child in image:
+            text = child.text
+            if child.tag == 'layers':
+                # Map._generate_xml writes the layers in reverse
+                for layer in reversed(child):
+                    for layer_child in layer:
+                        if layer_child.tag == 'occluders':
+                            record.occluders.extend(
+                                Occluder.from_elements(layer_child)
+                            )
+            elif text is None:
+                continue
+            elif child.tag == 'allowplayerdrawing':
+                record.player_drawing = BOOLEAN_MAP.get(text)
+            elif child.tag == 'grid':
+                record.grid = BOOLEAN_MAP.get(text)
+            elif child.tag == 'gridsize':
+                record.grid_size = cls._translate_xml_xy(text)
+            elif child.tag == 'gridoffset':
+                record.grid_offset = cls._translate_xml_xy(text)
+            elif child.tag == 'gridsnap':
+                record.grid_snap = BOOLEAN_MAP.get(text)
+            elif child.tag == 'brushsize':
+                record.brush_size = cls._translate_xml_xy(text)
+        return record
+
+    def _write_image_section(self, f, entries):
+        """Write the image element as it sits in db.xml.
+
+        The output is what _write_pretty_xml writes for the image element at
+        a one tab indent, without that indent and the final newline, as the
+        original bytes around the section remain.
 
-        return image_dict
+        Args:
+            f (file): Text file handle to write to.
+            entries (iterable): The children of the image element, either
+                elements or entries serialized by a MapSpool.
+
+        """
+        image = self.image
+        entries = iter(entries)
+        first = next(entries, None)
+        with _pretty_xml_stream(f) as write:
+            write('<' + image.tag)
+            for key, value in image.attrib.items():
+                write(' {}="{}"'.format(key, _escape_xml(value)))
+            text = image.text
+            if text and '\r' in text:
+                text = text.replace('\r\n', '\n').replace('\r', '\n')
+            if first is None:
+                if text:
+                    write('>' + _escape_xml(text) + '</' + image.tag + '>')
+                else:
+                    write('/>')
+                return
+
+            write('>\n')
+            if text:
+                write('\t\t' + _escape_xml(text) + '\n')
+            for entry in itertools.chain((first,), entries):
+                if isinstance(entry, str):
+                    write(entry)
+                    continue
+                _serialize_pretty_xml(entry, write, '\t\t')
+                tail = entry.tail
+                if tail:
+                    if '\r' in tail:
+                        tail = tail.replace('\r\n', '\n').replace('\r', '\n')
+                    write('\t\t' + _escape_xml(tail) + '\n')
+            write('\t</' + image.tag + '>')
 
     def _remove_existing_images(self):
         """Removes all images under the image element"""
@@ -149,6 +525,92 @@ class CampaignDB(object):
         for child in elems:
             self.image.remove(child)
 
+    def _scan_image(self, data):
+        """Find and parse the image section without parsing anything else.
+
+        Fantasy Grounds and this tool indent top level elements with a
+        single tab. If exactly one such image element exists and all of its
+        children are map entries, only it and the root start tag are parsed.
+
+        Args:
+            data (bytes|mmap): The raw contents of db.xml.
+
+        Returns:
+            tuple[Element, tuple[int, int]]|None: The root holding only the
+            image element and the span of the image section, or None if the
+            section could not be identified unambiguously.
+
+        """
+        matches = list(
+            itertools.islice(TOP_LEVEL_IMAGE_START.finditer(data), 2)
+        )
+        root_match = ROOT_START_TAG.search(data)
+        if len(matches) != 1 or root_match is None:
+            return None
+        start_match = matches[0]
+        start = start_match.start() + 2  # Skip the newline and tab
+        end = self._find_image_end(data, start_match)
+        if end is None or root_match.end() > start:
+            return None
+
+        try:
+            root = ET.fromstring(
+                data[root_match.start():root_match.end()].decode(
+                    self._encoding
+                ) + '</{}>'.format(root_match.group(1).decode('ascii'))
+            )
+            image = ET.fromstring(data[start:end].decode(self._encoding))
+        except (ET.ParseError, UnicodeDecodeError, LookupError):
+            return None
+        if not all(MAP_ENTRY_TAG.match(child.tag) for child in image):
+            return None
+        root.append(image)
+        return root, (start, end)
+
+    def _splice_db(self, entries=None):
+        """Replace only the image section of db.xml on disk.
+
+        Everything outside the image section is copied over as the original
+        bytes, so unrelated data is never reformatted. The section is
+        encoded straight into the new file.
+
+        Args:
+            entries (iterable|None): Image entries to write, see
+                _write_image_section. Defaults to the in-memory entries.
+
+        Returns:
+            bool: False if db.xml changed on disk since it was loaded, in
+            which case nothing was written.
+
+        """
+        start, end = self._image_span
+        if entries is None:
+            entries = list(self.image)
+
+        temp_filepath = self.filepath + '.tmp'
+        with open(self.filepath, 'rb') as fsrc:
+            stat = os.fstat(fsrc.fileno())
+            if (stat.st_mtime_ns, stat.st_size) != self._source_stat:
+                return False
+            with open(temp_filepath, 'wb') as fdst:
+                _copy_byte_range(fsrc, fdst, start)
+                section = io.TextIOWrapper(
+                    fdst, encoding=self._encoding, errors='xmlcharrefreplace',
+                    newline=''
+                )
+                self._write_image_section(section, entries)
+                section.flush()
+                section_end = fdst.tell()
+                section.detach()
+                fsrc.seek(end)
+                shutil.copyfileobj(fsrc, fdst, HASH_CHUNK_SIZE)
+        os.replace(temp_filepath, self.filepath)
+
+        stat = os.stat(self.filepath)
+        self._image_span = (start, section_end)
+        self._source_stat = (stat.st_mtime_ns, stat.st_size)
+        return True
+
     @classmethod
     def _translate_xml_xy(cls, value):
         """Takes text in the form of 'x,y' and turns it into tuple w/ float"""
@@ -160,490 +622,4068 @@ class CampaignDB(object):
 
     # Public Methods
 
-    def save_db(self):
-        """Updates the database on disk"""
+    def changed_on_disk(self):
+        """Check if db.xml was modified since it was loaded or saved"""
+        try:
+            stat = os.stat(self.filepath)
+        except FileNotFoundError:
+            return True
+        return (stat.st_mtime_ns, stat.st_size) != self._source_stat
+
+    def map_element(self, name):
+        """Return the image entry element for a map name, or None"""
+        record = self.maps.get(name)
+        if record is None:
+            return None
+        return record.element
+
+    def save_db(self, splice=True):
+        """Updates the database on disk
+
+        Args:
+            splice (bool): Only replace the image section of the existing
+                file when it can be located safely. Otherwise the whole
+                database is written. Lazily loaded databases always splice.
+
+        """
+        if (splice or self.lazy) and self._image_span is not None:
+            if self._splice_db():
+                logger.debug("Spliced image section into %s", self.filepath)
+                return
+            if self.lazy:
+                raise RuntimeError(
+                    "{} changed on disk since it was read. Only its image "
+                    "section was loaded, so it cannot be rewritten "
+                    "whole.".format(self.filepath)
+                )
+            logger.info(
+                "%s changed on disk since it was read, rewriting it",
+                self.filepath
+            )
         with open(self.filepath, 'w') as f:
-            f.write(self.pretty_xml)
+            _write_pretty_xml(self.root, f)
+        # The original layout is gone, later saves have to write it whole.
+        self._image_span = None
+        stat = os.stat(self.filepath)
+        self._source_stat = (stat.st_mtime_ns, stat.st_size)
 
-    def update_db(self, maps):
+    def save_streamed(self, spool, keep=(), splice=True):
+        """Save the DB with the image entries of a MapSpool.
+
+        The result is the same as update_db followed by save_db, but when
+        the image section can be spliced the spooled entries are copied
+        from the spool into db.xml without ever being parsed. Afterwards
+        only the kept entries are in memory.
+
+        Args:
+            spool (MapSpool): The entries of the maps that were built.
+            keep (iterable[str]): Names of unchanged maps whose existing
+                entries should be preserved.
+            splice (bool): See save_db.
+
+        """
+        keep = set(keep)
+        kept = [
+            child for child in self.image
+            if child.findtext('name') in keep
+        ]
+        self._remove_existing_images()
+        for child in kept:
+            self.image.append(child)
+        self._maps = None
+
+        if (splice or self.lazy) and self._image_span is not None:
+            # Same order as _add_maps, kept entries first among equal IDs
+            order = sorted(
+                [
+                    (int(child.tag.split('-')[-1]), 0, child, None)
+                    for child in kept
+                ] + [
+                    (map_id, 1, offset, length)
+                    for map_id, offset, length in spool.entries
+                ],
+                key=lambda x: x[:2]
+            )
+            entries = (
+                spool.read(entry, length) if length is not None else entry
+                for _, _, entry, length in order
+            )
+            if self._splice_db(entries):
+                logger.debug("Spliced image section into %s", self.filepath)
+                return
+
+        # The section has to be written whole, parse the spooled entries.
+        self._remove_existing_images()
+        self._add_maps([], kept + [
+            ET.fromstring(spool.read(offset, length))
+            for _, offset, length in spool.entries
+        ])
+        self.save_db(splice=splice)
+
+    def update_db(self, maps, keep=()):
         """Clears DB of images and repopulates.
 
         Args:
             maps (list[Map]): List of map objects.
+            keep (iterable[str]): Names of unchanged maps whose existing
+                entries should be preserved.
 
         """
+        keep = set(keep)
+        kept = [
+            child for child in self.image
+            if child.findtext('name') in keep
+        ]
         self._remove_existing_images()
-        self._add_maps(maps)
-
+        self._add_maps(maps, kept)
+        self._maps = None
 
-class Map(object):
-    """Representing one map."""
 
-    _campaign_defaults = {}
-    _runtime_defaults = {}
+class MapRecord(object):
+    """Compact record of a map's entry in the campaign DB."""
 
-    maps = {}
+    __slots__ = (
+        'map_id', 'name', 'player_drawing', 'grid', 'grid_size',
+        'grid_offset', 'grid_snap', 'brush_size', 'occluders', 'element'
+    )
 
     def __init__(
-            self, name, directory, campaign_db, map_id=None, parent_map=False,
-            player_drawing=None, grid=None, grid_size=None, grid_offset=None,
-            grid_snap=None, brush_size=None, occluders=None
+            self, map_id, name, player_drawing=None, grid=None,
+            grid_size=None, grid_offset=(0, 0), grid_snap=None,
+            brush_size=None, occluders=None, element=None
     ):
+        self.map_id = map_id
+        self.name = name
+        self.player_drawing = player_drawing
+        self.grid = grid
+        self.grid_size = grid_size
+        self.grid_offset = grid_offset
+        self.grid_snap = grid_snap
+        self.brush_size = brush_size
+        self.occluders = [] if occluders is None else occluders
+        self.element = element
 
-        logger.info("Initializing a Map object for %s", name)
+    # Public Methods
 
-        self.name = name
-        self.source_directory = directory
-        self._xml = None
+    def settings(self):
+        """Return the settings as keyword arguments for Map"""
+        return {
+            'map_id': self.map_id,
+            'name': self.name,
+            'player_drawing': self.player_drawing,
+            'grid': self.grid,
+            'grid_size': self.grid_size,
+            'grid_offset': self.grid_offset,
+            'grid_snap': self.grid_snap,
+            'brush_size': self.brush_size,
+            'occluders': self.occluders
+        }
 
-        self._id = map_id
-        self._parent_map = False
-        self._player_drawing = player_drawing
-        self._grid = grid
-        self._grid_size = grid_size
-        self._grid_offset = grid_offset
-        self._grid_snap = grid_snap
-        self._brush_size = brush_size
 
-        if occluders:
-            self._occluders = occluders
-        else:
-            try:
-                self._occluders = self._read_occluder_xml()
-            except FileNotFoundError:  # TODO: Add malformed XML exception
-                logger.debug("No XML Occluder file found for %s", self.name)
-                self._occluders = []
+class MapRegistry(object):
+    """MapRecords of a campaign DB, indexed by name and by map ID.
 
-        try:
-            self._json_sidecar_settings = self._read_json_sidecar()
-        except (FileNotFoundError, JSONDecodeError):
-            logger.debug(
-                "None or malformed JSON sidecar file found for %s", self.name
-            )
-            self._json_sidecar_settings = {}
+    When several entries share a name the one with the lowest ID is indexed
+    under that name. Every record stays reachable by its ID, and all clashes
+    are kept in duplicate_names and duplicate_ids.
 
-        self.layers = self._generate_layers()
-        self.campaign_db = campaign_db
+    """
 
-        self.maps[self.name] = self
+    def __init__(self):
+        self._by_name = {}
+        self._by_id = {}
+        self.duplicate_names = {}  # Name to list of map IDs
+        self.duplicate_ids = {}  # Map ID to list of names
 
-    # Properties
+    def __contains__(self, name):
+        return name in self._by_name
 
-    @property
-    def brush_size(self):
-        if self._brush_size is None:
-            self._brush_size = self._find_best_default('brush_size')
-        return self._brush_size
+    def __getitem__(self, name):
+        return self._by_name[name]
 
-    @property
-    def destination_dir(self):
-        return os.path.join(
-            self.campaign_db.campaign_dir,
-            'images',
-            os.path.basename(self.source_directory)
-        )
+    def __iter__(self):
+        return iter(self._by_name)
 
-    @property
-    def grid(self):
-        if self._grid is None:
-            self._grid = self._find_best_default('grid')
-        return self._grid
+    def __len__(self):
+        return len(self._by_name)
 
-    @property
-    def grid_offset(self):
-        if self._grid_offset is None:
-            self._grid_offset = self._find_best_default('grid_offset')
-        return self._grid_offset
+    # Public Methods
 
-    @property
-    def grid_size(self):
-        if self._grid_size is None:
-            self._grid_size = self._find_best_default('grid_size')
-        return self._grid_size
+    def add(self, record):
+        """Index a MapRecord, recording any name or ID clash"""
+        existing = self._by_name.get(record.name)
+        if existing is not None:
+            self.duplicate_names.setdefault(
+                record.name, [existing.map_id]
+            ).append(record.map_id)
+        if existing is None or record.map_id < existing.map_id:
+            self._by_name[record.name] = record
+
+        existing = self._by_id.get(record.map_id)
+        if existing is not None:
+            self.duplicate_ids.setdefault(
+                record.map_id, [existing.name]
+            ).append(record.name)
+        else:
+            self._by_id[record.map_id] = record
 
-    @property
-    def grid_snap(self):
-        if self._grid_snap is None:
-            self._grid_snap = self._find_best_default('grid_snap')
-        return self._grid_snap
+    def by_id(self, map_id):
+        """Return the MapRecord with a map ID, or None"""
+        return self._by_id.get(map_id)
 
-    @property
-    def id(self):
-        if self._id is None:
-            # Existing map ID for map does not exist in DB
-            if self.json_sidecar_settings.get('map_id') is None:
-                # Map ID also not set in JSON
-                return None
-            else:
-                self._id = self.json_sidecar_settings['map_id']
-        return self._id
+    def get(self, name, default=None):
+        """Return the MapRecord with a name, or default"""
+        return self._by_name.get(name, default)
 
-    @id.setter
-    def id(self, value):
-        if self._id is not None:
-            raise RuntimeError("Cannot set id on a Map which already has an id")
-        self._id = value
 
-    @property
-    def json_sidecar_settings(self):
-        """Json overrides from JSON sidecar file"""
-        return self._json_sidecar_settings
+class MapScan(object):
+    """Contents of one map directory, gathered in a single traversal.
 
-    @property
-    def json_filepath(self):
-        return os.path.join(self.source_directory, 'settings.json')
+    The directory tree is walked once with os.scandir. The gridless layer
+    files are kept in the order os.walk would find them, and the mtime and
+    size of every gridless and sidecar file are kept from the directory
+    entries, keyed by their path relative to the map directory.
 
-    @property
-    def occluders(self):
-        if self.parent_map:
-            # Redirect occluders to parent map
-            return self.maps[self.parent_map].occluders
-        else:
-            return self._occluders
+    A map directory within a zip archive, see _archive_member, is scanned
+    from the archive's member list instead.
 
-    @property
-    def occluder_xml_filepath(self):
-        return os.path.join(self.source_directory, 'occluders.xml')
+    """
 
-    @property
-    def parent_map(self):
-        if self._parent_map is False:
-            self._parent_map = self.json_sidecar_settings.get('parent_map')
-        return self._parent_map
+    __slots__ = ('name', 'directory', 'gridless', 'stats')
+
+    def __init__(self, name, directory):
+        self.name = name
+        self.directory = directory
+        self.gridless = []  # (dir_name, filename) pairs
+        self.stats = {}  # Relative path to (mtime_ns, size)
+
+    # Properties
 
     @property
-    def player_drawing(self):
-        if self._player_drawing is None:
-            self._player_drawing = self._find_best_default('player_drawing')
-        return self._player_drawing
+    def has_occluders(self):
+        return 'occluders.xml' in self.stats
 
     @property
-    def xml(self):
-        if self._xml is None:
-            self._xml = self._generate_xml()
-        return self._xml
+    def has_settings(self):
+        return 'settings.json' in self.stats
 
     # Private Methods
 
-    def _create_dir(self):
-        """Create the destination dir for this map"""
-        logger.debug(
-            "Creating directory %s for %s", self.destination_dir, self.name
-        )
+    def _scan_dir(self, dir_name, rel_dir):
+        """Scan one directory, then recurse into its subdirectories"""
+        subdirs = []
+        gridless = None
+        with os.scandir(dir_name) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    # Like os.walk, do not follow symlinked directories.
+                    if not entry.is_symlink():
+                        subdirs.append(entry)
+                    continue
+
+                filename = entry.name
+                if filename.lower().endswith(GRIDLESS_SUFFIX):
+                    if gridless is not None:
+                        raise _conflicting_gridless_error(
+                            dir_name, gridless, filename
+                        )
+                    gridless = filename
+                    self.gridless.append((dir_name, filename))
+                elif rel_dir or filename not in SIDECAR_FILES:
+                    continue
+                stat = entry.stat()
+                self.stats[os.path.join(rel_dir, filename)] = (
+                    stat.st_mtime_ns, stat.st_size
+                )
+
+        for entry in subdirs:
+            self._scan_dir(entry.path, os.path.join(rel_dir, entry.name))
+
+    def _scan_archive(self, archive, member):
+        """Scan the members of a zip archive below a map directory"""
+        prefix = member + '/' if member else ''
+        found = {}  # Directory to its gridless file
+        for info in sorted(archive.infolist(), key=lambda x: x.filename):
+            if info.is_dir() or not info.filename.startswith(prefix):
+                continue
+            parts = info.filename[len(prefix):].split('/')
+            filename = parts[-1]
+            if filename.lower().endswith(GRIDLESS_SUFFIX):
+                dir_name = os.path.join(self.directory, *parts[:-1])
+                if dir_name in found:
+                    raise _conflicting_gridless_error(
+                        dir_name, found[dir_name], filename
+                    )
+                found[dir_name] = filename
+                self.gridless.append((dir_name, filename))
+            elif len(parts) > 1 or filename not in SIDECAR_FILES:
+                continue
+            self.stats[os.path.join(*parts)] = (
+                _zip_mtime_ns(info), info.file_size
+            )
+
+    # Public Methods
+
+    @staticmethod
+    def library_directories(directory):
+        """Find the map directories of a library.
+
+        The library is a directory or a zip archive. Its subdirectories are
+        maps, and so are the zip archives in a library directory, named
+        after the archive. An archive holding nothing but a single
+        directory is read from within that directory. A map directory wins
+        over an archive of the same name.
+
+        Args:
+            directory (str): The root map directory or map pack.
+
+        Returns:
+            dict[str, str]: Map name to absolute map directory, in name
+            order.
+
+        """
+        directory = os.path.abspath(directory)
+        found = _archive_member(directory)
+        if found is not None:
+            dirs, _ = _archive_listing(*found)
+            return {
+                name: os.path.join(directory, name) for name in sorted(dirs)
+            }
+
+        maps = {}
+        archives = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    maps[entry.name] = entry.path
+                elif (
+                    entry.name.lower().endswith(ARCHIVE_SUFFIX) and
+                    entry.is_file()
+                ):
+                    archives.append(entry)
+        for entry in archives:
+            map_name = entry.name[:-len(ARCHIVE_SUFFIX)]
+            if map_name in maps:
+                logger.warning(
+                    "Ignoring %s, there is a map directory of that name",
+                    entry.path
+                )
+                continue
+            path = entry.path
+            dirs, files = _archive_listing(_open_archive(path), '')
+            if len(dirs) == 1 and not files:
+                path = os.path.join(path, dirs.pop())
+            maps[map_name] = path
+        return dict(sorted(maps.items()))
+
+    def refresh_sidecars(self):
+        """Update the stats of the sidecar files after writing them"""
+        if _archive_member(self.directory) is not None:
+            return  # Sidecars are never written into archives
+        for filename in SIDECAR_FILES:
+            try:
+                stat = os.stat(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                self.stats.pop(filename, None)
+            else:
+                self.stats[filename] = (stat.st_mtime_ns, stat.st_size)
+
+    def scan(self):
+        """Walk the map directory"""
+        self.gridless = []
+        self.stats = {}
+        found = _archive_member(self.directory)
+        if found is not None:
+            self._scan_archive(*found)
+        else:
+            self._scan_dir(self.directory, '')
+        return self
+
+    @classmethod
+    def scan_library(cls, directory, jobs=1):
+        """Scan every map directory in a library.
+
+        Args:
+            directory (str): The root map directory.
+            jobs (int): Number of map directories to scan concurrently.
+
+        Returns:
+            dict[str, MapScan]: Scans keyed by map name, in name order.
+
+        """
+        scans = [
+            cls(map_name, map_dir)
+            for map_name, map_dir in cls.library_directories(directory).items()
+        ]
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            list(executor.map(cls.scan, scans))
+        return {scan.name: scan for scan in scans}
+
+
+class MapIDAllocator(object):
+    """Hands out unused map IDs in ascending order.
+
+    Used IDs are kept in a set and the allocation cursor only moves forward,
+    so allocating n IDs next to m used ones costs O(n + m) no matter how
+    sparse or large the used IDs are.
+
+    """
+
+    def __init__(self, used=(), id_range=None):
+        """Create an allocator.
+
+        Args:
+            used (iterable[int]): IDs that are already taken.
+            id_range (tuple[int, int]|None): Inclusive range to allocate
+                from. Defaults to any positive ID.
+
+        """
+        self._used = set(used)
+        self.start, self.end = id_range or (1, None)
+        self._cursor = self.start
+
+    # Public Methods
+
+    def allocate(self):
+        """Return the lowest unused ID in the range and mark it used"""
+        while self._cursor in self._used:
+            self._cursor += 1
+        if self.end is not None and self._cursor > self.end:
+            raise RuntimeError(
+                "No free map IDs left in the range {}-{}.".format(
+                    self.start, self.end
+                )
+            )
+        map_id = self._cursor
+        self._used.add(map_id)
+        self._cursor += 1
+        return map_id
+
+    def claim(self, map_id):
+        """Mark an existing ID as used.
+
+        Returns:
+            bool: False if the ID was already used.
+
+        """
+        if map_id in self._used:
+            return False
+        self._used.add(map_id)
+        return True
+
+
+class MapSpool(object):
+    """Image entries of released maps, kept in a temporary file.
+
+    A streaming ingest serializes the entry of every map as soon as the map
+    is done and keeps only its ID and location in memory. The entries are
+    stored as the raw pieces _write_pretty_xml writes, so writing them back
+    gives the same bytes as keeping the elements would have.
+
+    """
+
+    def __init__(self, directory=None):
+        """
+        Args:
+            directory (str|None): Where to create the temporary file. The
+                campaign dir keeps it off a RAM backed temp dir.
+
+        """
+        self._file = tempfile.TemporaryFile(dir=directory)
+        self.entries = []  # (map_id, offset, length)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Public Methods
+
+    def add(self, map):
+        """Serialize the image entry of a map"""
+        pieces = []
+        _serialize_pretty_xml(map.xml, pieces.append, '\t\t')
+        data = ''.join(pieces).encode('utf-8')
+        offset = self._file.seek(0, os.SEEK_END)
+        self._file.write(data)
+        self.entries.append((map.id, offset, len(data)))
+
+    def close(self):
+        self._file.close()
+
+    def read(self, offset, length):
+        """Return a serialized image entry"""
+        self._file.seek(offset)
+        return self._file.read(length).decode('utf-8')
+
+
+class ModuleWriter(object):
+    """Packs maps into a Fantasy Grounds module.
+
+    A module is a zip archive holding a definition.xml that names it, a
+    db.xml with the image entries and the layer images below
+    MODULE_IMAGE_PREFIX. Everything is streamed into a temporary archive
+    next to the module, which replaces it once complete, so nothing is
+    staged on disk. Images with an extension in STORED_EXTENSIONS are
+    already compressed and stored as they are, everything else is
+    deflated.
+
+    The maps have to be built by a session with MODULE_IMAGE_PREFIX as
+    its embed_prefix.
+
+    """
+
+    def __init__(self, filepath, root_attrib=None, name=None):
+        """
+        Args:
+            filepath (str): The module file, usually ending in .mod.
+            root_attrib (dict|None): Attributes of the root element of both
+                XML files, like the version and release of the campaign.
+            name (str|None): The module name. Defaults to the filename
+                without its extension.
+
+        """
+        self.filepath = filepath
+        self.root_attrib = dict(root_attrib or {})
+        self.name = name or os.path.splitext(os.path.basename(filepath))[0]
+
+    # Private Methods
+
+    def _write_image(self, archive, source, member):
+        """Stream an image into the archive, returning its size in bytes"""
+        mtime_ns, size = _stat_source(source)
+        date_time = max(time.localtime(mtime_ns / 1e9)[:6], (1980, 1, 1))
+        info = zipfile.ZipInfo(member, date_time)
+        info.file_size = size  # Lets zipfile decide on ZIP64 up front
+        if os.path.splitext(member)[1].lower() in STORED_EXTENSIONS:
+            info.compress_type = zipfile.ZIP_STORED
+        else:
+            info.compress_type = zipfile.ZIP_DEFLATED
+        logger.debug("Packing %s as %s", source, member)
+        with _open_source(source) as fsrc:
+            with archive.open(info, 'w') as fdst:
+                shutil.copyfileobj(fsrc, fdst, COPY_CHUNK_SIZE)
+        return size
+
+    @staticmethod
+    def _write_xml(archive, member, element):
+        """Stream an element into the archive as pretty printed XML"""
+        with archive.open(member, 'w') as raw:
+            f = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+            _write_pretty_xml(element, f)
+            f.flush()
+            f.detach()
+
+    # Public Methods
+
+    def write(self, maps):
+        """Write the module.
+
+        Args:
+            maps (iterable[Map]): The maps to pack, with IDs set and any
+                images already optimized.
+
+        Returns:
+            CopyReport: The outcome of packing the layer images.
+
+        """
+        maps = sorted(maps, key=lambda x: x.id)
+        report = CopyReport()
+        start = time.perf_counter()
+
+        definition = ET.Element('root', self.root_attrib)
+        for tag, text in (
+                ('name', self.name), ('category', None), ('author', None),
+                ('ruleset', 'Any')
+        ):
+            ET.SubElement(definition, tag).text = text
+        root = ET.Element('root', self.root_attrib)
+        image = ET.SubElement(root, 'image')
+
+        temp_filepath = self.filepath + '.tmp'
+        with zipfile.ZipFile(
+                temp_filepath, 'w', compression=zipfile.ZIP_DEFLATED
+        ) as archive:
+            self._write_xml(archive, 'definition.xml', definition)
+            for map in maps:
+                optimizer = map.image_optimizer
+                for layer in map.image_layers:
+                    source = layer.copy_source
+                    if source is None:
+                        report.failures[layer.source_filename] = (
+                            optimizer.failures[layer.source_filename]
+                        )
+                        continue
+                    try:
+                        report.bytes_copied += self._write_image(
+                            archive, source, layer.embed_filename
+                        )
+                    except OSError as err:
+                        report.failures[source] = err
+                    else:
+                        report.copied.append(layer.embed_filename)
+                image.append(map.xml)
+            self._write_xml(archive, 'db.xml', root)
+        os.replace(temp_filepath, self.filepath)
+
+        report.elapsed = time.perf_counter() - start
+        logger.info("Wrote module %s to %s", self.name, self.filepath)
+        return report
+
+
+class IngestSession(object):
+    """The maps of one ingest and the defaults they fall back on.
+
+    Every Map belongs to a session, so one process can hold several
+    campaigns at once, each in its own session.
+
+    """
+
+    def __init__(
+            self, runtime_defaults=None, campaign_defaults=None,
+            detect_grid_size=True, image_optimizer=None, occluder_tolerance=0,
+            embed_prefix=CAMPAIGN_IMAGE_PREFIX
+    ):
+        self.runtime_defaults = runtime_defaults or {}
+        self.campaign_defaults = campaign_defaults or {}
+        self.detect_grid_size = detect_grid_size
+        self.image_optimizer = image_optimizer
+        self.occluder_tolerance = occluder_tolerance  # In grid units
+        self.embed_prefix = embed_prefix  # Image path prefix in the XML
+        self.maps = {}
+        self.unchanged_maps = {}
+        self.occluder_cache = {}  # Path to ((mtime_ns, size), occluders)
+
+    # Private Methods
+
+    def _allocate_ids(self, map_ids, id_range=None, database=None):
+        """Give every map an unused ID.
+
+        Maps are visited in name order, so the same library always gets the
+        same IDs. A map whose ID is already taken by another map is given a
+        new one. Maps that hold their ID in the DB are visited first, so an
+        ID copied into another map's sidecar cannot take it from them.
+
+        Args:
+            map_ids (dict[str, int|None]): Map name to its current ID.
+            id_range (tuple[int, int]|None): Inclusive range to allocate new
+                IDs from. Defaults to any positive ID.
+            database (CampaignDB|None): The campaign database.
+
+        Returns:
+            dict[str, int]: Map name to its ID.
+
+        """
+        # Maps skipped by the manifest keep their IDs in the DB.
+        allocator = MapIDAllocator(self.unchanged_maps.values(), id_range)
+
+        def in_db(map_name):
+            record = database.maps.by_id(map_ids[map_name])
+            return record is not None and record.name == map_name
+
+        order = sorted(map_ids)
+        if database is not None:
+            order.sort(key=lambda _: not in_db(_))
+        resolved = dict(map_ids)
+        missing = []
+        for map_name in order:
+            map_id = map_ids[map_name]
+            if map_id is None:
+                missing.append(map_name)
+            elif not allocator.claim(map_id):
+                logger.warning(
+                    "%s shares id %s with another map, assigning a new id",
+                    map_name, map_id
+                )
+                missing.append(map_name)
+
+        for map_name in missing:
+            resolved[map_name] = allocator.allocate()
+            logger.debug("Setting %s to id %s", map_name, resolved[map_name])
+        return resolved
+
+    def _current_ids(self, scans, database, respect_db=True):
+        """Return the IDs scanned maps have before any are allocated.
+
+        As with Map.id, the ID in the DB takes precedence over the one in
+        the JSON sidecar.
+
+        Args:
+            scans (dict[str, MapScan]): Map name to its scan.
+            database (CampaignDB): The campaign database.
+            respect_db (bool): Use existing settings from the DB.
+
+        Returns:
+            dict[str, int|None]: Map name to its ID, see _allocate_ids.
+
+        """
+        map_ids = {}
+        for map_name, scan in scans.items():
+            if respect_db and map_name in database.maps:
+                map_ids[map_name] = database.maps[map_name].map_id
+            else:
+                map_ids[map_name] = self._peek_settings(scan).get('map_id')
+        return map_ids
+
+    def _build_map(self, map_name, directory, database, respect_db=True,
+                   scan=None, map_id=None):
+        """Build a single map, taking its existing settings from the DB"""
+        try:
+            if not respect_db:
+                # Complete overwrite of DB
+                raise KeyError()
+            db_map = database.maps[map_name].settings()
+        except KeyError:
+            db_map = {
+                'name': map_name,
+            }
+        if map_id is not None:
+            db_map['map_id'] = map_id
+
+        return Map(
+            directory=directory, campaign_db=database, scan=scan,
+            session=self, **db_map
+        )
+
+    def _build_pending(
+            self, map_name, pending, parents, database, respect_db=True,
+            map_ids=None
+    ):
+        """Build a pending map, building its parent first"""
+        if map_name in self.maps:
+            return
+        # Parents must exist before their children build their layers.
+        if parents.get(map_name) in pending:
+            self._build_pending(
+                parents[map_name], pending, parents, database, respect_db,
+                map_ids
+            )
+        scan = pending[map_name]
+        self._build_map(
+            map_name, scan.directory, database, respect_db, scan=scan,
+            map_id=map_ids[map_name] if map_ids else None
+        )
+
+    def _copy_layers(
+            self, maps, overwrite=False, jobs=1, check='exists',
+            link_mode='copy'
+    ):
+        """Copy the layers of the given, already optimized, maps"""
+        copies = []
+        total = 0
+        failures = {}  # Layers the optimizer failed on
+        optimizer = self.image_optimizer
+        for map in maps:
+            map._create_dir()
+            copies.extend(map.pending_copies(overwrite=overwrite, check=check))
+            total += len(map.image_layers)
+            if optimizer is None:
+                continue
+            for layer in map.image_layers:
+                error = optimizer.failures.get(layer.source_filename)
+                if error is not None:
+                    failures[layer.source_filename] = error
+        report = _copy_files(copies, jobs, link_mode)
+        report.skipped = total - len(copies) - len(failures)
+        report.failures.update(failures)
+        return report
+
+    @staticmethod
+    def _family_batches(pending, parents, batch_size):
+        """Split pending maps into batches that keep families together.
+
+        Child maps use the occluders of their parent, so a parent and all
+        of its children always end up in the same batch.
+
+        Yields:
+            list[str]: Names of the maps in a batch.
+
+        """
+        families = {}
+        for map_name in sorted(pending):
+            root = map_name
+            seen = {root}
+            while parents.get(root) in pending and parents[root] not in seen:
+                root = parents[root]
+                seen.add(root)
+            families.setdefault(root, []).append(map_name)
+
+        batch = []
+        for family in sorted(families.values()):
+            batch.extend(family)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _pending_scans(
+            self, directory, database, respect_db=True, manifest=None,
+            jobs=1, names=None
+    ):
+        """Scan the library and find the maps that have to be built.
+
+        Maps the manifest finds unchanged are registered in unchanged_maps,
+        see build_maps for the arguments.
+
+        Returns:
+            tuple[dict, dict]: Map name to MapScan of the maps to build, and
+            map name to the parent map named in its JSON sidecar.
+
+        """
+        library = MapScan.library_directories(directory)
+
+        def _scan(map_name):
+            return MapScan(
+                map_name,
+                library.get(map_name) or
+                os.path.abspath(os.path.join(directory, map_name))
+            ).scan()
+
+        if names is None:
+            scans = MapScan.scan_library(directory, jobs=jobs)
+        else:
+            scans = {
+                map_name: _scan(map_name) for map_name in sorted(names)
+                if map_name in library
+            }
+            for map_name, entry in manifest.entries.items():
+                if map_name not in names:
+                    self.unchanged_maps[map_name] = entry['map_id']
+        pending = {}
+        for map_name, scan in scans.items():
+            if (
+                manifest is not None and respect_db and
+                manifest.is_current(scan, database.map_element(map_name))
+            ):
+                logger.debug("%s is unchanged since last ingest", map_name)
+                self.unchanged_maps[map_name] = (
+                    manifest.entries[map_name]['map_id']
+                )
+            else:
+                pending[map_name] = scan
+
+        # Child maps share the occluders of their parent, so parents and
+        # children of changed maps have to be rebuilt along with them.
+        parents = {
+            map_name: self._peek_parent_map(scan)
+            for map_name, scan in pending.items()
+        }
+        changed = True
+        while changed:
+            changed = False
+            for map_name in list(self.unchanged_maps):
+                if (
+                    manifest.parent_of(map_name) in pending or
+                    map_name in parents.values()
+                ):
+                    del self.unchanged_maps[map_name]
+                    if map_name not in scans:
+                        scans[map_name] = _scan(map_name)
+                    pending[map_name] = scans[map_name]
+                    parents[map_name] = self._peek_parent_map(
+                        pending[map_name]
+                    )
+                    changed = True
+        return pending, parents
+
+    @staticmethod
+    def _peek_parent_map(scan):
+        """Return the parent map named in a map dir's JSON sidecar, if any"""
+        return IngestSession._peek_settings(scan).get('parent_map')
+
+    @staticmethod
+    def _peek_settings(scan):
+        """Return the settings in a map dir's JSON sidecar, if any"""
+        if not scan.has_settings:
+            return {}
+        filepath = os.path.join(scan.directory, 'settings.json')
+        try:
+            with _open_source(filepath) as f:
+                return json.load(f)
+        except (FileNotFoundError, JSONDecodeError):
+            return {}
+
+    # Public Methods
+
+    def build_maps(
+            self, directory, database, respect_db=True, manifest=None, jobs=1,
+            names=None
+    ):
+        """Build a Map for every map directory in the given directory.
+
+        Args:
+            directory (str): The root map directory.
+            database (CampaignDB): The campaign database.
+            respect_db (bool): Use existing settings from the DB.
+            manifest (IngestManifest|None): If given, maps that are unchanged
+                since the last ingest are not built. They are registered in
+                unchanged_maps instead.
+            jobs (int): Number of map directories to scan concurrently.
+            names (iterable[str]|None): Only scan these map directories. The
+                other maps in the manifest are taken to be unchanged.
+
+        """
+        pending, parents = self._pending_scans(
+            directory, database, respect_db, manifest, jobs, names
+        )
+        for map_name in sorted(pending):
+            self._build_pending(
+                map_name, pending, parents, database, respect_db
+            )
+
+    def clear(self):
+        """Forget all maps, keeping the defaults and the occluder cache"""
+        self.maps.clear()
+        self.unchanged_maps.clear()
+
+    def defaults_digest(self):
+        """Return a digest of the campaign and runtime defaults"""
+        return hashlib.sha1(
+            json.dumps(
+                [
+                    self.campaign_defaults, self.runtime_defaults,
+                    self.detect_grid_size,
+                    self.image_optimizer and self.image_optimizer.options,
+                    self.occluder_tolerance
+                ],
+                sort_keys=True
+            ).encode('utf-8')
+        ).hexdigest()
+
+    def occluder_report(self):
+        """Return the occluder points of every map before and after
+        simplification.
+
+        Returns:
+            dict[str, tuple[int, int]]: Map name to the number of points
+            read and the number embedded in db.xml, for maps with
+            occluders.
+
+        """
+        report = {}
+        for name, map in self.maps.items():
+            layers = [layer for layer in map.layers if layer.occluder]
+            if layers:
+                report[name] = (
+                    sum(len(_.occluder.points) // 2 for _ in layers),
+                    sum(len(_.embedded_occluder.points) // 2 for _ in layers)
+                )
+        return report
+
+    def read_occluders(self, filepath, fingerprint=None):
+        """Return the occluders of an occluders.xml file.
+
+        Every version of the file is parsed once per session, so watch mode
+        only parses the sidecars that changed.
+
+        Args:
+            filepath (str): Path of the occluders.xml file.
+            fingerprint (tuple|None): (mtime_ns, size) of the file, if
+                already known from a scan.
+
+        Returns:
+            list[Occluder]: The occluders in file order.
+
+        """
+        if fingerprint is None:
+            fingerprint = _stat_source(filepath)
+        cached = self.occluder_cache.get(filepath)
+        if cached is None or cached[0] != fingerprint:
+            cached = (fingerprint, Occluder.read_xml(filepath))
+            self.occluder_cache[filepath] = cached
+        return list(cached[1])
+
+    def save_all_sidecar_files(self):
+        """Saves JSON and XML sidecar files for all maps
+
+        Returns:
+            tuple[int, int]: The number of sidecar files written and the
+            number left alone because they were already up to date.
+
+        """
+        written = skipped = 0
+        for map in self.maps.values():
+            map_written, map_skipped = map.save_sidecar_files()
+            written += map_written
+            skipped += map_skipped
+        return written, skipped
+
+    def set_campaign_defaults(self, campaign_dir):
+        """Read the campaign default settings json."""
+        json_settings = os.path.join(campaign_dir, 'settings.json')
+        with open(json_settings, 'r') as f:
+            logger.info("Reading campaign defaults from %s", json_settings)
+            self.campaign_defaults = json.load(f)
+
+    def set_missing_ids(self, id_range=None):
+        """Sets ids for all maps to unused ID values
+
+        Maps are visited in name order, so the same library always gets the
+        same IDs. A map whose ID is already taken by another map is given a
+        new one.
+
+        Args:
+            id_range (tuple[int, int]|None): Inclusive range to allocate new
+                IDs from. Defaults to any positive ID.
+
+        """
+        database = None
+        if self.maps:
+            database = next(iter(self.maps.values())).campaign_db
+        map_ids = self._allocate_ids(
+            {map.name: map.id for map in self.maps.values()}, id_range,
+            database
+        )
+        for map in self.maps.values():
+            map._id = map_ids[map.name]
+
+    def set_runtime_defaults(self, defaults):
+        """Set the default dictionary to the given values."""
+        self.runtime_defaults = defaults
+
+    def stream_maps(
+            self, directory, database, spool, respect_db=True, manifest=None,
+            jobs=1, id_range=None, overwrite=False, check='exists',
+            link_mode='copy', save_sidecars=True,
+            batch_size=STREAM_BATCH_SIZE
+    ):
+        """Build, copy and serialize the maps of a library batch by batch.
+
+        IDs are allocated and images optimized for the whole library up
+        front, from the directory scans. Then every batch of maps is built,
+        its images are copied, its sidecar files written and its image
+        entries added to the spool. The maps are released before the next
+        batch is built, so memory use does not grow with the library. Save
+        the DB with CampaignDB.save_streamed once all batches are done.
+
+        Args:
+            directory (str): The root map directory.
+            database (CampaignDB): The campaign database.
+            spool (MapSpool): Receives the image entries of all maps.
+            respect_db (bool): Use existing settings from the DB.
+            manifest (IngestManifest|None): See build_maps.
+            jobs (int): Maximum number of concurrent operations of a kind.
+            id_range (tuple[int, int]|None): See set_missing_ids.
+            overwrite (bool): Copy every layer, even if up to date.
+            check (str): One of COPY_CHECKS, see Map.pending_copies.
+            link_mode (str): One of LINK_MODES.
+            save_sidecars (bool): Write the JSON and XML sidecar files.
+            batch_size (int): Number of maps to hold at once. Families of
+                parent and child maps are never split.
+
+        Yields:
+            tuple[CopyReport, int, int]: For every batch, while its maps are
+            in maps, the outcome of its copies and the number of sidecar
+            files written and already up to date.
+
+        """
+        pending, parents = self._pending_scans(
+            directory, database, respect_db, manifest, jobs
+        )
+        map_ids = self._allocate_ids(
+            self._current_ids(pending, database, respect_db), id_range,
+            database
+        )
+        if self.image_optimizer is not None:
+            self.image_optimizer.optimize(
+                [
+                    os.path.join(dir_name, filename)
+                    for scan in pending.values()
+                    for dir_name, filename in scan.gridless
+                ],
+                jobs
+            )
+
+        for batch in self._family_batches(pending, parents, batch_size):
+            for map_name in batch:
+                self._build_pending(
+                    map_name, pending, parents, database, respect_db, map_ids
+                )
+            report = self._copy_layers(
+                self.maps.values(), overwrite, jobs, check, link_mode
+            )
+            written = skipped = 0
+            if save_sidecars:
+                written, skipped = self.save_all_sidecar_files()
+            for map in self.maps.values():
+                spool.add(map)
+            yield report, written, skipped
+
+            for map in self.maps.values():
+                map.release()
+            self.maps.clear()
+            self.occluder_cache.clear()
+            for map_name in batch:
+                del pending[map_name]
+
+
+class Map(object):
+    """Representing one map."""
+
+    __slots__ = (
+        'name', 'source_directory', 'scan', 'session', 'campaign_db',
+        'layers', '_xml', '_id', '_parent_map', '_player_drawing', '_grid',
+        '_grid_size', '_grid_offset', '_grid_snap', '_brush_size',
+        '_detected_grid_size', '_occluders', '_json_sidecar_settings'
+    )
+
+    def __init__(
+            self, name, directory, campaign_db, map_id=None, parent_map=False,
+            player_drawing=None, grid=None, grid_size=None, grid_offset=None,
+            grid_snap=None, brush_size=None, occluders=None, scan=None,
+            session=None
+    ):
+
+        logger.debug("Initializing a Map object for %s", name)
+
+        self.name = name
+        self.source_directory = directory
+        self.scan = scan
+        self.session = session if session is not None else IngestSession()
+        self._xml = None
+
+        self._id = map_id
+        self._parent_map = False
+        self._player_drawing = player_drawing
+        self._grid = grid
+        self._grid_size = grid_size
+        self._grid_offset = grid_offset
+        self._grid_snap = grid_snap
+        self._brush_size = brush_size
+        self._detected_grid_size = False
+
+        if occluders:
+            self._occluders = occluders
+        else:
+            try:
+                if self.scan is not None and not self.scan.has_occluders:
+                    raise FileNotFoundError()
+                self._occluders = self._read_occluder_xml()
+            except FileNotFoundError:  # TODO: Add malformed XML exception
+                logger.debug("No XML Occluder file found for %s", self.name)
+                self._occluders = []
+
+        try:
+            if self.scan is not None and not self.scan.has_settings:
+                raise FileNotFoundError()
+            self._json_sidecar_settings = self._read_json_sidecar()
+        except (FileNotFoundError, JSONDecodeError):
+            logger.debug(
+                "None or malformed JSON sidecar file found for %s", self.name
+            )
+            self._json_sidecar_settings = {}
+
+        self.layers = self._generate_layers()
+        self.campaign_db = campaign_db
+
+        self.session.maps[self.name] = self
+
+    # Properties
+
+    @property
+    def brush_size(self):
+        if self._brush_size is None:
+            self._brush_size = self._find_best_default('brush_size')
+        return self._brush_size
+
+    @property
+    def detected_grid_size(self):
+        """Grid size derived from the image dimensions and filenames"""
+        if self._detected_grid_size is False:
+            self._detected_grid_size = None
+            for layer in self.image_layers:
+                grid_size = layer.detect_grid_size()
+                if grid_size:
+                    logger.debug(
+                        "Detected grid size %s for %s from %s",
+                        grid_size, self.name, layer.source_filename
+                    )
+                    self._detected_grid_size = grid_size
+                    break
+        return self._detected_grid_size
+
+    @property
+    def destination_dir(self):
+        return os.path.join(
+            self.campaign_db.campaign_dir,
+            'images',
+            self.name
+        )
+
+    @property
+    def grid(self):
+        if self._grid is None:
+            self._grid = self._find_best_default('grid')
+        return self._grid
+
+    @property
+    def grid_offset(self):
+        if self._grid_offset is None:
+            self._grid_offset = self._find_best_default('grid_offset')
+        return self._grid_offset
+
+    @property
+    def grid_size(self):
+        if self._grid_size is None:
+            self._grid_size = self._find_best_default('grid_size')
+        return self._grid_size
+
+    @property
+    def grid_snap(self):
+        if self._grid_snap is None:
+            self._grid_snap = self._find_best_default('grid_snap')
+        return self._grid_snap
+
+    @property
+    def id(self):
+        if self._id is None:
+            # Existing map ID for map does not exist in DB
+            if self.json_sidecar_settings.get('map_id') is None:
+                # Map ID also not set in JSON
+                return None
+            else:
+                self._id = self.json_sidecar_settings['map_id']
+        return self._id
+
+    @id.setter
+    def id(self, value):
+        if self._id is not None:
+            raise RuntimeError("Cannot set id on a Map which already has an id")
+        self._id = value
+
+    @property
+    def image_layers(self):
+        """Layers backed by an image file"""
+        return [layer for layer in self.layers if layer.source_filename]
+
+    @property
+    def image_optimizer(self):
+        return self.session.image_optimizer
+
+    @property
+    def image_size(self):
+        """Pixel dimensions of the first layer image that could be probed"""
+        for layer in self.image_layers:
+            if layer.dimensions:
+                return layer.dimensions
+        return None
+
+    @property
+    def in_archive(self):
+        """True if the map is read from a zip archive"""
+        return _archive_member(self.source_directory) is not None
+
+    @property
+    def json_sidecar_settings(self):
+        """Json overrides from JSON sidecar file"""
+        return self._json_sidecar_settings
+
+    @property
+    def json_filepath(self):
+        return os.path.join(self.source_directory, 'settings.json')
+
+    @property
+    def occluders(self):
+        if self.parent_map:
+            # Redirect occluders to parent map
+            return self.session.maps[self.parent_map].occluders
+        else:
+            return self._occluders
+
+    @property
+    def occluder_tolerance(self):
+        """Occluder simplification tolerance in pixels, 0 if disabled"""
+        if not self.session.occluder_tolerance or not self.grid_size:
+            return 0
+        return self.session.occluder_tolerance * min(self.grid_size)
+
+    @property
+    def occluder_xml_filepath(self):
+        return os.path.join(self.source_directory, 'occluders.xml')
+
+    @property
+    def parent_map(self):
+        if self._parent_map is False:
+            self._parent_map = self.json_sidecar_settings.get('parent_map')
+        return self._parent_map
+
+    @property
+    def player_drawing(self):
+        if self._player_drawing is None:
+            self._player_drawing = self._find_best_default('player_drawing')
+        return self._player_drawing
+
+    @property
+    def sidecar_filepaths(self):
+        """The sidecar files save_sidecar_files writes"""
+        if self.in_archive:
+            return []
+        if self.occluders:
+            return [self.json_filepath, self.occluder_xml_filepath]
+        return [self.json_filepath]
+
+    @property
+    def xml(self):
+        if self._xml is None:
+            self._xml = self._generate_xml()
+        return self._xml
+
+    # Private Methods
+
+    def _create_dir(self):
+        """Create the destination dir for this map"""
+        logger.debug(
+            "Creating directory %s for %s", self.destination_dir, self.name
+        )
         os.makedirs(self.destination_dir, exist_ok=True)
 
-    def _find_best_default(self, key):
-        """Find and return the highest priority default value for a key"""
-        if self.json_sidecar_settings.get(key):
-            return self.json_sidecar_settings[key]
-        elif self._campaign_defaults.get(key):
-            return self._campaign_defaults[key]
+    def _find_best_default(self, key):
+        """Find and return the highest priority default value for a key"""
+        if self.json_sidecar_settings.get(key):
+            return self.json_sidecar_settings[key]
+        elif self.session.campaign_defaults.get(key):
+            return self.session.campaign_defaults[key]
+        elif self.session.runtime_defaults.get(key) is not None:
+            return self.session.runtime_defaults[key]
+        elif key == 'grid_size':
+            if self.session.detect_grid_size and self.detected_grid_size:
+                return self.detected_grid_size
+            return (DEFAULT_GRID_SIZE, DEFAULT_GRID_SIZE)
+        elif key == 'brush_size':
+            return (self.grid_size[0] * 0.1, self.grid_size[1] * 0.1)
+        else:
+            return self.session.runtime_defaults[key]
+
+    def _generate_updated_json(self):
+        """Generates the updated JSON for this map"""
+        return {
+            'map_id': self.id,
+            'name': self.name,
+            'parent_map': self.parent_map,
+            'player_drawing': self.player_drawing,
+            'grid': self.grid,
+            'grid_size': self.grid_size,
+            'grid_offset': self.grid_offset,
+            'grid_snap': self.grid_snap,
+            'brush_size': self.brush_size,
+            'image_size': self.image_size
+        }
+
+    def _generate_layers(self):
+        """Creates the Layers for this map"""
+        layers = []
+        layer_id = 0
+        for dir_name, gridless in self._get_gridless():
+            rel_path = dir_name.replace(self.source_directory, '')
+            layer_name = ' - '.join(filter(None, rel_path.split(os.path.sep)))
+            layers.append(
+                Layer(
+                    layer_name, self, layer_id,
+                    os.path.join(dir_name, gridless)
+                )
+            )
+            layer_id += 1
+        for occluder in self.occluders:
+            layers.append(
+                Layer(
+                    None, self, layer_id, occluder=occluder
+                )
+            )
+        return layers
+
+    def _generate_xml(self):
+        """Generates the XML for this map"""
+        image_id_root = ET.Element('id-{:05d}'.format(self.id))
+        image_elem = ET.SubElement(image_id_root, 'image', type='image')
+        subelements = [
+            ('allowplayerdrawing', BOOLEAN_MAP_INVERSE[self.player_drawing]),
+            ('grid', BOOLEAN_MAP_INVERSE[self.grid]),
+            ('gridsize', self._to_xml_int_coord(self.grid_size)),
+            ('gridoffset', self._to_xml_int_coord(self.grid_offset)),
+            ('gridsnap', BOOLEAN_MAP_INVERSE[self.grid_snap]),
+            ('brushsize', self._to_xml_float_coord(self.brush_size))
+        ]
+        for name, text in subelements:
+            _ = ET.SubElement(image_elem, name)
+            _.text = text
+        layers = ET.SubElement(image_elem, 'layers')
+        for layer in self.layers:
+            # We want the layer list to be inversed
+            layers.insert(0, layer.xml)
+        locked = ET.SubElement(image_id_root, 'locked', type='number')
+        locked.text = '0'
+        name = ET.SubElement(image_id_root, 'name', type='string')
+        name.text = self.name
+        return image_id_root
+
+    def _get_gridless(self):
+        """Return a list of gridless files in subdirectories
+
+        Returns:
+            str, str: Returns the directory name and the filename of the
+            gridless jpeg image.
+
+        """
+        scan = self.scan
+        if scan is None and self.in_archive:
+            scan = MapScan(self.name, self.source_directory).scan()
+        if scan is not None:
+            for dir_name, filename in scan.gridless:
+                yield dir_name, filename
+            return
+
+        found = {}
+        for dir_name, _, file_list in os.walk(self.source_directory):
+            for filename in file_list:
+                if filename.lower().endswith(GRIDLESS_SUFFIX):
+                    if dir_name in found:
+                        raise _conflicting_gridless_error(
+                            dir_name, found[dir_name], filename
+                        )
+                    found[dir_name] = filename
+                    yield dir_name, filename
+
+    def _to_xml_float_coord(self, value):
+        """Takes a (x, y) tuple with floats and returns a 'x,y' string."""
+        float_values = (float(_) for _ in value)
+        return '{:.4},{:.4}'.format(*float_values)
+
+    def _to_xml_int_coord(self, value):
+        """Takes a (x, y) tuple with ints and returns a 'x,y' string."""
+        float_values = (int(_) for _ in value)
+        return '{},{}'.format(*float_values)
+
+    def _read_json_sidecar(self):
+        """Read and return the contents of the JSON sidecar file for this map"""
+        with _open_source(self.json_filepath) as f:
+            return json.load(f)
+
+    def _read_occluder_xml(self):
+        """Read and return the occluders from the XML sidecar file"""
+        fingerprint = None
+        if self.scan is not None:
+            fingerprint = self.scan.stats.get('occluders.xml')
+        return self.session.read_occluders(
+            self.occluder_xml_filepath, fingerprint
+        )
+
+    def _render_json_settings(self):
+        """Return the text save_json_settings writes"""
+        return json.dumps(
+            self._generate_updated_json(), indent=4, separators=(',', ': ')
+        )
+
+    def _render_occluders(self):
+        """Return the text save_occluders writes"""
+        xml_root = ET.Element('saved-occluders')
+        for occluder in self.occluders:
+            xml_root.append(occluder.to_element())
+        xml = io.StringIO()
+        _write_pretty_xml(xml_root, xml)
+        return xml.getvalue()
+
+    # Public Methods
+
+    def pending_copies(self, overwrite=False, check='exists', touches=None):
+        """Return the (source, destination) pairs of layers to be copied
+
+        Args:
+            overwrite (bool): Return every layer, even if up to date.
+            check (str): How to decide if a copied layer is up to date.
+                'exists' only checks that it is there, 'stat' compares size
+                and mtime and 'hash' also compares the content of files whose
+                size matches but whose mtime does not.
+            touches (list|None): See _needs_copy.
+
+        """
+        planned = {}
+        if self.image_optimizer is not None:
+            planned = self.image_optimizer.planned
+        copies = []
+        for layer in self.image_layers:
+            source = layer.copy_source
+            if source is None:
+                continue  # Optimizing the layer failed
+            if (
+                overwrite or layer.source_filename in planned or
+                _needs_copy(
+                    source, layer.destination_filename, check, touches
+                )
+            ):
+                copies.append((source, layer.destination_filename))
+        return copies
+
+    def release(self):
+        """Drop the layers and the cached XML.
+
+        Layers refer back to their map, so without this a map is only freed
+        by the cyclic garbage collector, long after it was dropped.
+
+        """
+        self.layers = []
+        self._xml = None
+
+    def changed_sidecar_filepaths(self):
+        """Return the sidecar files save_sidecar_files would change"""
+        if self.in_archive:
+            return []
+        texts = [(self.json_filepath, self._render_json_settings())]
+        if self.occluders:
+            texts.append(
+                (self.occluder_xml_filepath, self._render_occluders())
+            )
+        return [
+            filepath for filepath, text in texts
+            if _text_differs(filepath, text)
+        ]
+
+    def save_json_settings(self):
+        """Saves the JSON settings to a JSON file in the base map dir.
+
+        Returns:
+            bool: False if the file was already up to date.
+
+        """
+        text = self._render_json_settings()
+        if not _write_text_if_changed(self.json_filepath, text):
+            logger.debug("JSON settings for %s are up to date", self.name)
+            return False
+        logger.debug(
+            "Saved JSON settings for %s to %s",
+            self.name, self.json_filepath
+        )
+        return True
+
+    def save_occluders(self):
+        """Saves the occluders XML to an XML file in the base map dir.
+
+        Returns:
+            bool: False if there are no occluders or the file was already up
+            to date.
+
+        """
+        if not self.occluders:
+            logger.debug("No occluders to save for %s", self.name)
+            return False
+
+        written = _write_text_if_changed(
+            self.occluder_xml_filepath, self._render_occluders()
+        )
+        if written:
+            logger.debug(
+                "Saved XML occluders for %s to %s",
+                self.name, self.occluder_xml_filepath
+            )
+        else:
+            logger.debug("XML occluders for %s are up to date", self.name)
+        # What is on disk is what is held, no need to parse it again
+        stat = os.stat(self.occluder_xml_filepath)
+        self.session.occluder_cache[self.occluder_xml_filepath] = (
+            (stat.st_mtime_ns, stat.st_size), list(self.occluders)
+        )
+        return written
+
+    def save_sidecar_files(self):
+        """Save JSON and XML sidecar files for this map
+
+        Files whose content would not change are not touched, so their
+        mtimes stay put for backup and sync tools. Nothing is written for
+        maps read from a zip archive.
+
+        Returns:
+            tuple[int, int]: The number of sidecar files written and the
+            number left alone because they were already up to date.
+
+        """
+        if self.in_archive:
+            logger.debug(
+                "Not saving sidecar files for %s, it is in an archive",
+                self.name
+            )
+            return 0, 0
+        results = [self.save_json_settings()]
+        if self.occluders:
+            results.append(self.save_occluders())
+        written = sum(results)
+        return written, len(results) - written
+
+
+class Layer(object):
+    """Representing a layer of a map."""
+
+    __slots__ = (
+        'name', 'id', 'map', 'source_filename', 'occluder', '_dimensions',
+        '_embedded_occluder', '_xml'
+    )
+
+    def __init__(self, name, map, layer_id, filename=None, occluder=None):
+
+        logger.debug("Instantiating layer %s - %s", map.name, name)
+
+        self.name = name
+        self.id = layer_id
+        self.map = map
+        self.source_filename = filename
+        self.occluder = occluder
+        self._dimensions = False
+        self._embedded_occluder = None
+        self._xml = None
+
+    # Properties
+
+    @property
+    def copy_source(self):
+        """File placed in the campaign dir, the optimized image if enabled"""
+        optimizer = self.map.image_optimizer
+        if optimizer is None:
+            return self.source_filename
+        return (
+            optimizer.outputs.get(self.source_filename) or
+            optimizer.planned.get(self.source_filename)
+        )
+
+    @property
+    def destination_filename(self):
+        return os.path.join(
+            self.map.destination_dir, '{name}{ext}'.format(
+                name=self.name,
+                ext=self.extension
+            )
+        )
+
+    @property
+    def dimensions(self):
+        """Pixel (width, height) of the layer image, read from its header"""
+        if self._dimensions is False:
+            self._dimensions = None
+            if self.source_filename:
+                try:
+                    self._dimensions = _probe_image_size(self.source_filename)
+                except OSError as e:
+                    logger.warning(
+                        "Could not probe %s: %s", self.source_filename, e
+                    )
+            optimizer = self.map.image_optimizer
+            if self._dimensions and optimizer is not None:
+                self._dimensions = optimizer.output_size(self._dimensions)
+        return self._dimensions
+
+    @property
+    def embedded_occluder(self):
+        """The occluder as embedded in db.xml, simplified if enabled"""
+        if self._embedded_occluder is None and self.occluder:
+            tolerance = self.map.occluder_tolerance
+            if tolerance:
+                self._embedded_occluder = self.occluder.simplified(tolerance)
+            else:
+                self._embedded_occluder = self.occluder
+        return self._embedded_occluder
+
+    @property
+    def embed_filename(self):
+        """Filename suitable for embeddng in the XML"""
+        return "{prefix}/{map_name}/{layer_name}{ext}".format(
+            prefix=self.map.session.embed_prefix,
+            map_name=self.map.name,
+            layer_name=self.name,
+            ext=self.extension
+        )
+
+    @property
+    def extension(self):
+        if self.map.image_optimizer is not None:
+            return self.map.image_optimizer.extension
+        return os.path.splitext(self.source_filename)[-1]
+
+    @property
+    def xml(self):
+        if self._xml is None:
+            self._xml = self._generate_xml()
+        return self._xml
+
+    # Private Methods
+
+    def _generate_xml(self):
+        """Generates the XML for this Layer"""
+        layer = ET.Element('layer')
+        if self.name:
+            name = ET.SubElement(layer, 'name')
+            name.text = self.name
+        layer_id = ET.SubElement(layer, 'id')
+        layer_id.text = str(self.id)
+        layer_type = ET.SubElement(layer, 'type')
+        layer_type.text = 'image'
+        bitmap = ET.SubElement(layer, 'bitmap')
+        if self.source_filename:
+            bitmap.text = self.embed_filename
+        if self.occluder:
+            occluders = ET.SubElement(layer, 'occluders')
+            occluders.append(self.embedded_occluder.to_element())
+        return layer
+
+    # Public Methods
+
+    def detect_grid_size(self):
+        """Derive the grid size from the image size and naming conventions.
+
+        The image filename, the directories between the map directory and
+        the image, and the map name are searched in that order for either a
+        grid square size in pixels ('140px') or the map size in grid squares
+        ('30x20').
+
+        Returns:
+            tuple[int, int]|None: The grid size, or None if it could not be
+            derived.
+
+        """
+        if not self.source_filename:
+            return None
+        dir_name, filename = os.path.split(self.source_filename)
+        rel_dir = os.path.relpath(dir_name, self.map.source_directory)
+        names = [filename[:-len(GRIDLESS_SUFFIX)]]
+        names.extend(reversed(rel_dir.split(os.path.sep)))
+        names.append(self.map.name)
+        return _grid_size_from_names(names, self.dimensions)
+
+
+class Occluder(object):
+    """A line of sight occluder, kept compact between reading and writing.
+
+    The points are kept as the text they were read from and are only parsed
+    into an array of floats when accessed, so an occluder with thousands of
+    points costs a couple of strings instead of an element tree, and is
+    written back exactly as it was read. Children other than the ID and the
+    points, such as flags, are rare and kept as elements.
+
+    """
+
+    __slots__ = ('occluder_id', 'children', '_points', '_points_text')
+
+    def __init__(self, occluder_id, points, children=('id', 'points')):
+        """
+        Args:
+            occluder_id (str|None): Text of the id element.
+            points (str|array): Comma separated points, or an array of
+                x, y floats.
+            children (tuple): Order of the children. 'id' and 'points' stand
+                in for those elements, any other child is an Element.
+
+        """
+        self.occluder_id = occluder_id
+        self.children = children
+        if isinstance(points, str):
+            self._points = None
+            self._points_text = points
+        else:
+            self._points = points
+            self._points_text = None
+
+    # Properties
+
+    @property
+    def points(self):
+        """The x, y coordinates as a flat array of floats"""
+        if self._points is None:
+            self._points = array('d', (
+                float(value) for value in self._points_text.split(',')
+                if value.strip()
+            ))
+        return self._points
+
+    @points.setter
+    def points(self, value):
+        self._points = array('d', value)
+        self._points_text = None
+
+    @property
+    def points_text(self):
+        if self._points_text is None:
+            self._points_text = ','.join(
+                _format_coord(value) for value in self._points
+            )
+        return self._points_text
+
+    # Public Methods
+
+    @classmethod
+    def from_element(cls, element):
+        """Create an Occluder from an occluder element"""
+        occluder_id = None
+        points = ''
+        children = []
+        for child in element:
+            if child.tag == 'id' and 'id' not in children:
+                occluder_id = child.text
+                children.append('id')
+            elif child.tag == 'points' and 'points' not in children:
+                points = child.text or ''
+                children.append('points')
+            else:
+                children.append(child)
+        return cls(occluder_id, points, tuple(children))
+
+    @classmethod
+    def from_elements(cls, elements):
+        """Create Occluders from occluder elements.
+
+        Earlier versions wrapped the occluders of a layer in an extra
+        occluders element, in db.xml and in the sidecar file. Such legacy
+        containers are unwrapped into the occluders they hold.
+
+        Args:
+            elements (iterable[Element]): The occluder elements.
+
+        Returns:
+            list[Occluder]: The occluders in document order.
+
+        """
+        occluders = []
+        for element in elements:
+            if element.tag == 'occluders':
+                occluders.extend(cls.from_elements(element))
+            else:
+                occluders.append(cls.from_element(element))
+        return occluders
+
+    @classmethod
+    def read_xml(cls, filepath):
+        """Read the occluders of an occluders.xml sidecar file.
+
+        The file is parsed incrementally and every occluder element is
+        discarded once converted, so the whole tree is never held.
+
+        Returns:
+            list[Occluder]: The occluders in file order.
+
+        """
+        occluders = []
+        depth = 0
+        root = None
+        with _open_source(filepath) as f:
+            for event, element in ET.iterparse(f, ('start', 'end')):
+                if event == 'start':
+                    if root is None:
+                        root = element
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth == 1:
+                    occluders.extend(cls.from_elements([element]))
+                    root.clear()
+        return occluders
+
+    def simplified(self, tolerance):
+        """Return the occluder simplified with Douglas-Peucker.
+
+        Simplifying is deterministic, and simplifying a simplified occluder
+        with the same tolerance keeps all of its points, so repeated
+        ingests do not change db.xml.
+
+        Args:
+            tolerance (float): Largest distance in pixels a removed point
+                may have from the simplified outline.
+
+        Returns:
+            Occluder: A new occluder, or this one if no point was removed.
+
+        """
+        points = self.points
+        if len(points) % 2 or len(points) < 6:
+            return self
+        xy = np.frombuffer(points, dtype=np.float64).reshape(-1, 2)
+        keep = _douglas_peucker(xy, tolerance)
+        # A closed outline needs three corners, an open one two ends
+        minimum = 4 if (xy[0] == xy[-1]).all() else 2
+        if len(keep) == len(xy) or len(keep) < minimum:
+            return self
+        return Occluder(
+            self.occluder_id, array('d', xy[keep].ravel()), self.children
+        )
+
+    def to_element(self):
+        """Build the occluder element for db.xml or the sidecar file"""
+        element = ET.Element('occluder')
+        for child in self.children:
+            if child == 'id':
+                ET.SubElement(element, 'id').text = self.occluder_id
+            elif child == 'points':
+                ET.SubElement(element, 'points').text = self.points_text
+            else:
+                element.append(child)
+        return element
+
+
+class CopyReport(object):
+    """Outcome of copying a batch of files."""
+
+    def __init__(self):
+        self.copied = []  # Destination filenames
+        self.linked = []  # Destination filenames hardlinked or reflinked
+        self.failures = {}  # Source filename to exception
+        self.skipped = 0
+        self.bytes_copied = 0
+        self.elapsed = 0.0
+
+    # Properties
+
+    @property
+    def throughput(self):
+        """Bytes copied per second"""
+        if not self.elapsed:
+            return 0.0
+        return self.bytes_copied / self.elapsed
+
+    # Public Methods
+
+    def log_summary(self):
+        """Log the aggregate result and every failure"""
+        logger.info(
+            "Copied %d files (%.1f MB, %d linked, %d up to date) in %.2fs, "
+            "%.1f MB/s",
+            len(self.copied), self.bytes_copied / 1024 ** 2, len(self.linked),
+            self.skipped, self.elapsed, self.throughput / 1024 ** 2
+        )
+        for filename, error in sorted(self.failures.items()):
+            logger.error("Failed to copy %s: %s", filename, error)
+
+    def update(self, other):
+        """Add the outcome of another batch of files"""
+        self.copied.extend(other.copied)
+        self.linked.extend(other.linked)
+        self.failures.update(other.failures)
+        self.skipped += other.skipped
+        self.bytes_copied += other.bytes_copied
+        self.elapsed += other.elapsed
+
+
+class ImageOptimizer(object):
+    """Re-encodes and downscales layer images before they are copied.
+
+    Images are transcoded on a process pool into a cache directory in the
+    campaign dir. Cached images are named after the digest of the source
+    content and the optimization options, so every layer is only processed
+    once, even if it is renamed or shared between maps. The source digests
+    are kept in an index and reused while a source's mtime and size are
+    unchanged.
+
+    """
+
+    def __init__(
+            self, campaign_dir, image_format='jpeg', max_dimension=0,
+            quality=85
+    ):
+
+        logger.info("Initializing ImageOptimizer object for %s", campaign_dir)
+
+        if Image is None:
+            raise RuntimeError("Optimizing images requires Pillow")
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError("Unknown image format {}".format(image_format))
+
+        self.cache_dir = os.path.join(campaign_dir, OPTIMIZE_CACHE_DIR)
+        self.image_format = image_format
+        self.max_dimension = max_dimension
+        self.quality = quality
+        self.index = {}  # Source filename to [mtime_ns, size, digest]
+        self.outputs = {}  # Source filename to optimized filename
+        self.planned = {}  # Source filename to not yet optimized filename
+        self.failures = {}  # Source filename to exception
+        self.transcoded = 0
+
+        try:
+            with open(self.index_filepath, 'r') as f:
+                self.index = json.load(f)
+        except (FileNotFoundError, JSONDecodeError):
+            logger.debug("No optimized image index found")
+
+    # Properties
+
+    @property
+    def extension(self):
+        return IMAGE_FORMATS[self.image_format]
+
+    @property
+    def index_filepath(self):
+        return os.path.join(self.cache_dir, 'index.json')
+
+    @property
+    def options(self):
+        return {
+            'format': self.image_format,
+            'max_dimension': self.max_dimension,
+            'quality': self.quality
+        }
+
+    # Private Methods
+
+    def _cache_filename(self, source):
+        """Return the cached output filename for a source image"""
+        fingerprint = list(_stat_source(source))
+        recorded = self.index.get(source)
+        if recorded and recorded[:2] == fingerprint:
+            digest = recorded[2]
+        else:
+            digest = _file_digest(source)
+            self.index[source] = fingerprint + [digest]
+        key = hashlib.sha1(
+            json.dumps([digest, self.options], sort_keys=True).encode('utf-8')
+        ).hexdigest()
+        return os.path.join(self.cache_dir, key + self.extension)
+
+    # Public Methods
+
+    def optimize(self, sources, jobs=1):
+        """Optimize every source image that is not in the cache yet.
+
+        Args:
+            sources (list[str]): Source image filenames.
+            jobs (int): Maximum number of concurrent transcodes.
+
+        """
+        self.transcode(self.plan(sources), jobs)
+
+    def output_size(self, dimensions):
+        """Return the pixel size of the optimized version of an image"""
+        return _scaled_size(dimensions, self.max_dimension)
+
+    def plan(self, sources):
+        """Find the source images that are not in the cache yet.
+
+        Cached images are added to outputs, the others to planned. Only
+        sources that are new or changed since the last run are hashed.
+
+        Args:
+            sources (list[str]): Source image filenames.
+
+        Returns:
+            dict[str, str]: Source filename to optimized filename, for every
+            image that has to be transcoded.
+
+        """
+        pending = {}
+        for source in sources:
+            if (
+                source in self.outputs or source in self.planned or
+                source in self.failures
+            ):
+                continue
+            try:
+                output = self._cache_filename(source)
+            except OSError as err:
+                self.failures[source] = err
+                continue
+            if os.path.exists(output):
+                self.outputs[source] = output
+            else:
+                pending[source] = output
+        self.planned.update(pending)
+        return pending
+
+    def save_index(self):
+        """Atomically write the source digest index"""
+        temp_filepath = self.index_filepath + '.tmp'
+        with open(temp_filepath, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(temp_filepath, self.index_filepath)
+
+    def transcode(self, pending, jobs=1):
+        """Transcode images on a pool of processes.
+
+        Sources with the same content share an output and are transcoded
+        only once.
+
+        Args:
+            pending (dict[str, str]): Source filename to optimized filename,
+                as returned by plan.
+            jobs (int): Maximum number of concurrent transcodes.
+
+        """
+        start = time.perf_counter()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        sources_by_output = {}
+        for source, output in pending.items():
+            sources_by_output.setdefault(output, []).append(source)
+        if sources_by_output:
+            with ProcessPoolExecutor(max_workers=max(1, jobs)) as executor:
+                futures = [
+                    (output, executor.submit(
+                        _transcode_image, sources[0], output,
+                        self.image_format, self.max_dimension, self.quality
+                    ))
+                    for output, sources in sources_by_output.items()
+                ]
+                for output, future in futures:
+                    sources = sources_by_output[output]
+                    try:
+                        future.result()
+                    except (OSError, KeyError, ValueError) as err:
+                        for source in sources:
+                            self.failures[source] = err
+                    else:
+                        for source in sources:
+                            self.outputs[source] = output
+                        self.transcoded += 1
+        for source in pending:
+            self.planned.pop(source, None)
+
+        logger.info(
+            "Optimized %d images (%d reused, %d failed) in %.2fs",
+            self.transcoded, len(self.outputs) - self.transcoded,
+            len(self.failures), time.perf_counter() - start
+        )
+        self.save_index()
+
+
+class IngestPlan(object):
+    """Every operation an ingest will perform, computed up front.
+
+    Planning only stats files and compares the generated map entries with
+    the ones in db.xml, nothing is written. The plan can be printed as a
+    diff, saved as JSON and executed. As all operations are known before
+    any of them runs, independent ones run concurrently: the DB and sidecar
+    writes overlap with transcoding and copying the images.
+
+    """
+
+    def __init__(self):
+        self.transcodes = {}  # Source filename to optimized filename
+        self.copies = []  # (source, destination) pairs
+        self.skipped_copies = 0  # Layers already up to date
+        self.touches = []  # (destination, mtime_ns) pairs of same content
+        self.sidecars = []  # Sidecar filenames whose content changes
+        self.skipped_sidecars = 0  # Sidecar files already up to date
+        self.db_added = []  # (name, map_id) pairs
+        self.db_changed = []
+        self.db_removed = []
+        self.unchanged_maps = []  # Names of maps not rebuilt
+
+    # Properties
+
+    @property
+    def db_changes(self):
+        """Whether db.xml has to be rewritten"""
+        return bool(self.db_added or self.db_changed or self.db_removed)
+
+    # Private Methods
+
+    @staticmethod
+    def _save_sidecars(map):
+        """Save the sidecar files of a map and note when it finished"""
+        written, skipped = map.save_sidecar_files()
+        return written, skipped, time.perf_counter()
+
+    @staticmethod
+    def _write_db(database, maps, keep, splice, stats):
+        """Update and save the database"""
+        with stats.phase('update_db'):
+            database.update_db(maps, keep=keep)
+        with stats.phase('save_db'):
+            database.save_db(splice=splice)
+
+    # Public Methods
+
+    @classmethod
+    def build(
+            cls, session, database, overwrite=False, check='exists',
+            save_sidecars=True
+    ):
+        """Plan the ingest of the maps built by a session.
+
+        Args:
+            session (IngestSession): The session, with map IDs set. Its
+                unchanged maps keep their DB entries as they are.
+            database (CampaignDB): The campaign database.
+            overwrite (bool): Copy every layer, even if up to date.
+            check (str): One of COPY_CHECKS, see Map.pending_copies.
+            save_sidecars (bool): Write the JSON and XML sidecar files.
+
+        Returns:
+            IngestPlan: The plan.
+
+        """
+        maps = session.maps
+        plan = cls()
+        plan.unchanged_maps = sorted(session.unchanged_maps)
+
+        if session.image_optimizer is not None:
+            plan.transcodes = session.image_optimizer.plan(
+                [
+                    layer.source_filename
+                    for map in maps.values()
+                    for layer in map.image_layers
+                ]
+            )
+
+        for map in maps.values():
+            copies = map.pending_copies(
+                overwrite=overwrite, check=check, touches=plan.touches
+            )
+            plan.copies.extend(copies)
+            plan.skipped_copies += len(map.image_layers) - len(copies)
+            if save_sidecars:
+                changed = map.changed_sidecar_filepaths()
+                plan.sidecars.extend(changed)
+                plan.skipped_sidecars += (
+                    len(map.sidecar_filepaths) - len(changed)
+                )
+
+            xml = map.xml
+            existing = database.map_element(map.name)
+            if existing is None:
+                plan.db_added.append((map.name, map.id))
+            elif (
+                existing.tag != xml.tag or
+                _element_digest(existing) != _element_digest(xml)
+            ):
+                plan.db_changed.append((map.name, map.id))
+
+        for name in database.maps:
+            if name not in maps and name not in plan.unchanged_maps:
+                plan.db_removed.append(
+                    (name, database.maps[name].map_id)
+                )
+        return plan
+
+    def execute(
+            self, session, database, jobs=1, link_mode='copy', splice=True,
+            stats=None
+    ):
+        """Run the plan.
+
+        Args:
+            session (IngestSession): The session the plan was built for.
+            database (CampaignDB): The campaign database.
+            jobs (int): Maximum number of concurrent operations of a kind.
+            link_mode (str): One of LINK_MODES.
+            splice (bool): See CampaignDB.save_db.
+            stats (IngestStats|None): Receives the wall time of the
+                optimize, copy_maps, save_sidecars, update_db and save_db
+                steps. The steps overlap, so together they take longer than
+                the whole.
+
+        Returns:
+            tuple[CopyReport, int, int]: The outcome of the copies, the
+            number of sidecar files written and the number of sidecar files
+            that were already up to date.
+
+        """
+        maps = session.maps
+        optimizer = session.image_optimizer
+        sidecars = set(self.sidecars)
+        if stats is None:
+            stats = IngestStats()  # Discarded
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            db_future = None
+            if self.db_changes:
+                db_future = executor.submit(
+                    self._write_db, database, maps.values(),
+                    self.unchanged_maps, splice, stats
+                )
+            sidecar_start = time.perf_counter()
+            sidecar_futures = [
+                executor.submit(self._save_sidecars, map)
+                for map in maps.values()
+                if sidecars.intersection(map.sidecar_filepaths)
+            ]
+
+            failed = set()
+            if self.transcodes:
+                with stats.phase('optimize'):
+                    optimizer.transcode(self.transcodes, jobs)
+                failed = {
+                    output for source, output in self.transcodes.items()
+                    if source in optimizer.failures
+                }
+            copies = [_ for _ in self.copies if _[0] not in failed]
+            for dir_name in {os.path.dirname(_[1]) for _ in copies}:
+                os.makedirs(dir_name, exist_ok=True)
+            with stats.phase('copy_maps'):
+                report = _copy_files(copies, jobs, link_mode)
+                for destination, mtime_ns in self.touches:
+                    _align_mtime(destination, mtime_ns)
+            report.skipped = self.skipped_copies
+            if optimizer is not None:
+                report.failures.update(optimizer.failures)
+
+            sidecars_written, sidecars_skipped = 0, self.skipped_sidecars
+            sidecar_end = sidecar_start
+            for future in sidecar_futures:
+                written, skipped, end = future.result()
+                sidecars_written += written
+                sidecars_skipped += skipped
+                sidecar_end = max(sidecar_end, end)
+            if sidecar_futures:
+                stats.add_phase('save_sidecars', sidecar_end - sidecar_start)
+            if db_future is not None:
+                db_future.result()
+        return report, sidecars_written, sidecars_skipped
+
+    def format_diff(self):
+        """Return the plan as diff-like lines"""
+        lines = []
+        for prefix, entries in (
+                ('+', self.db_added), ('~', self.db_changed),
+                ('-', self.db_removed)
+        ):
+            for name, map_id in sorted(entries, key=lambda x: x[0]):
+                lines.append('{} db.xml image id-{:05d} {}'.format(
+                    prefix, map_id or 0, name
+                ))
+        for source, output in sorted(self.transcodes.items()):
+            lines.append('~ optimize {} -> {}'.format(source, output))
+        for source, destination in sorted(self.copies):
+            lines.append('+ copy {} -> {}'.format(source, destination))
+        for destination, _ in sorted(self.touches):
+            lines.append('~ touch {}'.format(destination))
+        for filepath in sorted(self.sidecars):
+            lines.append('~ write {}'.format(filepath))
+        lines.append(
+            '{} added, {} changed, {} removed, {} unchanged maps; {} '
+            'optimized, {} copied, {} up to date images; {} sidecars'.format(
+                len(self.db_added), len(self.db_changed),
+                len(self.db_removed), len(self.unchanged_maps),
+                len(self.transcodes), len(self.copies), self.skipped_copies,
+                len(self.sidecars)
+            )
+        )
+        return '\n'.join(lines)
+
+    def save(self, filepath):
+        """Atomically write the plan to a JSON file"""
+        logger.debug("Saving ingest plan to %s", filepath)
+        temp_filepath = filepath + '.tmp'
+        with open(temp_filepath, 'w') as f:
+            json.dump(self.to_dict(), f, indent=4, separators=(',', ': '))
+        os.replace(temp_filepath, filepath)
+
+    def to_dict(self):
+        """Return the plan as a JSON serializable dict"""
+        return {
+            'transcodes': self.transcodes,
+            'copies': self.copies,
+            'skipped_copies': self.skipped_copies,
+            'touches': self.touches,
+            'sidecars': self.sidecars,
+            'skipped_sidecars': self.skipped_sidecars,
+            'db': {
+                'added': self.db_added,
+                'changed': self.db_changed,
+                'removed': self.db_removed
+            },
+            'unchanged_maps': self.unchanged_maps
+        }
+
+
+class IngestPipeline(object):
+    """Ingest that moves every map through the stages on its own.
+
+    A map is built, reading its sidecar files, as soon as its directory is
+    scanned, and its images are optimized and copied as soon as it is
+    built. Once every directory is scanned the set of maps is known and
+    IDs are allocated, after which the sidecar files of the maps are
+    written and, once all maps are built, the DB is saved while images are
+    still being copied.
+
+    Every stage has its own concurrency limit. Blocking work runs on a
+    shared thread pool, transcoding on a process pool of 'optimize'
+    workers.
+
+    """
+
+    def __init__(
+            self, session, directory, database, respect_db=True,
+            manifest=None, id_range=None, overwrite=False, check='exists',
+            link_mode='copy', save_sidecars=True, splice=True,
+            stage_jobs=None
+    ):
+        """
+        Args:
+            session (IngestSession): The session to build the maps in.
+            directory (str): The root map directory.
+            database (CampaignDB): The campaign database.
+            respect_db (bool): Use existing settings from the DB.
+            manifest (IngestManifest|None): See IngestSession.build_maps.
+            id_range (tuple[int, int]|None): See set_missing_ids.
+            overwrite (bool): Copy every layer, even if up to date.
+            check (str): One of COPY_CHECKS, see Map.pending_copies.
+            link_mode (str): One of LINK_MODES.
+            save_sidecars (bool): Write the JSON and XML sidecar files.
+            splice (bool): See CampaignDB.save_db.
+            stage_jobs (dict[str, int]|None): Concurrency limit of each of
+                PIPELINE_STAGES. Defaults to 1.
+
+        """
+        self.session = session
+        self.directory = directory
+        self.database = database
+        self.respect_db = respect_db
+        self.manifest = manifest
+        self.id_range = id_range
+        self.overwrite = overwrite
+        self.check = check
+        self.link_mode = link_mode
+        self.save_sidecars = save_sidecars
+        self.splice = splice
+        self.stage_jobs = dict.fromkeys(PIPELINE_STAGES, 1)
+        self.stage_jobs.update(stage_jobs or {})
+
+        self.report = CopyReport()
+        self.sidecars_written = 0
+        self.sidecars_skipped = 0
+
+        self._loop = None
+        self._limits = {}
+        self._threads = None
+        self._processes = None
+        self._optimizer_lock = None
+        self._scanned = None  # Set once every map directory is scanned
+        self._library = {}  # Map name to map directory
+        self._scans = {}
+        self._parents = {}  # Map name to the parent named in its sidecar
+        self._pending = set()  # Names of the maps to build
+        self._wanted_parents = set()  # Parents of the maps to build
+        self._built = {}  # Map name to a future of its Map
+        self._map_ids = None
+        self._tasks = []
+        self._transcodes = {}  # Optimized filename to its transcode
+
+    # Private Methods
+
+    def _built_future(self, map_name):
+        if map_name not in self._built:
+            self._built[map_name] = self._loop.create_future()
+        return self._built[map_name]
+
+    async def _build(self, map_name):
+        """Build a map once its parent is built"""
+        future = self._built_future(map_name)
+        try:
+            parent = self._parent_to_wait_for(map_name)
+            if parent is not None and parent not in self._scans:
+                await self._scanned.wait()
+                parent = self._parent_to_wait_for(map_name)
+            if parent in self._pending:
+                await self._built_future(parent)
+            scan = self._scans[map_name]
+            map = await self._call(
+                'build', self.session._build_map, map_name, scan.directory,
+                self.database, self.respect_db, scan
+            )
+        except Exception as err:
+            future.set_exception(err)
+            raise
+        future.set_result(map)
+        self._tasks.append(self._loop.create_task(self._copy(map)))
+
+    async def _call(self, stage, func, *args):
+        """Run a blocking function on the thread pool, within a stage limit"""
+        async with self._limits[stage]:
+            return await self._loop.run_in_executor(self._threads, func, *args)
+
+    async def _copy(self, map):
+        """Optimize and copy the images of a map"""
+        optimizer = self.session.image_optimizer
+        if optimizer is not None:
+            async with self._optimizer_lock:
+                planned = await self._call(
+                    'optimize', optimizer.plan,
+                    [layer.source_filename for layer in map.image_layers]
+                )
+            await asyncio.gather(*(
+                self._transcode(source, output)
+                for source, output in planned.items()
+            ))
+
+        await self._call('copy', map._create_dir)
+        copies = await self._call(
+            'copy', map.pending_copies, self.overwrite, self.check
+        )
+        failed = 0
+        if optimizer is not None:
+            for layer in map.image_layers:
+                error = optimizer.failures.get(layer.source_filename)
+                if error is not None:
+                    self.report.failures[layer.source_filename] = error
+                    failed += 1
+        self.report.skipped += len(map.image_layers) - len(copies) - failed
+        await asyncio.gather(*(
+            self._copy_file(source, destination)
+            for source, destination in copies
+        ))
+
+    async def _copy_file(self, source, destination):
+        try:
+            bytes_copied, linked = await self._call(
+                'copy', _copy_file, source, destination, self.link_mode
+            )
+        except OSError as err:
+            self.report.failures[source] = err
+        else:
+            self.report.bytes_copied += bytes_copied
+            self.report.copied.append(destination)
+            if linked:
+                self.report.linked.append(destination)
+
+    async def _finish(self, map_name):
+        """Give a built map its ID and write its sidecar files"""
+        map = await self._built_future(map_name)
+        map._id = self._map_ids[map_name]
+        if self.save_sidecars:
+            written, skipped = await self._call('write', map.save_sidecar_files)
+            self.sidecars_written += written
+            self.sidecars_skipped += skipped
+
+    def _list_maps(self):
+        self._library = MapScan.library_directories(self.directory)
+        return list(self._library)
+
+    def _parent_to_wait_for(self, map_name):
+        """Return the parent a map has to wait for, None in a cycle"""
+        parent = self._parents.get(map_name)
+        seen = {map_name}
+        ancestor = parent
+        while ancestor is not None and ancestor not in seen:
+            seen.add(ancestor)
+            ancestor = self._parents.get(ancestor)
+        return None if ancestor is not None else parent
+
+    def _promote(self, map_name):
+        """Build an unchanged map after all, as its family is rebuilt"""
+        if map_name in self.session.unchanged_maps:
+            logger.debug("Rebuilding %s along with its family", map_name)
+            del self.session.unchanged_maps[map_name]
+            self._queue_build(map_name)
+
+    def _queue_build(self, map_name):
+        """Start building a map, see IngestSession._pending_scans"""
+        self._pending.add(map_name)
+        self._tasks.append(self._loop.create_task(self._build(map_name)))
+        parent = self._parents[map_name]
+        if parent is not None:
+            self._wanted_parents.add(parent)
+            self._promote(parent)
+        if self.manifest is not None:
+            for other in list(self.session.unchanged_maps):
+                if self.manifest.parent_of(other) == map_name:
+                    self._promote(other)
+
+    async def _run(self):
+        self._loop = asyncio.get_running_loop()
+        self._limits = {
+            stage: asyncio.Semaphore(max(1, jobs))
+            for stage, jobs in self.stage_jobs.items()
+        }
+        self._optimizer_lock = asyncio.Lock()
+        self._scanned = asyncio.Event()
+        start = time.perf_counter()
+
+        # Every stage may fill its limit, plus the DB write
+        self._threads = ThreadPoolExecutor(
+            max_workers=sum(
+                max(1, self.stage_jobs[_]) for _ in PIPELINE_STAGES
+            ) + 1
+        )
+        if self.session.image_optimizer is not None:
+            os.makedirs(self.session.image_optimizer.cache_dir, exist_ok=True)
+            self._processes = ProcessPoolExecutor(
+                max_workers=max(1, self.stage_jobs['optimize'])
+            )
+        try:
+            await self._run_stages()
+        finally:
+            self._threads.shutdown()
+            if self._processes is not None:
+                self._processes.shutdown()
+        self.report.elapsed = time.perf_counter() - start
+
+        optimizer = self.session.image_optimizer
+        if optimizer is not None:
+            logger.info(
+                "Optimized %d images (%d reused, %d failed)",
+                optimizer.transcoded,
+                len(optimizer.outputs) - optimizer.transcoded,
+                len(optimizer.failures)
+            )
+            optimizer.save_index()
+
+    async def _run_stages(self):
+        # Look up the DB entries once, before the scans do concurrently
+        await self._call('scan', getattr, self.database, 'maps')
+        names = await self._call('scan', self._list_maps)
+        await asyncio.gather(*(self._scan(_) for _ in names))
+        self._scanned.set()
+
+        current_ids = await self._call(
+            'scan', self.session._current_ids,
+            {_: self._scans[_] for _ in self._pending}, self.database,
+            self.respect_db
+        )
+        self._map_ids = self.session._allocate_ids(
+            current_ids, self.id_range, self.database
+        )
+        stages = [self._finish(_) for _ in sorted(self._pending)]
+        if (
+            self._pending or self.manifest is None or
+            set(self.manifest.entries) - set(self._scans)
+        ):
+            stages.append(self._write_db())
+        await asyncio.gather(*stages)
+        while self._tasks:
+            tasks, self._tasks = self._tasks, []
+            await asyncio.gather(*tasks)
+
+    async def _scan(self, map_name):
+        """Scan a map directory and queue its build if it changed"""
+        scan, current, parent = await self._call(
+            'scan', self._scan_map, map_name
+        )
+        self._scans[map_name] = scan
+        self._parents[map_name] = parent
+        if (
+            current and map_name not in self._wanted_parents and
+            self.manifest.parent_of(map_name) not in self._pending
+        ):
+            logger.debug("%s is unchanged since last ingest", map_name)
+            self.session.unchanged_maps[map_name] = (
+                self.manifest.entries[map_name]['map_id']
+            )
+        else:
+            self._queue_build(map_name)
+
+    def _scan_map(self, map_name):
+        """Scan a map directory, check it and peek at its parent map"""
+        scan = MapScan(map_name, self._library[map_name]).scan()
+        current = (
+            self.manifest is not None and self.respect_db and
+            self.manifest.is_current(
+                scan, self.database.map_element(map_name)
+            )
+        )
+        return scan, current, self.session._peek_parent_map(scan)
+
+    async def _transcode(self, source, output):
+        """Transcode an image, once per optimized filename"""
+        optimizer = self.session.image_optimizer
+        transcode = self._transcodes.get(output)
+        first = transcode is None
+        if first:
+            transcode = self._loop.run_in_executor(
+                self._processes, _transcode_image, source, output,
+                optimizer.image_format, optimizer.max_dimension,
+                optimizer.quality
+            )
+            self._transcodes[output] = transcode
+        try:
+            await transcode
+        except (OSError, KeyError, ValueError) as err:
+            optimizer.failures[source] = err
+        else:
+            optimizer.outputs[source] = output
+            if first:
+                optimizer.transcoded += 1
+        finally:
+            optimizer.planned.pop(source, None)
+
+    async def _write_db(self):
+        """Save the DB once every map is built and has its ID"""
+        for map_name in self._pending:
+            map = await self._built_future(map_name)
+            map._id = self._map_ids[map_name]
+        await self._loop.run_in_executor(
+            self._threads, IngestPlan._write_db, self.database,
+            list(self.session.maps.values()),
+            list(self.session.unchanged_maps), self.splice,
+            IngestStats()  # Discarded, run times the pipeline as a whole
+        )
+
+    # Public Methods
+
+    def run(self):
+        """Run the ingest.
+
+        Returns:
+            tuple[CopyReport, int, int]: The outcome of the copies, the
+            number of sidecar files written and the number of sidecar files
+            that were already up to date.
+
+        """
+        asyncio.run(self._run())
+        return self.report, self.sidecars_written, self.sidecars_skipped
+
+
+class IngestStats(object):
+    """Phase timings and counters of one ingest run."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = {}  # Phase name to wall time in seconds
+        self.counters = {}
+        self._start = time.perf_counter()
+
+    # Public Methods
+
+    def count(self, name, value=1):
+        """Add to a counter"""
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def log_summary(self):
+        """Log the time of every phase and the counters"""
+        for name, elapsed in self.phases.items():
+            logger.info("Phase %s took %.3fs", name, elapsed)
+        for name, value in sorted(self.counters.items()):
+            logger.info("%s: %s", name, value)
+
+    def add_phase(self, name, elapsed):
+        """Add to the wall time of a phase timed elsewhere"""
+        self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    @contextmanager
+    def phase(self, name):
+        """Time the enclosed block as a phase of the ingest"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start)
+
+    def save(self, filepath):
+        """Atomically write the stats to a JSON file"""
+        logger.debug("Saving stats to %s", filepath)
+        temp_filepath = filepath + '.tmp'
+        with open(temp_filepath, 'w') as f:
+            json.dump(self.to_dict(), f, indent=4, separators=(',', ': '))
+        os.replace(temp_filepath, filepath)
+
+    def to_dict(self):
+        """Return the stats as a JSON serializable dict"""
+        return {
+            'started': self.started,
+            'elapsed': round(time.perf_counter() - self._start, 6),
+            'phases': {
+                name: round(elapsed, 6)
+                for name, elapsed in self.phases.items()
+            },
+            'counters': self.counters
+        }
+
+
+class IngestManifest(object):
+    """Persistent record of what each map looked like when last ingested.
+
+    The manifest lives in the campaign dir and stores, per map, a fingerprint
+    of every gridless file and sidecar file, the size of every copied image
+    and a digest of the map's entry in db.xml. A map whose fingerprint still
+    matches does not need to be rebuilt, copied, saved or re-added to the DB.
+
+    """
+
+    def __init__(self, campaign_dir, defaults_digest, use_hash=False):
+
+        logger.info("Initializing IngestManifest object for %s", campaign_dir)
+
+        self.campaign_dir = campaign_dir
+        self.use_hash = use_hash
+        self._defaults_digest = defaults_digest
+        self._filepath = os.path.join(self.campaign_dir, MANIFEST_FILENAME)
+
+        try:
+            data = self._read_manifest()
+        except (FileNotFoundError, JSONDecodeError):
+            logger.debug(
+                "None or malformed manifest found at %s", self.filepath
+            )
+            data = {}
+
+        if data.get('version') != MANIFEST_VERSION:
+            data = {}
+
+        self._entries = data.get('maps', {})
+        self.id_range = data.get('id_range')
+        # Folders maps were copied to, kept when the maps are pruned so
+        # --gc-images can still clean them up.
+        self.map_dirs = set(data.get('map_dirs', []))
+        for entry in self._entries.values():
+            self.map_dirs.update(
+                os.path.dirname(rel_path) for rel_path, _ in entry['images']
+            )
+        # If the defaults changed every map may render differently.
+        self._stale = data.get('defaults') != self._defaults_digest
+
+    # Properties
+
+    @property
+    def entries(self):
+        return self._entries
+
+    @property
+    def filepath(self):
+        return self._filepath
+
+    # Private Methods
+
+    def _fingerprint_file(self, filepath, stat, previous=None):
+        """Return a [mtime_ns, size, digest] fingerprint for a file.
+
+        Args:
+            filepath (str): Path of the file to fingerprint.
+            stat (tuple[int, int]): The mtime_ns and size of the file.
+            previous (list|None): Previously recorded fingerprint. Its digest
+                is reused if the mtime and size are unchanged.
+
+        """
+        fingerprint = [stat[0], stat[1], None]
+        if self.use_hash:
+            if previous and previous[:2] == fingerprint[:2] and previous[2]:
+                fingerprint[2] = previous[2]
+            else:
+                fingerprint[2] = _file_digest(filepath)
+        return fingerprint
+
+    def _files_match(self, scan, recorded):
+        """Check the source files of a map against their recorded fingerprints
+
+        Args:
+            scan (MapScan): Scan of the map's source directory.
+            recorded (dict): Relative path to fingerprint mapping.
+
+        Returns:
+            bool: True if every file is unchanged.
+
+        """
+        if scan.stats.keys() != recorded.keys():
+            return False
+        for rel_path, fingerprint in recorded.items():
+            mtime_ns, size = scan.stats[rel_path]
+            if [mtime_ns, size] == fingerprint[:2]:
+                continue
+            # Touched but possibly not modified, fall back to the content.
+            if not (self.use_hash and fingerprint[2]):
+                return False
+            if size != fingerprint[1]:
+                return False
+            digest = _file_digest(os.path.join(scan.directory, rel_path))
+            if digest != fingerprint[2]:
+                return False
+        return True
+
+    def _images_match(self, recorded):
+        """Check that every copied image is still present and complete"""
+        for rel_path, size in recorded:
+            try:
+                stat = os.stat(os.path.join(self.campaign_dir, rel_path))
+            except FileNotFoundError:
+                return False
+            if stat.st_size != size:
+                return False
+        return True
+
+    def _read_manifest(self):
+        """Read and return the contents of the manifest file"""
+        with open(self.filepath, 'r') as f:
+            return json.load(f)
+
+    # Public Methods
+
+    def is_current(self, scan, db_element):
+        """Check if a map is unchanged since the last recorded ingest.
+
+        Args:
+            scan (MapScan): Scan of the map's source directory.
+            db_element (Element|None): The map's current entry in db.xml.
+
+        Returns:
+            bool: True if nothing about the map changed.
+
+        """
+        entry = self.entries.get(scan.name)
+        if self._stale or entry is None or db_element is None:
+            return False
+        if entry['source_directory'] != scan.directory:
+            return False
+        if entry['db_digest'] != _element_digest(db_element):
+            logger.debug("DB entry for %s was modified", scan.name)
+            return False
+        return (
+            self._files_match(scan, entry['files']) and
+            self._images_match(entry['images'])
+        )
+
+    def parent_of(self, name):
+        """Return the recorded parent map name of a map, if any"""
+        return self.entries.get(name, {}).get('parent_map')
+
+    def prune(self, names):
+        """Drop entries for maps that are no longer in the library.
+
+        Args:
+            names (iterable[str]): Names of all maps currently in the library.
+
+        Returns:
+            list[str]: The names of the removed entries.
+
+        """
+        names = set(names)
+        removed = [name for name in self.entries if name not in names]
+        for name in removed:
+            logger.debug("Dropping %s from the manifest", name)
+            del self.entries[name]
+        return removed
+
+    def record(self, map):
+        """Record the current state of a freshly ingested map.
+
+        Args:
+            map (Map): The map to record. Its sidecar files and images must
+                already have been written.
+
+        """
+        scan = map.scan
+        if scan is None:
+            scan = MapScan(map.name, map.source_directory)
+            scan.scan()
         else:
-            return self._runtime_defaults[key]
+            # Sidecars were most likely just rewritten
+            scan.refresh_sidecars()
+        previous = self.entries.get(map.name, {}).get('files', {})
+        files = {}
+        for rel_path, stat in scan.stats.items():
+            files[rel_path] = self._fingerprint_file(
+                os.path.join(map.source_directory, rel_path), stat,
+                previous.get(rel_path)
+            )
+        images = []
+        self.map_dirs.add(
+            os.path.relpath(map.destination_dir, self.campaign_dir)
+        )
+        for layer in map.layers:
+            if layer.source_filename:
+                try:
+                    size = os.path.getsize(layer.destination_filename)
+                except FileNotFoundError:
+                    # Never matches, so a failed copy is retried next run.
+                    size = -1
+                images.append(
+                    [
+                        os.path.relpath(
+                            layer.destination_filename, self.campaign_dir
+                        ),
+                        size
+                    ]
+                )
+        self.entries[map.name] = {
+            'source_directory': map.source_directory,
+            'map_id': map.id,
+            'parent_map': map.parent_map,
+            'files': files,
+            'images': images,
+            'db_digest': _element_digest(map.xml)
+        }
 
-    def _generate_updated_json(self):
-        """Generates the updated JSON for this map"""
-        return {
-            'map_id': self.id,
-            'name': self.name,
-            'parent_map': self.parent_map,
-            'player_drawing': self.player_drawing,
-            'grid': self.grid,
-            'grid_size': self.grid_size,
-            'grid_offset': self.grid_offset,
-            'grid_snap': self.grid_snap,
-            'brush_size': self.brush_size
+    def save(self):
+        """Atomically write the manifest to the campaign dir"""
+        logger.debug("Saving manifest to %s", self.filepath)
+        self.map_dirs = {
+            _ for _ in self.map_dirs
+            if os.path.isdir(os.path.join(self.campaign_dir, _))
         }
+        temp_filepath = self.filepath + '.tmp'
+        with open(temp_filepath, 'w') as f:
+            json.dump(
+                {
+                    'version': MANIFEST_VERSION,
+                    'defaults': self._defaults_digest,
+                    'maps': self.entries,
+                    'id_range': self.id_range,
+                    'map_dirs': sorted(self.map_dirs)
+                },
+                f, indent=4, separators=(',', ': '), sort_keys=True
+            )
+        os.replace(temp_filepath, self.filepath)
+        self._stale = False
 
-    def _generate_layers(self):
-        """Creates the Layers for this map"""
-        layers = []
-        layer_id = 0
-        for dir_name, gridless in self._get_gridless():
-            rel_path = dir_name.replace(self.source_directory, '')
-            layer_name = ' - '.join(filter(None, rel_path.split(os.path.sep)))
-            layers.append(
-                Layer(
-                    layer_name, self, layer_id,
-                    os.path.join(dir_name, gridless)
-                )
+
+class LibraryWatcher(object):
+    """Keeps a campaign in memory and re-ingests maps as they change.
+
+    The map library is watched with inotify on Linux and by scanning it
+    every WATCH_POLL_INTERVAL seconds elsewhere. Changes are collected per
+    map directory until none arrived for ``debounce`` seconds. Then only
+    those maps are rescanned, and the ones the manifest does not consider
+    current are rebuilt and ingested. The image section of db.xml is
+    spliced in place, and the DB is reloaded first if something else
+    changed it on disk.
+
+    """
+
+    def __init__(
+            self, session, directory, database, manifest, jobs=1,
+            check='exists', link_mode='copy', splice=True, save_sidecars=True,
+            debounce=0.3
+    ):
+
+        logger.info("Initializing LibraryWatcher object for %s", directory)
+
+        self.session = session
+        self.directory = os.path.abspath(directory)
+        self.database = database
+        self.manifest = manifest
+        self.jobs = jobs
+        self.check = check
+        self.link_mode = link_mode
+        self.splice = splice
+        self.save_sidecars = save_sidecars
+        self.debounce = debounce
+        self._inotify_fd = None
+        self._watches = {}  # Watch descriptor to directory
+        self._snapshot = {}  # Map name to the stats of its files
+
+    # Private Methods
+
+    def _add_watches(self, directory):
+        """Watch a directory and all directories below it"""
+        for dir_name, _, _ in os.walk(directory):
+            wd = libc.inotify_add_watch(
+                self._inotify_fd, os.fsencode(dir_name), INOTIFY_MASK
             )
-            layer_id += 1
-        for occluder in self.occluders:
-            layers.append(
-                Layer(
-                    None, self, layer_id, occluder=occluder
+            if wd < 0:
+                logger.warning(
+                    "Cannot watch %s: %s",
+                    dir_name, os.strerror(ctypes.get_errno())
+                )
+                continue
+            self._watches[wd] = dir_name
+
+    def _map_name(self, path):
+        """Return the name of the map directory a path is in"""
+        rel_path = os.path.relpath(path, self.directory)
+        if rel_path == os.curdir or rel_path.startswith(os.pardir):
+            return None
+        map_name = rel_path.split(os.path.sep)[0]
+        if map_name.lower().endswith(ARCHIVE_SUFFIX):
+            map_name = map_name[:-len(ARCHIVE_SUFFIX)]
+        return map_name
+
+    def _poll_changes(self):
+        """Rescan the library and return the maps that differ from before"""
+        time.sleep(WATCH_POLL_INTERVAL)
+        try:
+            scans = MapScan.scan_library(self.directory, jobs=self.jobs)
+        except (OSError, ValueError) as e:  # Half copied map directories
+            logger.debug("Scan of %s failed: %s", self.directory, e)
+            return set()
+        snapshot = {name: scan.stats for name, scan in scans.items()}
+        changed = {
+            name for name in set(snapshot) | set(self._snapshot)
+            if snapshot.get(name) != self._snapshot.get(name)
+        }
+        self._snapshot = snapshot
+        return changed
+
+    def _read_events(self):
+        """Wait for inotify events and return the maps they concern"""
+        readable, _, _ = select.select(
+            [self._inotify_fd], [], [], WATCH_POLL_INTERVAL
+        )
+        if not readable:
+            return set()
+        data = os.read(self._inotify_fd, 64 * 1024)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            filename = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                logger.info("Missed file events, checking every map")
+                for entry in os.listdir(self.directory):
+                    map_name = self._map_name(
+                        os.path.join(self.directory, entry)
+                    )
+                    if map_name:
+                        changed.add(map_name)
+                changed.update(self.manifest.entries)
+                continue
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            dir_name = self._watches.get(wd)
+            if dir_name is None:
+                continue
+            path = os.path.join(dir_name, filename)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_watches(path)
+            map_name = self._map_name(path)
+            if map_name:
+                changed.add(map_name)
+        return changed
+
+    def _start(self):
+        """Start watching, with inotify if the platform has it"""
+        if libc is not None:
+            self._inotify_fd = libc.inotify_init1(os.O_CLOEXEC)
+            if self._inotify_fd < 0:
+                logger.info(
+                    "inotify is unavailable: %s",
+                    os.strerror(ctypes.get_errno())
                 )
+                self._inotify_fd = None
+        if self._inotify_fd is not None:
+            self._add_watches(self.directory)
+            logger.info("Watching %s with inotify", self.directory)
+        else:
+            self._poll_changes()
+            logger.info(
+                "Watching %s by scanning every %ss",
+                self.directory, WATCH_POLL_INTERVAL
             )
-        return layers
 
-    def _generate_xml(self):
-        """Generates the XML for this map"""
-        image_id_root = ET.Element('id-{:05d}'.format(self.id))
-        image_elem = ET.SubElement(image_id_root, 'image', type='image')
-        subelements = [
-            ('allowplayerdrawing', BOOLEAN_MAP_INVERSE[self.player_drawing]),
-            ('grid', BOOLEAN_MAP_INVERSE[self.grid]),
-            ('gridsize', self._to_xml_int_coord(self.grid_size)),
-            ('gridoffset', self._to_xml_int_coord(self.grid_offset)),
-            ('gridsnap', BOOLEAN_MAP_INVERSE[self.grid_snap]),
-            ('brushsize', self._to_xml_float_coord(self.brush_size))
-        ]
-        for name, text in subelements:
-            _ = ET.SubElement(image_elem, name)
-            _.text = text
-        layers = ET.SubElement(image_elem, 'layers')
-        for layer in self.layers:
-            # We want the layer list to be inversed
-            layers.insert(0, layer.xml)
-        locked = ET.SubElement(image_id_root, 'locked', type='number')
-        locked.text = '0'
-        name = ET.SubElement(image_id_root, 'name', type='string')
-        name.text = self.name
-        return image_id_root
+    def _stop(self):
+        if self._inotify_fd is not None:
+            os.close(self._inotify_fd)
+            self._inotify_fd = None
+            self._watches = {}
 
-    def _get_gridless(self):
-        """Return a list of gridless files in subdirectories
+    # Public Methods
+
+    def ingest(self, names):
+        """Rebuild and ingest the given maps if they changed.
+
+        Args:
+            names (iterable[str]): Names of possibly changed maps.
 
         Returns:
-            str, str: Returns the directory name and the filename of the
-            gridless jpeg image.
+            bool: True if anything was ingested.
 
         """
-        found = {}
-        for dir_name, _, file_list in os.walk(self.source_directory):
-            for filename in file_list:
-                if filename.lower().endswith('gridless.jpg'):
-                    if dir_name in found:
-                        raise ValueError(
-                            "More than one gridless file found in directory "
-                            "{dir_name}. Conflicting files:\n"
-                            "{file1}\n"
-                            "{file2}".format(
-                                dir_name=dir_name,
-                                file1=found[dir_name],
-                                file2=filename
-                            )
+        if self.database.changed_on_disk():
+            logger.info("%s changed on disk, reloading", self.database.filepath)
+            self.database = CampaignDB(
+                self.database.campaign_dir, lazy=self.database.lazy
+            )
+
+        session = self.session
+        session.clear()
+        session.build_maps(
+            self.directory, self.database, manifest=self.manifest,
+            jobs=self.jobs, names=set(names)
+        )
+        removed = self.manifest.prune(
+            list(session.maps) + list(session.unchanged_maps)
+        )
+        if not session.maps and not removed:
+            return False
+
+        session.set_missing_ids(id_range=self.manifest.id_range)
+        plan = IngestPlan.build(
+            session, self.database, check=self.check,
+            save_sidecars=self.save_sidecars
+        )
+        copy_report, _, _ = plan.execute(
+            session, self.database, jobs=self.jobs,
+            link_mode=self.link_mode, splice=self.splice
+        )
+        copy_report.log_summary()
+        for map in session.maps.values():
+            self.manifest.record(map)
+        self.manifest.save()
+        logger.info(
+            "Ingested %s", ', '.join(sorted(list(session.maps) + removed))
+        )
+        return True
+
+    def run(self):
+        """Watch the library until interrupted"""
+        self._start()
+        try:
+            dirty = set()
+            last_change = 0.0
+            while True:
+                if self._inotify_fd is not None:
+                    changed = self._read_events()
+                else:
+                    changed = self._poll_changes()
+                now = time.monotonic()
+                if changed:
+                    dirty.update(changed)
+                    last_change = now
+                if dirty and now - last_change >= self.debounce:
+                    names, dirty = dirty, set()
+                    try:
+                        self.ingest(names)
+                    except (
+                            OSError, RuntimeError, ValueError, ET.ParseError
+                    ) as e:
+                        logger.error(
+                            "Ingesting %s failed, retrying on the next "
+                            "change: %s", ', '.join(sorted(names)), e
                         )
-                    found[dir_name] = filename
-                    yield dir_name, filename
+        finally:
+            self._stop()
 
-    def _to_xml_float_coord(self, value):
-        """Takes a (x, y) tuple with floats and returns a 'x,y' string."""
-        float_values = (float(_) for _ in value)
-        return '{:.4},{:.4}'.format(*float_values)
 
-    def _to_xml_int_coord(self, value):
-        """Takes a (x, y) tuple with ints and returns a 'x,y' string."""
-        float_values = (int(_) for _ in value)
-        return '{},{}'.format(*float_values)
+# Private Functions
 
-    def _read_json_sidecar(self):
-        """Read and return the contents of the JSON sidecar file for this map"""
-        with open(self.json_filepath, 'r') as f:
-            return json.load(f)
+def _archive_listing(archive, member):
+    """Return the directories and files directly below a zip archive member
+
+    Returns:
+        tuple[set[str], set[str]]: Directory names and filenames.
+
+    """
+    prefix = member + '/' if member else ''
+    dirs = set()
+    files = set()
+    for name in archive.namelist():
+        if not name.startswith(prefix) or name == prefix:
+            continue
+        head, sep, _ = name[len(prefix):].partition('/')
+        if sep:
+            dirs.add(head)
+        else:
+            files.add(head)
+    return dirs, files
 
-    def _read_occluder_xml(self):
-        """Read and return the occluder XML sidecar file"""
-        xml = ET.parse(self.occluder_xml_filepath)
-        return list(xml.getroot())
 
-    # Public Methods
+def _archive_member(filepath):
+    """Split a path into a zip archive and a member within it.
 
-    @classmethod
-    def build_maps(cls, directory, database, respect_db=True):
-        map_files = sorted(os.listdir(directory))
-        for map_name in map_files:
-            if os.path.isdir(os.path.join(directory, map_name)):
-                try:
-                    if not respect_db:
-                        # Complete overwrite of DB
-                        raise KeyError()
-                    db_map = database.maps[map_name]
-                except KeyError:
-                    db_map = {
-                        'name': map_name,
-                    }
-
-                cls(
-                    directory=os.path.abspath(
-                        os.path.join(directory, map_name)
-                    ),
-                    campaign_db=database,
-                    **db_map
-                )
+    Map packs are addressed as if the archive were a directory, so
+    'pack.zip/Map/Day/Map gridless.jpg' is the member
+    'Map/Day/Map gridless.jpg' of 'pack.zip'.
 
-    def copy_images(self, overwrite=False):
-        """Copies the layer images for this map to the campaign dir"""
-        self._create_dir()
-        for layer in self.layers:
-            if layer.source_filename:
-                if overwrite or not os.path.exists(layer.destination_filename):
-                    # This could be a race conditions, but that seems
-                    # very unlikely to occur and the workaround is ugly.
-                    logger.debug(
-                        "Copying %s to %s",
-                        layer.source_filename, layer.destination_filename
-                    )
-                    shutil.copy2(
-                        layer.source_filename,
-                        layer.destination_filename
-                    )
+    Returns:
+        tuple[ZipFile, str]|None: The archive and the member name, empty for
+        the archive itself, or None if the path is not within an archive.
 
-    @classmethod
-    def copy_maps(cls, overwrite=False):
-        """Copies all map layers for all maps to the campaign dir"""
-        for map in cls.maps.values():
-            map.copy_images(overwrite=overwrite)
+    """
+    head = filepath
+    parts = []
+    while True:
+        if head.lower().endswith(ARCHIVE_SUFFIX) and os.path.isfile(head):
+            return _open_archive(head), '/'.join(reversed(parts))
+        head, tail = os.path.split(head)
+        if not tail:
+            return None
+        parts.append(tail)
 
-    def save_json_settings(self):
-        """Saves the JSON settings to a JSON file in the base map dir."""
-        logger.debug(
-            "Saving JSON settings for %s to %s",
-            self.name, self.json_filepath
-        )
-        with open(self.json_filepath, 'w') as f:
-            json.dump(
-                self._generate_updated_json(), f,
-                indent=4, separators=(',', ': ')
-            )
 
-    def save_occluders(self):
-        """Saves the occluders XML to an XML file in the base map dir."""
-        if not self.occluders:
-            logger.debug("No occluders to save for %s", self.name)
-            return
+def _clone_file(source, destination):
+    """Clone a file on the same filesystem without copying user space bytes
 
-        xml_root = ET.Element('saved-occluders')
-        for occluder in self.occluders:
-            xml_root.append(occluder)
+    Tries a reflink (FICLONE) first, which shares extents on copy-on-write
+    filesystems, then an in-kernel copy_file_range, then a plain copy.
 
-        logger.debug(
-            "Saving XML occluders for %s to %s",
-            self.name, self.occluder_xml_filepath
+    Returns:
+        bool: True if the file was reflinked.
+
+    """
+    with open(source, 'rb') as fsrc, open(destination, 'wb') as fdst:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return True
+            except OSError:
+                pass
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while os.copy_file_range(
+                    fsrc.fileno(), fdst.fileno(), HASH_CHUNK_SIZE * 64
+                ):
+                    pass
+                return False
+            except OSError:
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+        shutil.copyfileobj(fsrc, fdst, HASH_CHUNK_SIZE)
+    return False
+
+
+def _conflicting_gridless_error(dir_name, file1, file2):
+    return ValueError(
+        "More than one gridless file found in directory "
+        "{dir_name}. Conflicting files:\n"
+        "{file1}\n"
+        "{file2}".format(
+            dir_name=dir_name,
+            file1=file1,
+            file2=file2
         )
+    )
 
-        with open(self.occluder_xml_filepath, 'w') as f:
-            f.write(
-                NEWLINE_FIX.sub(
-                    '',
-                    minidom.parseString(
-                        ET.tostring(xml_root)
-                    ).toprettyxml(indent="\t")
-                )
-            )
 
-    @classmethod
-    def save_all_sidecar_files(cls):
-        """Saves JSON and XML sidecar files for all maps"""
-        for map in cls.maps.values():
-            map.save_sidecar_files()
+def _copy_byte_range(fsrc, fdst, length):
+    """Copy length bytes from the current position of fsrc to fdst"""
+    while length:
+        chunk = fsrc.read(min(length, HASH_CHUNK_SIZE))
+        if not chunk:
+            raise EOFError("Source ended before the end of the range")
+        fdst.write(chunk)
+        length -= len(chunk)
 
-    def save_sidecar_files(self):
-        """Save JSON and XML sidecar files for this map"""
-        self.save_json_settings()
-        self.save_occluders()
 
-    @classmethod
-    def set_campaign_defaults(cls, campaign_dir):
-        """Read the campaign default settings json."""
-        json_settings = os.path.join(campaign_dir, 'settings.json')
-        with open(json_settings, 'r') as f:
-            logger.info("Reading campaign defaults from %s", json_settings)
-            cls._campaign_defaults = json.load(f)
+def _copy_file(source, destination, link_mode='copy'):
+    """Copy a single file
 
-    @classmethod
-    def set_missing_ids(cls):
-        """Sets ids for all maps to unused ID values"""
-        existing_ids = [_.id for _ in cls.maps.values() if _.id is not None]
-
-        def _get_next_id():
-            for i in range(len(cls.maps)):
-                if i + 1 not in existing_ids:
-                    yield i + 1
-                else:
+    Copies, hardlinks and reflinks are made to a temporary file which then
+    replaces the destination, so a destination is never left half written.
+    Large copies resume where an interrupted run left off, see
+    _copy_journaled. Members of zip archives are always copied.
+
+    Returns:
+        tuple[int, bool]: The number of bytes copied and whether the file
+        was linked rather than copied.
+
+    """
+    if (
+        link_mode != 'copy' and _archive_member(source) is None and
+        _same_filesystem(source, destination)
+    ):
+        temp_destination = destination + '.tmp'
+        if link_mode == 'hardlink':
+            logger.debug("Hardlinking %s to %s", source, destination)
+            if os.path.lexists(temp_destination):
+                os.remove(temp_destination)
+            os.link(source, temp_destination)
+            os.replace(temp_destination, destination)
+            return 0, True
+        logger.debug("Reflinking %s to %s", source, destination)
+        linked = _clone_file(source, temp_destination)
+        shutil.copystat(source, temp_destination)
+        os.replace(temp_destination, destination)
+        if linked:
+            return 0, True
+        return os.path.getsize(destination), False
+
+    logger.debug("Copying %s to %s", source, destination)
+    return _copy_journaled(source, destination), False
+
+
+def _copy_journaled(source, destination):
+    """Copy a file through a partial file that replaces the destination
+
+    Files larger than COPY_JOURNAL_INTERVAL are copied in blocks of that
+    size. After every block the partial file is synced and the sha1 digest
+    of the block recorded in a journal next to it. An interrupted copy
+    resumes after the last block the partial file still holds, as long as
+    the source has not changed since.
+
+    Returns:
+        int: The number of bytes copied by this call.
+
+    """
+    temp_destination = destination + PARTIAL_COPY_SUFFIX
+    archived = _archive_member(source) is not None
+    mtime_ns, size = _stat_source(source)
+    if size <= COPY_JOURNAL_INTERVAL:
+        if archived:
+            with _open_source(source) as fsrc:
+                with open(temp_destination, 'wb') as fdst:
+                    shutil.copyfileobj(fsrc, fdst)
+            os.utime(temp_destination, ns=(mtime_ns, mtime_ns))
+        else:
+            shutil.copyfile(source, temp_destination)
+            shutil.copystat(source, temp_destination)
+        os.replace(temp_destination, destination)
+        return size
+
+    journal_filepath = temp_destination + '.json'
+    source_id = [size, mtime_ns]
+    digests = _journaled_blocks(journal_filepath, temp_destination, source_id)
+    offset = len(digests) * COPY_JOURNAL_INTERVAL
+    if offset:
+        logger.debug("Resuming copy of %s at %d bytes", source, offset)
+
+    copied = 0
+    block, block_size = hashlib.sha1(), 0
+    temp_journal = journal_filepath + '.tmp'
+    with _open_source(source) as fsrc:
+        fsrc.seek(offset)
+        with open(temp_destination, 'r+b' if offset else 'wb') as fdst:
+            fdst.seek(offset)
+            fdst.truncate()
+            while True:
+                chunk = fsrc.read(
+                    min(COPY_CHUNK_SIZE, COPY_JOURNAL_INTERVAL - block_size)
+                )
+                if not chunk:
+                    break
+                fdst.write(chunk)
+                block.update(chunk)
+                block_size += len(chunk)
+                copied += len(chunk)
+                if block_size < COPY_JOURNAL_INTERVAL:
                     continue
+                fdst.flush()
+                os.fsync(fdst.fileno())
+                digests.append(block.hexdigest())
+                block, block_size = hashlib.sha1(), 0
+                with open(temp_journal, 'w') as f:
+                    json.dump({'source': source_id, 'blocks': digests}, f)
+                os.replace(temp_journal, journal_filepath)
+
+    if archived:
+        os.utime(temp_destination, ns=(mtime_ns, mtime_ns))
+    else:
+        shutil.copystat(source, temp_destination)
+    os.replace(temp_destination, destination)
+    if os.path.exists(journal_filepath):
+        os.remove(journal_filepath)
+    return copied
+
+
+def _copy_files(copies, jobs=1, link_mode='copy'):
+    """Copy (source, destination) pairs on a bounded pool of threads
+
+    Args:
+        copies (list[tuple[str, str]]): Files to copy.
+        jobs (int): Maximum number of concurrent copies.
+        link_mode (str): One of LINK_MODES.
+
+    Returns:
+        CopyReport: The outcome of the copy.
+
+    """
+    report = CopyReport()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = [
+            (source, destination,
+             executor.submit(_copy_file, source, destination, link_mode))
+            for source, destination in copies
+        ]
+        for source, destination, future in futures:
+            try:
+                bytes_copied, linked = future.result()
+            except OSError as err:
+                report.failures[source] = err
+            else:
+                report.bytes_copied += bytes_copied
+                report.copied.append(destination)
+                if linked:
+                    report.linked.append(destination)
+    report.elapsed = time.perf_counter() - start
+    return report
+
+
+def _douglas_peucker(xy, tolerance):
+    """Return the indices of the points Douglas-Peucker keeps.
+
+    The recursion is unrolled onto a stack, and the distances of all points
+    between two kept points are computed at once. Ties go to the first
+    point, so the result only depends on the input.
+
+    Args:
+        xy (ndarray): Points as an (n, 2) array.
+        tolerance (float): Largest distance a removed point may have from
+            the simplified line.
+
+    Returns:
+        ndarray: Ascending indices of the kept points.
+
+    """
+    keep = np.zeros(len(xy), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(xy) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        offsets = xy[start + 1:end] - xy[start]
+        dx, dy = xy[end] - xy[start]
+        length = np.hypot(dx, dy)
+        if length:
+            distances = np.abs(dx * offsets[:, 1] - dy * offsets[:, 0])
+            distances /= length
+        else:
+            # Closed outline, measure from the shared end point
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        index = int(np.argmax(distances))
+        if distances[index] > tolerance:
+            index += start + 1
+            keep[index] = True
+            stack.append((index, end))
+            stack.append((start, index))
+    return np.flatnonzero(keep)
+
+
+def _element_digest(element):
+    """Return a digest of an element that ignores indentation whitespace"""
+    digest = hashlib.sha1()
+    for elem in element.iter():
+        digest.update(elem.tag.encode('utf-8'))
+        for key, value in sorted(elem.attrib.items()):
+            digest.update('\0{}={}'.format(key, value).encode('utf-8'))
+        for text in (elem.text, elem.tail):
+            digest.update(b'\0')
+            if text and text.strip():
+                digest.update(text.strip().encode('utf-8'))
+        digest.update(b'\1')
+    return digest.hexdigest()
+
+
+def _file_digest(filepath):
+    """Return the sha1 digest of a file, read in chunks"""
+    digest = hashlib.sha1()
+    with _open_source(filepath) as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _journaled_blocks(journal_filepath, temp_destination, source_id):
+    """Return the digests of the journaled blocks a partial copy still holds
+
+    The blocks of the partial file are hashed in order, up to the first one
+    that is missing or does not match its digest in the journal.
+
+    Args:
+        journal_filepath (str): The journal of the partial copy.
+        temp_destination (str): The partial copy.
+        source_id (list[int]): Size and mtime of the source being copied.
+
+    Returns:
+        list[str]: The digests of the blocks to keep, empty to start over.
+
+    """
+    digests = []
+    try:
+        with open(journal_filepath, 'r') as f:
+            journal = json.load(f)
+        if journal['source'] != source_id:
+            return digests
+        with open(temp_destination, 'rb') as f:
+            for expected in journal['blocks']:
+                block = hashlib.sha1()
+                remaining = COPY_JOURNAL_INTERVAL
+                while remaining:
+                    chunk = f.read(min(COPY_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    block.update(chunk)
+                    remaining -= len(chunk)
+                if remaining or block.hexdigest() != expected:
+                    logger.debug(
+                        "Partial copy %s differs from its journal after %d "
+                        "bytes", temp_destination,
+                        len(digests) * COPY_JOURNAL_INTERVAL
+                    )
+                    break
+                digests.append(expected)
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return digests
+
+
+def _find_orphan_images(campaign_dir, map_dirs, referenced):
+    """Find the files in the map folders of the images dir nothing refers to
+
+    Only the folders maps were copied to are searched. Other folders of the
+    images dir, like Fantasy Grounds' own imports and handouts, are left
+    alone. Every directory is listed once with os.scandir and only the
+    orphans are stat'ed. Partial copies of referenced images are kept, so
+    an interrupted copy can resume.
+
+    Args:
+        campaign_dir (str): The campaign dir.
+        map_dirs (iterable[str]): The map folders, relative to campaign_dir.
+        referenced (iterable[str]): Paths of the images the DB refers to.
+
+    Returns:
+        list[tuple[str, int]]: Path and size of every orphan, in path order.
+
+    """
+    images_dir = os.path.normpath(os.path.join(campaign_dir, 'images'))
+    referenced = {os.path.normcase(os.path.normpath(_)) for _ in referenced}
+    orphans = []
+    stack = []
+    for map_dir in map_dirs:
+        path = os.path.normpath(os.path.join(campaign_dir, map_dir))
+        if path.startswith(images_dir + os.sep):
+            stack.append(path)
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+                continue
+            path = os.path.normcase(entry.path)
+            for suffix in (
+                    PARTIAL_COPY_SUFFIX + '.json', PARTIAL_COPY_SUFFIX
+            ):
+                if path.endswith(suffix):
+                    path = path[:-len(suffix)]
+                    break
+            if path not in referenced:
+                orphans.append(
+                    (entry.path, entry.stat(follow_symlinks=False).st_size)
+                )
+    orphans.sort()
+    return orphans
+
+
+def _referenced_images(db_filepath, campaign_dir):
+    """Return the campaign images the image section of a db.xml refers to
+
+    The file is parsed incrementally, top level section by section, as it
+    may hold entries a streamed ingest spliced in without loading them.
+    Images in modules, named like 'images/x.jpg@Module', are not part of
+    the campaign and left out.
+
+    Args:
+        db_filepath (str): The saved db.xml.
+        campaign_dir (str): The campaign dir the image paths are relative to.
+
+    Returns:
+        set[str]: Paths of the referenced images.
+
+    """
+    referenced = set()
+    depth = 0
+    in_images = False
+    for event, element in ET.iterparse(db_filepath, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 2:
+                in_images = element.tag == 'image'
+            continue
+        depth -= 1
+        if in_images and element.tag == 'bitmap' and element.text:
+            parts = element.text.strip().split('/')
+            if '@' not in parts[-1]:
+                if parts[0] == 'campaign':
+                    parts = parts[1:]
+                referenced.add(os.path.join(campaign_dir, *parts))
+        if depth == 1:
+            element.clear()  # Done with this section
+    return referenced
+
+
+def _format_coord(value):
+    """Format a coordinate for XML, whole numbers without a fraction"""
+    if value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _align_mtime(destination, mtime_ns):
+    """Set the mtime of a copy whose content matches its source"""
+    try:
+        os.utime(destination, ns=(os.stat(destination).st_atime_ns, mtime_ns))
+    except OSError as err:
+        logger.warning("Could not update the mtime of %s: %s", destination, err)
 
-        ids = _get_next_id()
 
-        for map in cls.maps.values():
-            if map.id is None:
-                map_id = next(ids)
-                logger.debug("Setting %s to id %s", map.name, map_id)
-                map.id = map_id
+def _needs_copy(source, destination, check='exists', touches=None):
+    """Decide if the destination of a layer is missing or out of date
 
-    @classmethod
-    def set_runtime_defaults(cls, defaults):
-        """Set the default dictionary to the given values."""
-        cls._runtime_defaults = defaults
+    Args:
+        source (str): The source image.
+        destination (str): The copy in the campaign dir.
+        check (str): One of COPY_CHECKS.
+        touches (list|None): Collects the (destination, mtime_ns) pairs of
+            copies with the same content but another mtime than their
+            source, for aligning later. If None they are aligned right away.
 
+    """
+    try:
+        dest_stat = os.stat(destination)
+    except FileNotFoundError:
+        return True
+    if check == 'exists':
+        return False
+
+    source_mtime_ns, source_size = _stat_source(source)
+    if source_size != dest_stat.st_size:
+        return True
+    if (
+        abs(source_mtime_ns - dest_stat.st_mtime_ns) <=
+        MTIME_TOLERANCE * 1e9
+    ):
+        return False
+    if check != 'hash':
+        return True
+    if _file_digest(source) != _file_digest(destination):
+        return True
+    # Same content, align the mtime so the next check is cheap.
+    if touches is None:
+        os.utime(destination, ns=(dest_stat.st_atime_ns, source_mtime_ns))
+    else:
+        touches.append((destination, source_mtime_ns))
+    return False
+
+
+def _grid_size_from_names(names, dimensions):
+    """Derive a grid size from the first name following a grid convention.
+
+    Args:
+        names (list[str]): Names to search, in order of preference.
+        dimensions (tuple[int, int]|None): Pixel size of the image.
+
+    Returns:
+        tuple[int, int]|None: The grid size in pixels.
+
+    """
+    for name in names:
+        match = GRID_PIXELS.search(name)
+        if match:
+            size = int(match.group(1))
+            return size, size
+        if not dimensions:
+            continue
+        width, height = dimensions
+        for match in GRID_DIMENSIONS.finditer(name):
+            columns, rows = (int(_) for _ in match.groups())
+            if not columns or not rows:
+                continue
+            # Both orders are common, pick the one giving square cells.
+            for columns, rows in ((columns, rows), (rows, columns)):
+                cell_width = width / columns
+                cell_height = height / rows
+                if (
+                    abs(cell_width - cell_height) <=
+                    GRID_TOLERANCE * max(cell_width, cell_height)
+                ):
+                    return round(cell_width), round(cell_height)
+    return None
+
+
+def _open_archive(filepath):
+    """Return an open ZipFile, shared until the archive changes on disk"""
+    stat = os.stat(filepath)
+    # Forked workers must not share the file offset of their parent's handle
+    fingerprint = (os.getpid(), stat.st_mtime_ns, stat.st_size)
+    with _archives_lock:
+        cached = _archives.get(filepath)
+        if cached is None or cached[0] != fingerprint:
+            cached = (fingerprint, zipfile.ZipFile(filepath))
+            _archives[filepath] = cached
+        return cached[1]
+
+
+def _open_source(filepath):
+    """Open a source file, or a member of a zip archive, for binary reading"""
+    found = _archive_member(filepath)
+    if found is None:
+        return open(filepath, 'rb')
+    archive, member = found
+    try:
+        return archive.open(member)
+    except KeyError:
+        raise FileNotFoundError(
+            "No {} in {}".format(member, archive.filename)
+        )
 
-class Layer(object):
-    """Representing a layer of a map."""
 
-    def __init__(self, name, map, layer_id, filename=None, occluder=None):
+def _probe_image_size(filepath):
+    """Read the pixel size of a JPEG or PNG image from its header.
 
-        logger.info("Instantiating layer %s - %s", map.name, name)
+    Only the PNG IHDR chunk or the JPEG segment headers up to the start of
+    frame are read, the image data itself is never touched.
 
-        self.name = name
-        self.id = layer_id
-        self.map = map
-        self.source_filename = filename
-        self.occluder = occluder
-        self._xml = None
+    Args:
+        filepath (str): Path of the image.
 
-    # Properties
+    Returns:
+        tuple[int, int]|None: The width and height, or None if the format is
+        not recognized.
 
-    @property
-    def destination_filename(self):
-        return os.path.join(
-            self.map.destination_dir, '{name}{ext}'.format(
-                name=self.name,
-                ext=self.extension
-            )
+    """
+    with _open_source(filepath) as f:
+        head = f.read(24)
+        if head[:8] == PNG_SIGNATURE and head[12:16] == b'IHDR':
+            return struct.unpack('>II', head[16:24])
+        if head[:2] != b'\xff\xd8':
+            return None
+        f.seek(2)
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                return None
+            code = marker[1]
+            while code == 0xFF:  # Fill bytes
+                byte = f.read(1)
+                if not byte:
+                    return None
+                code = byte[0]
+            if code == 0x01 or 0xD0 <= code <= 0xD8:
+                continue  # Markers without a segment
+            if code in (0xD9, 0xDA):
+                return None  # End of image or start of scan
+            segment = f.read(2)
+            if len(segment) < 2:
+                return None
+            length = struct.unpack('>H', segment)[0]
+            if code in JPEG_SOF_MARKERS:
+                frame = f.read(5)
+                if len(frame) < 5:
+                    return None
+                height, width = struct.unpack('>HH', frame[1:])
+                return width, height
+            f.seek(length - 2, os.SEEK_CUR)
+
+
+def _scaled_size(dimensions, max_dimension):
+    """Scale a (width, height) down to fit within max_dimension"""
+    width, height = dimensions
+    if not max_dimension or max(width, height) <= max_dimension:
+        return width, height
+    scale = max_dimension / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _stat_source(filepath):
+    """Return the (mtime_ns, size) of a source file or zip archive member"""
+    found = _archive_member(filepath)
+    if found is None:
+        stat = os.stat(filepath)
+        return stat.st_mtime_ns, stat.st_size
+    archive, member = found
+    try:
+        info = archive.getinfo(member)
+    except KeyError:
+        raise FileNotFoundError(
+            "No {} in {}".format(member, archive.filename)
         )
+    return _zip_mtime_ns(info), info.file_size
+
+
+def _transcode_image(source, destination, image_format, max_dimension,
+                     quality):
+    """Re-encode an image, run in a worker process of ImageOptimizer
+
+    Args:
+        source (str): Source image filename.
+        destination (str): Filename of the optimized image.
+        image_format (str): One of IMAGE_FORMATS.
+        max_dimension (int): Maximum width and height, 0 for no limit.
+        quality (int): Encoder quality, 1 to 100.
+
+    Returns:
+        int: The size of the optimized image in bytes.
+
+    """
+    Image.MAX_IMAGE_PIXELS = None  # Battlemaps are large, trusted files
+    with _open_source(source) as f, Image.open(f) as image:
+        size = _scaled_size(image.size, max_dimension)
+        if size != image.size:
+            image = image.resize(size, Image.LANCZOS)
+        if image_format == 'jpeg' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        temp_destination = destination + '.tmp'
+        image.save(
+            temp_destination, format=image_format.upper(), quality=quality,
+            optimize=True
+        )
+    os.replace(temp_destination, destination)
+    return os.path.getsize(destination)
 
-    @property
-    def embed_filename(self):
-        """Filename suitable for embeddng in the XML"""
-        return "campaign/images/{map_name}/{layer_name}{ext}".format(
-            map_name=self.map.name,
-            layer_name=self.name,
-            ext=self.extension
+
+def _escape_xml(data):
+    """Escape text or an attribute value the way minidom does"""
+    return data.replace('&', '&amp;').replace('<', '&lt;').replace(
+        '"', '&quot;').replace('>', '&gt;')
+
+
+def _serialize_pretty_xml(element, write, indent=''):
+    """Write an element the way minidom's toprettyxml(indent='\\t') does.
+
+    ElementTree keeps text and tails on elements, minidom keeps them as text
+    nodes between child elements. The node list minidom would have built is
+    derived from the text and tails, so no copy of the tree is made.
+
+    """
+    write(indent + '<' + element.tag)
+    for key, value in element.attrib.items():
+        write(' {}="{}"'.format(key, _escape_xml(value)))
+
+    text = element.text
+    if text and '\r' in text:
+        # A round trip through the parser normalizes line endings
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    if not len(element):
+        if text:
+            write('>' + _escape_xml(text) + '</' + element.tag + '>\n')
+        else:
+            write('/>\n')
+        return
+
+    child_indent = indent + '\t'
+    write('>\n')
+    if text:
+        write(child_indent + _escape_xml(text) + '\n')
+    for child in element:
+        _serialize_pretty_xml(child, write, child_indent)
+        tail = child.tail
+        if tail:
+            if '\r' in tail:
+                tail = tail.replace('\r\n', '\n').replace('\r', '\n')
+            write(child_indent + _escape_xml(tail) + '\n')
+    write(indent + '</' + element.tag + '>\n')
+
+
+def _write_pretty_xml(element, f, indent='', declaration=True):
+    """Stream an element to a file handle as pretty printed XML.
+
+    The output is identical to running NEWLINE_FIX over minidom's
+    toprettyxml, without building the serialized, reparsed and pretty
+    printed copies of the document in memory. NEWLINE_FIX only ever matches
+    within a run of newlines and tabs, so the buffer is flushed up to the
+    last run and the run is carried over to the next flush.
+
+    Args:
+        element (Element): Root element to write.
+        f (file): Text file handle to write to.
+        indent (str): Indent of the element itself.
+        declaration (bool): Start with an XML declaration.
+
+    """
+    with _pretty_xml_stream(f) as write:
+        if declaration:
+            write(XML_DECLARATION)
+        _serialize_pretty_xml(element, write, indent)
+
+
+@contextmanager
+def _pretty_xml_stream(f):
+    """Yield a write function that applies NEWLINE_FIX on its way to f.
+
+    Pieces are buffered, and the buffer is flushed up to its last run of
+    newlines and tabs, which is carried over to the next flush.
+
+    """
+    pieces = []
+
+    def write(piece):
+        pieces.append(piece)
+        if len(pieces) >= XML_WRITE_BUFFER:
+            chunk = ''.join(pieces)
+            head = chunk.rstrip('\n\t')
+            f.write(NEWLINE_FIX.sub('', head))
+            pieces[:] = [chunk[len(head):]]
+
+    yield write
+    f.write(NEWLINE_FIX.sub('', ''.join(pieces)))
+
+
+def _text_differs(filepath, text):
+    """Whether a text file is missing or holds another text.
+
+    The existing file is read with universal newlines, so a file written
+    with the platform's line endings compares equal to the text.
+
+    """
+    try:
+        with open(filepath, 'r') as f:
+            return f.read() != text
+    except (FileNotFoundError, UnicodeDecodeError):
+        return True
+
+
+def _write_text_if_changed(filepath, text):
+    """Atomically replace a text file, unless it already holds the text.
+
+    Returns:
+        bool: True if the file was written.
+
+    """
+    if not _text_differs(filepath, text):
+        return False
+
+    temp_filepath = filepath + '.tmp'
+    with open(temp_filepath, 'w') as f:
+        f.write(text)
+    os.replace(temp_filepath, filepath)
+    return True
+
+
+def _check_copy_failures(args, copy_report):
+    """Fail the ingest if images could not be copied, unless watching"""
+    if copy_report.failures:
+        message = (
+            "Failed to copy {} images, see the log for details. They will be "
+            "retried on the next run.".format(len(copy_report.failures))
         )
+        if not args.watch:
+            raise RuntimeError(message)
+        logger.error(message)
 
-    @property
-    def extension(self):
-        return os.path.splitext(self.source_filename)[-1]
 
-    @property
-    def xml(self):
-        if self._xml is None:
-            self._xml = self._generate_xml()
-        return self._xml
+def _collect_orphan_images(args, stats, db, manifest):
+    """Report or delete images no map refers to anymore, see --gc-images
 
-    # Private Methods
+    The referenced images are read from db.xml as saved, so they include
+    the entries of maps that were streamed and released, and of other
+    images in the campaign. Only the map folders the manifest recorded are
+    searched, including those of maps since removed from the library.
 
-    def _generate_xml(self):
-        """Generates the XML for this Layer"""
-        layer = ET.Element('layer')
-        if self.name:
-            name = ET.SubElement(layer, 'name')
-            name.text = self.name
-        layer_id = ET.SubElement(layer, 'id')
-        layer_id.text = str(self.id)
-        layer_type = ET.SubElement(layer, 'type')
-        layer_type.text = 'image'
-        bitmap = ET.SubElement(layer, 'bitmap')
-        if self.source_filename:
-            bitmap.text = self.embed_filename
-        if self.occluder:
-            occluders = ET.SubElement(layer, 'occluders')
-            occluders.append(self.occluder)
-        return layer
+    """
+    images_dir = os.path.normpath(os.path.join(db.campaign_dir, 'images'))
+    with stats.phase('gc_images'):
+        referenced = _referenced_images(db.filepath, db.campaign_dir)
+        orphans = _find_orphan_images(
+            db.campaign_dir, manifest.map_dirs, referenced
+        )
+    stats.count('orphan_images', len(orphans))
+    stats.count('orphan_bytes', sum(size for _, size in orphans))
+    for path, _ in orphans:
+        logger.info("Orphaned image %s", path)
+    logger.info(
+        "Found %d orphaned images taking %.1f MB",
+        len(orphans), sum(size for _, size in orphans) / 1024 ** 2
+    )
+    if args.gc_images != 'delete':
+        return
 
+    deleted = 0
+    dirs = set()
+    for path, _ in orphans:
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.warning("Could not delete %s: %s", path, e)
+            continue
+        deleted += 1
+        dir_name = os.path.dirname(path)
+        while dir_name != images_dir and dir_name not in dirs:
+            dirs.add(dir_name)
+            dir_name = os.path.dirname(dir_name)
+    # Deepest first, so emptied parents can go too
+    for dir_name in sorted(dirs, key=len, reverse=True):
+        try:
+            os.rmdir(dir_name)
+        except OSError:
+            pass  # Not empty
+    manifest.save()  # Forget the map folders that are gone
+    stats.count('orphans_deleted', deleted)
+    logger.info("Deleted %d orphaned images", deleted)
+
+
+def _count_execution(
+        stats, session, copy_report, sidecars_written, sidecars_skipped
+):
+    """Count the copies, sidecar writes and optimized images of an ingest"""
+    stats.count('files_copied', len(copy_report.copied))
+    stats.count('files_linked', len(copy_report.linked))
+    stats.count('files_skipped', copy_report.skipped)
+    stats.count('copy_failures', len(copy_report.failures))
+    stats.count('bytes_copied', copy_report.bytes_copied)
+    stats.count('sidecars_written', sidecars_written)
+    stats.count('sidecars_skipped', sidecars_skipped)
+    if session.image_optimizer is not None:
+        stats.count('images_optimized', session.image_optimizer.transcoded)
 
-# Private Functions
 
 def _find_campaign_dir(campaign, campaign_dir=''):
     if campaign_dir and os.path.isdir(campaign_dir):
@@ -667,13 +4707,383 @@ def _find_campaign_dir(campaign, campaign_dir=''):
     )
 
 
+def _ingest(args, stats):
+    """Ingest the map library into the campaign
+
+    Args:
+        args (Namespace): The parsed command line arguments.
+        stats (IngestStats): Collects the phase timings and counters.
+
+    Returns:
+        tuple[IngestSession, CampaignDB, IngestManifest]|None: The session,
+        the loaded database and the manifest, or None for a dry run or a
+        module.
+
+    """
+    # Find the campaign dir
+    try:
+        campaign_dir = _find_campaign_dir(
+            args.campaign, args.campaign_dir or ''
+        )
+    except ValueError:
+        raise RuntimeError(
+            "No valid campaign directory found. Check that your campaign name "
+            "is correct, or specify an exact directory with --campaign-dir. If "
+            "you have not pre-created the campaign directory, please do that "
+            "first."
+        )
+
+    # Build Campaign DB object
+    try:
+        with stats.phase('db_parse'):
+            db = CampaignDB(campaign_dir, lazy=args.lazy_db)
+    except ValueError:
+        raise RuntimeError(
+            "No db.xml file found in the campaign directory. Please check "
+            "campaign directory."
+        )
+
+    session = IngestSession(
+        detect_grid_size=not args.disable_grid_detection,
+        occluder_tolerance=args.simplify_occluders,
+        embed_prefix=(
+            MODULE_IMAGE_PREFIX if args.module else CAMPAIGN_IMAGE_PREFIX
+        )
+    )
+
+    # Set campaign default values
+    try:
+        session.set_campaign_defaults(campaign_dir)
+    except (FileNotFoundError, JSONDecodeError):
+        logger.info("No campaign default settings found")
+        pass
+
+    # Set default fallback values
+    session.set_runtime_defaults(
+        {
+            'player_drawing': not args.disallow_player_drawing,
+            'grid': not args.disable_grid,
+            'grid_size': (
+                (args.grid_size, args.grid_size) if args.grid_size else None
+            ),
+            'grid_offset': (args.grid_offset_x, args.grid_offset_y),
+            'grid_snap': not args.disable_grid_snap,
+            'brush_size': (
+                (args.brush_size, args.brush_size) if args.brush_size
+                else None
+            )
+        }
+    )
+
+    if args.optimize_images:
+        session.image_optimizer = ImageOptimizer(
+            campaign_dir, image_format=args.image_format,
+            max_dimension=args.max_image_size, quality=args.image_quality
+        )
+
+    if args.module:
+        _ingest_module(args, stats, session, db)
+        return
+
+    manifest = IngestManifest(
+        campaign_dir, session.defaults_digest(), use_hash=args.hash_files
+    )
+
+    if args.stream:
+        _ingest_streamed(args, stats, session, db, manifest)
+        return session, db, manifest
+    if args.pipeline:
+        _ingest_pipelined(args, stats, session, db, manifest)
+        return session, db, manifest
+
+    # Build maps based on jpegs
+    with stats.phase('build_maps'):
+        session.build_maps(
+            args.map_dir, db, respect_db=not args.overwrite_db,
+            manifest=None if args.full_rebuild else manifest, jobs=args.jobs
+        )
+    removed = manifest.prune(
+        list(session.maps) + list(session.unchanged_maps)
+    )
+    stats.count('maps_built', len(session.maps))
+    stats.count('maps_unchanged', len(session.unchanged_maps))
+    stats.count('maps_removed', len(removed))
+    for map in session.maps.values():
+        stats.count('layers', len(map.layers))
+        stats.count('image_layers', len(map.image_layers))
+    if args.id_range:
+        manifest.id_range = args.id_range
+    if not session.maps and not removed and not args.full_rebuild:
+        logger.info("All maps are unchanged since the last ingest")
+        # Keep an --id-range given on a run with nothing to do
+        manifest.save()
+        return session, db, manifest
+
+    with stats.phase('set_missing_ids'):
+        session.set_missing_ids(id_range=manifest.id_range)
+
+    # Work out what has to be copied, written and changed in the DB
+    with stats.phase('plan'):
+        plan = IngestPlan.build(
+            session, db, overwrite=args.overwrite_images,
+            check=args.copy_check, save_sidecars=not args.disable_saving
+        )
+    stats.count('db_added', len(plan.db_added))
+    stats.count('db_changed', len(plan.db_changed))
+    stats.count('db_removed', len(plan.db_removed))
+    _log_occluder_report(session, stats)
+    if args.plan_json:
+        plan.save(args.plan_json)
+    if args.dry_run:
+        print(plan.format_diff())
+        return
+
+    # Copy images, write sidecars and save the DB
+    with stats.phase('execute'):
+        copy_report, sidecars_written, sidecars_skipped = plan.execute(
+            session, db, jobs=args.jobs, link_mode=args.link_mode,
+            splice=not args.full_db_write, stats=stats
+        )
+    copy_report.log_summary()
+    if sidecars_written or sidecars_skipped:
+        logger.info(
+            "Wrote %s sidecar files, %s were already up to date",
+            sidecars_written, sidecars_skipped
+        )
+    _count_execution(
+        stats, session, copy_report, sidecars_written, sidecars_skipped
+    )
+
+    # Record what was ingested, for skipping unchanged maps next time
+    with stats.phase('save_manifest'):
+        for map in session.maps.values():
+            manifest.record(map)
+        manifest.save()
+
+    _check_copy_failures(args, copy_report)
+    return session, db, manifest
+
+
+def _ingest_module(args, stats, session, db):
+    """Pack the map library into a module, see --module
+
+    The campaign is only read, for its defaults and the settings of maps
+    already in it. No sidecar files are written to the library either, so
+    packing a module leaves it as it was.
+
+    Args:
+        args (Namespace): The parsed command line arguments.
+        stats (IngestStats): Collects the phase timings and counters.
+        session (IngestSession): The session with its defaults set.
+        db (CampaignDB): The campaign database.
+
+    """
+    with stats.phase('build_maps'):
+        session.build_maps(
+            args.map_dir, db, respect_db=not args.overwrite_db, jobs=args.jobs
+        )
+    stats.count('maps_built', len(session.maps))
+    for map in session.maps.values():
+        stats.count('layers', len(map.layers))
+        stats.count('image_layers', len(map.image_layers))
+    with stats.phase('set_missing_ids'):
+        session.set_missing_ids(id_range=args.id_range)
+    _log_occluder_report(session, stats)
+
+    optimizer = session.image_optimizer
+    if optimizer is not None:
+        with stats.phase('optimize'):
+            optimizer.optimize(
+                [
+                    layer.source_filename
+                    for map in session.maps.values()
+                    for layer in map.image_layers
+                ],
+                args.jobs
+            )
+
+    writer = ModuleWriter(args.module, root_attrib=db.root.attrib)
+    with stats.phase('write_module'):
+        copy_report = writer.write(session.maps.values())
+    copy_report.log_summary()
+    _count_execution(stats, session, copy_report, 0, 0)
+    _check_copy_failures(args, copy_report)
+
+
+def _ingest_pipelined(args, stats, session, db, manifest):
+    """Ingest the map library through an IngestPipeline, see --pipeline
+
+    Args:
+        args (Namespace): The parsed command line arguments.
+        stats (IngestStats): Collects the phase timings and counters.
+        session (IngestSession): The session with its defaults set.
+        db (CampaignDB): The campaign database.
+        manifest (IngestManifest): The ingest manifest.
+
+    """
+    if args.id_range:
+        manifest.id_range = args.id_range
+
+    stage_jobs = dict.fromkeys(PIPELINE_STAGES, args.jobs)
+    stage_jobs.update(args.stage_jobs)
+    pipeline = IngestPipeline(
+        session, args.map_dir, db, respect_db=not args.overwrite_db,
+        manifest=None if args.full_rebuild else manifest,
+        id_range=manifest.id_range, overwrite=args.overwrite_images,
+        check=args.copy_check, link_mode=args.link_mode,
+        save_sidecars=not args.disable_saving,
+        splice=not args.full_db_write, stage_jobs=stage_jobs
+    )
+    with stats.phase('pipeline'):
+        copy_report, sidecars_written, sidecars_skipped = pipeline.run()
+
+    removed = manifest.prune(
+        list(session.maps) + list(session.unchanged_maps)
+    )
+    stats.count('maps_built', len(session.maps))
+    stats.count('maps_unchanged', len(session.unchanged_maps))
+    stats.count('maps_removed', len(removed))
+    if not session.maps and not removed and not args.full_rebuild:
+        logger.info("All maps are unchanged since the last ingest")
+        manifest.save()
+        return
+    for map in session.maps.values():
+        stats.count('layers', len(map.layers))
+        stats.count('image_layers', len(map.image_layers))
+    _log_occluder_report(session, stats)
+
+    copy_report.log_summary()
+    if sidecars_written or sidecars_skipped:
+        logger.info(
+            "Wrote %s sidecar files, %s were already up to date",
+            sidecars_written, sidecars_skipped
+        )
+    _count_execution(
+        stats, session, copy_report, sidecars_written, sidecars_skipped
+    )
+    with stats.phase('save_manifest'):
+        for map in session.maps.values():
+            manifest.record(map)
+        manifest.save()
+    _check_copy_failures(args, copy_report)
+
+
+def _ingest_streamed(args, stats, session, db, manifest):
+    """Ingest the map library a batch of maps at a time, see --stream
+
+    Args:
+        args (Namespace): The parsed command line arguments.
+        stats (IngestStats): Collects the phase timings and counters.
+        session (IngestSession): The session with its defaults set.
+        db (CampaignDB): The campaign database.
+        manifest (IngestManifest): The ingest manifest.
+
+    """
+    if args.id_range:
+        manifest.id_range = args.id_range
+
+    copy_report = CopyReport()
+    sidecars_written = sidecars_skipped = 0
+    built = []
+    with MapSpool(db.campaign_dir) as spool:
+        with stats.phase('stream'):
+            for report, written, skipped in session.stream_maps(
+                    args.map_dir, db, spool, respect_db=not args.overwrite_db,
+                    manifest=None if args.full_rebuild else manifest,
+                    jobs=args.jobs, id_range=manifest.id_range,
+                    overwrite=args.overwrite_images, check=args.copy_check,
+                    link_mode=args.link_mode,
+                    save_sidecars=not args.disable_saving
+            ):
+                copy_report.update(report)
+                sidecars_written += written
+                sidecars_skipped += skipped
+                _log_occluder_report(session, stats)
+                for map in session.maps.values():
+                    stats.count('layers', len(map.layers))
+                    stats.count('image_layers', len(map.image_layers))
+                    manifest.record(map)
+                    built.append(map.name)
+
+        removed = manifest.prune(built + list(session.unchanged_maps))
+        stats.count('maps_built', len(built))
+        stats.count('maps_unchanged', len(session.unchanged_maps))
+        stats.count('maps_removed', len(removed))
+        if not built and not removed and not args.full_rebuild:
+            logger.info("All maps are unchanged since the last ingest")
+            manifest.save()
+            return
+
+        with stats.phase('save_db'):
+            db.save_streamed(
+                spool, keep=session.unchanged_maps,
+                splice=not args.full_db_write
+            )
+
+    copy_report.log_summary()
+    if sidecars_written or sidecars_skipped:
+        logger.info(
+            "Wrote %s sidecar files, %s were already up to date",
+            sidecars_written, sidecars_skipped
+        )
+    _count_execution(
+        stats, session, copy_report, sidecars_written, sidecars_skipped
+    )
+    with stats.phase('save_manifest'):
+        manifest.save()
+    _check_copy_failures(args, copy_report)
+
+
+def _ingest_batch_entry(args):
+    """Ingest one pair of a batch, run in a worker process
+
+    Returns:
+        dict: The map and campaign dir, the error if the ingest failed and
+        the stats of the ingest.
+
+    """
+    logging.basicConfig()
+    logger.setLevel(args.log_level)
+    stats = IngestStats()
+    error = None
+    try:
+        ingested = _ingest(args, stats)
+        if args.gc_images and ingested is not None:
+            _collect_orphan_images(args, stats, *ingested[1:])
+    except (OSError, RuntimeError, ValueError, ET.ParseError) as e:
+        logger.exception("Ingesting %s failed", args.map_dir)
+        error = str(e)
+    return {
+        'map_dir': args.map_dir,
+        'campaign_dir': args.campaign_dir,
+        'error': error,
+        'stats': stats.to_dict()
+    }
+
+
+def _log_occluder_report(session, stats):
+    """Log and count the occluder points removed by simplification"""
+    if not session.occluder_tolerance:
+        return
+    for name, (read, embedded) in sorted(session.occluder_report().items()):
+        logger.info(
+            "Simplified the occluders of %s: removed %s of %s points",
+            name, read - embedded, read
+        )
+        stats.count('occluder_points_removed', read - embedded)
+
+
 def _parse_args():
     """Parse the arguments and return a dictionary of values"""
 
     parser = ArgumentParser()
     parser.add_argument(
         "map_dir",
-        help="the path to the root map directory"
+        nargs='?',
+        help="the path to the root map directory, or a zip archive of map "
+             "directories. Zip archives in the root map directory are read "
+             "as maps too, without extracting them. Required unless --batch "
+             "is given."
     )
     parser.add_argument(
         "-c",
@@ -691,8 +5101,10 @@ def _parse_args():
     parser.add_argument(
         "--grid-size",
         type=int,
-        default=100,
-        help="specify the default grid size for all maps. Defaults to 100."
+        default=None,
+        help="specify the default grid size for all maps. Takes precedence "
+             "over detected grid sizes. Defaults to the detected grid size, "
+             "or 100."
     )
     parser.add_argument(
         "--grid-offset-x",
@@ -708,18 +5120,88 @@ def _parse_args():
         help="specify the default grid offset y value for all maps. Defaults "
              "to 0."
     )
+    parser.add_argument(
+        "--disable-grid-detection",
+        action='store_true',
+        help="does not derive the grid size of maps from their image size and "
+             "names like '30x20' or '140px'. Maps without a grid size in "
+             "their JSON sidecar or the campaign defaults then use "
+             "--grid-size, or 100."
+    )
+    parser.add_argument(
+        "--simplify-occluders",
+        type=float,
+        default=0,
+        metavar='GRID_UNITS',
+        help="simplifies the occluders embedded in the campaign with "
+             "Douglas-Peucker, dropping points closer than this many grid "
+             "squares to the simplified outline. Requires NumPy. Defaults to "
+             "0, no simplification."
+    )
     parser.add_argument(
         "--brush-size",
         type=float,
         default=0,
         help="specify the default brush size for all maps. Defaults to 1/10 "
-             "the grid size"
+             "the grid size of each map."
     )
     parser.add_argument(
         "--overwrite-images",
         action='store_true',
         help="overwrites all images in the campaign dir."
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=4,
+        help="the number of images to copy and map directories to scan "
+             "concurrently. Defaults to 4."
+    )
+    parser.add_argument(
+        "--copy-check",
+        choices=COPY_CHECKS,
+        default='stat',
+        help="how to decide if an image already in the campaign dir is up to "
+             "date. 'exists' only checks that it is there, 'stat' compares "
+             "size and modification time, 'hash' also compares the content "
+             "of files whose modification time differs. Defaults to stat."
+    )
+    parser.add_argument(
+        "--link-mode",
+        choices=LINK_MODES,
+        default='copy',
+        help="how to place images in the campaign dir when it is on the same "
+             "filesystem as the map dir. 'hardlink' and 'reflink' avoid "
+             "copying bytes and using extra disk space. Defaults to copy."
+    )
+    parser.add_argument(
+        "--optimize-images",
+        action='store_true',
+        help="re-encodes the layer images before placing them in the campaign "
+             "dir, so clients download and decode smaller files. Requires "
+             "Pillow. Grid sizes are in pixels of the optimized images."
+    )
+    parser.add_argument(
+        "--image-format",
+        choices=sorted(IMAGE_FORMATS),
+        default='jpeg',
+        help="the format of optimized images. Defaults to jpeg."
+    )
+    parser.add_argument(
+        "--max-image-size",
+        type=int,
+        default=0,
+        help="downscales optimized images so neither side exceeds this many "
+             "pixels. Defaults to no limit."
+    )
+    parser.add_argument(
+        "--image-quality",
+        type=int,
+        default=85,
+        help="the encoder quality of optimized images, from 1 to 100. "
+             "Defaults to 85."
+    )
     parser.add_argument(
         "--overwrite-db",
         action='store_true',
@@ -751,88 +5233,320 @@ def _parse_args():
         action='store_true',
         help="turns off grid snapping on all maps. Takes JSON override."
     )
+    parser.add_argument(
+        "--full-db-write",
+        action='store_true',
+        help="rewrites and reformats the whole db.xml. By default only the "
+             "image section of db.xml is replaced and everything else is "
+             "kept byte for byte."
+    )
+    parser.add_argument(
+        "--lazy-db",
+        action='store_true',
+        help="only loads the image section of db.xml into memory, which "
+             "keeps startup fast and memory low on large campaigns. Cannot "
+             "be combined with 'full-db-write'."
+    )
+    parser.add_argument(
+        "--id-range",
+        help="the range of map IDs new maps are given, as START-END. It is "
+             "remembered in the campaign's ingest manifest for later runs. "
+             "Defaults to the lowest unused IDs."
+    )
+    parser.add_argument(
+        "--full-rebuild",
+        action='store_true',
+        help="ignores the ingest manifest and rebuilds every map, even ones "
+             "that are unchanged since the last run. Implied by "
+             "'overwrite-images' and 'overwrite-db'."
+    )
+    parser.add_argument(
+        "--dry-run",
+        action='store_true',
+        help="prints the DB entries, images and sidecar files an ingest "
+             "would add, change or remove, without changing anything."
+    )
+    parser.add_argument(
+        "--module",
+        help="packs the maps into this Fantasy Grounds module (.mod) instead "
+             "of ingesting them into the campaign. The campaign is only read, "
+             "for its default settings and the settings of maps already in "
+             "it, and no sidecar files are written to the map directory."
+    )
+    parser.add_argument(
+        "--plan-json",
+        help="writes the planned operations of the ingest to this JSON file."
+    )
+    parser.add_argument(
+        "--stream",
+        action='store_true',
+        help="builds, copies and writes the maps {} at a time and releases "
+             "each batch before building the next, so memory use stays flat "
+             "no matter how large the library is. Nothing is planned up "
+             "front, so the DB is written after all images are "
+             "copied.".format(STREAM_BATCH_SIZE)
+    )
+    parser.add_argument(
+        "--pipeline",
+        action='store_true',
+        help="runs the ingest as a pipeline, so the images of a map are "
+             "copied as soon as the map is built and the DB is written while "
+             "the last images are still being copied. See --stage-jobs."
+    )
+    parser.add_argument(
+        "--stage-jobs",
+        action='append',
+        metavar='STAGE=N',
+        help="limits the number of concurrent jobs of a --pipeline stage, "
+             "one of {}. Can be given more than once. Defaults to --jobs for "
+             "every stage.".format(', '.join(PIPELINE_STAGES))
+    )
+    parser.add_argument(
+        "--watch",
+        action='store_true',
+        help="keeps running after the ingest and re-ingests maps as files in "
+             "the map directory change. Uses inotify on Linux and polling "
+             "elsewhere."
+    )
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=0.3,
+        help="the number of seconds without further changes to wait for in "
+             "--watch mode before re-ingesting a map. Defaults to 0.3."
+    )
+    parser.add_argument(
+        "--batch",
+        help="ingests every map directory and campaign dir pair listed in "
+             "this JSON file, several at a time in separate processes. The "
+             "file holds a list of objects with 'map_dir' and 'campaign_dir' "
+             "keys. All other options apply to every pair."
+    )
+    parser.add_argument(
+        "--batch-jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="the number of campaigns to ingest concurrently with --batch. "
+             "Defaults to the number of CPUs."
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'),
+        default='DEBUG',
+        help="the lowest level of log messages shown. Defaults to DEBUG."
+    )
+    parser.add_argument(
+        "--stats-json",
+        help="writes the time taken by every phase of the ingest and counts "
+             "of maps, layers, copied bytes, skipped files and written "
+             "sidecars to this JSON file."
+    )
+    parser.add_argument(
+        "--profile",
+        help="profiles the ingest with cProfile and writes the stats to this "
+             "file, for use with pstats or snakeviz."
+    )
+    parser.add_argument(
+        "--gc-images",
+        choices=('report', 'delete'),
+        help="after the ingest, looks for files in the folders maps were "
+             "copied to that db.xml no longer refers to, left behind by "
+             "removed or renamed maps. 'report' lists them, 'delete' also "
+             "deletes them. Defaults to neither."
+    )
+    parser.add_argument(
+        "--hash-files",
+        action='store_true',
+        help="records content hashes in the ingest manifest, so maps whose "
+             "files were touched but not modified are still skipped."
+    )
 
     args = parser.parse_args()
 
-    args.map_dir = os.path.abspath(args.map_dir)
+    if args.lazy_db and args.full_db_write:
+        parser.error("--lazy-db cannot be combined with --full-db-write")
 
-    if not args.campaign:
-        args.campaign = os.path.basename(args.map_dir)
+    if args.watch and (args.dry_run or args.overwrite_db):
+        parser.error("--watch cannot be combined with --dry-run or "
+                     "--overwrite-db")
+
+    if args.stream and (args.dry_run or args.plan_json or args.watch):
+        parser.error("--stream cannot be combined with --dry-run, "
+                     "--plan-json or --watch")
+
+    if args.module and (
+            args.stream or args.pipeline or args.watch or args.dry_run or
+            args.plan_json
+    ):
+        parser.error("--module cannot be combined with --stream, --pipeline, "
+                     "--watch, --dry-run or --plan-json")
+
+    if args.gc_images and (args.dry_run or args.module):
+        parser.error("--gc-images cannot be combined with --dry-run or "
+                     "--module")
+
+    if args.pipeline and (args.stream or args.dry_run or args.plan_json):
+        parser.error("--pipeline cannot be combined with --stream, "
+                     "--dry-run or --plan-json")
+
+    stage_jobs = {}
+    for value in args.stage_jobs or ():
+        stage, _, jobs = value.partition('=')
+        if stage not in PIPELINE_STAGES or not jobs.isdigit() or not int(jobs):
+            parser.error("--stage-jobs must be given as STAGE=N, with STAGE "
+                         "one of {}".format(', '.join(PIPELINE_STAGES)))
+        stage_jobs[stage] = int(jobs)
+    args.stage_jobs = stage_jobs
 
-    if not args.brush_size:
-        args.brush_size = args.grid_size * 0.1
+    if args.optimize_images and Image is None:
+        parser.error("--optimize-images requires Pillow to be installed")
+
+    if args.simplify_occluders and np is None:
+        parser.error("--simplify-occluders requires NumPy to be installed")
+
+    if args.simplify_occluders < 0:
+        parser.error("--simplify-occluders cannot be negative")
+
+    if not 1 <= args.image_quality <= 100:
+        parser.error("--image-quality must be between 1 and 100")
+
+    if args.id_range:
+        try:
+            start, end = (int(_) for _ in args.id_range.split('-'))
+        except ValueError:
+            parser.error("--id-range must be given as START-END")
+        if not 0 < start <= end:
+            parser.error("--id-range must be positive and ascending")
+        args.id_range = [start, end]
+
+    if args.batch:
+        if args.map_dir:
+            parser.error("map_dir cannot be combined with --batch")
+        if args.watch or args.profile or args.module:
+            parser.error("--batch cannot be combined with --watch, "
+                         "--profile or --module")
+        try:
+            with open(args.batch, 'r') as f:
+                args.batch = [
+                    (
+                        os.path.abspath(entry['map_dir']),
+                        os.path.abspath(entry['campaign_dir'])
+                    )
+                    for entry in json.load(f)
+                ]
+        except (OSError, JSONDecodeError, KeyError, TypeError) as e:
+            parser.error("cannot read batch file {}: {}".format(args.batch, e))
+    elif not args.map_dir:
+        parser.error("map_dir is required unless --batch is given")
+    else:
+        args.map_dir = os.path.abspath(args.map_dir)
+
+    if args.watch and args.map_dir and not os.path.isdir(args.map_dir):
+        parser.error("--watch needs map_dir to be a directory")
+
+    if not args.campaign and args.map_dir:
+        args.campaign = os.path.basename(args.map_dir)
+        if args.campaign.lower().endswith(ARCHIVE_SUFFIX):
+            args.campaign = args.campaign[:-len(ARCHIVE_SUFFIX)]
 
     if args.overwrite_db:
         args.disable_saving = True
 
-    return args
-
+    if args.overwrite_images or args.overwrite_db:
+        args.full_rebuild = True
 
-# Public Functions
+    return args
 
-def main():
-    args = _parse_args()
 
-    logging.basicConfig()
-    logger.setLevel(logging.DEBUG)
+def _run_batch(args):
+    """Ingest all pairs of a batch on a pool of processes"""
+    batch = []
+    for map_dir, campaign_dir in args.batch:
+        entry_args = Namespace(**vars(args))
+        entry_args.batch = None
+        entry_args.map_dir = map_dir
+        entry_args.campaign_dir = campaign_dir
+        entry_args.campaign = os.path.basename(map_dir)
+        batch.append(entry_args)
 
-    # Find the campaign dir
-    try:
-        campaign_dir = _find_campaign_dir(
-            args.campaign, vars(args).get('data-dir', '')
-        )
-    except ValueError:
-        raise RuntimeError(
-            "No valid campaign directory found. Check that your campaign name "
-            "is correct, or specify an exact directory with --campaign-dir. If "
-            "you have not pre-created the campaign directory, please do that "
-            "first."
+    logger.info(
+        "Ingesting %d campaigns, %d at a time", len(batch), args.batch_jobs
+    )
+    with ProcessPoolExecutor(max_workers=max(1, args.batch_jobs)) as executor:
+        results = list(executor.map(_ingest_batch_entry, batch))
+
+    failed = [result for result in results if result['error']]
+    for result in failed:
+        logger.error(
+            "Failed to ingest %s into %s: %s",
+            result['map_dir'], result['campaign_dir'], result['error']
         )
-
-    # Build Campaign DB object
-    try:
-        db = CampaignDB(campaign_dir)
-    except ValueError:
+    if args.stats_json:
+        temp_filepath = args.stats_json + '.tmp'
+        with open(temp_filepath, 'w') as f:
+            json.dump(results, f, indent=4, separators=(',', ': '))
+        os.replace(temp_filepath, args.stats_json)
+    if failed:
         raise RuntimeError(
-            "No db.xml file found in the campaign directory. Please check "
-            "campaign directory."
+            "Failed to ingest {} of {} campaigns, see the log for "
+            "details.".format(len(failed), len(results))
         )
 
-    # Set campaign default values
-    try:
-        Map.set_campaign_defaults(campaign_dir)
-    except (FileNotFoundError, JSONDecodeError):
-        logger.info("No campaign default settings found")
-        pass
 
-    # Set default fallback values
-    Map.set_runtime_defaults(
-        {
-            'player_drawing': not args.disallow_player_drawing,
-            'grid': not args.disable_grid,
-            'grid_size': (args.grid_size, args.grid_size),
-            'grid_offset': (args.grid_offset_x, args.grid_offset_y),
-            'grid_snap': not args.disable_grid_snap,
-            'brush_size': (args.brush_size, args.brush_size)
-        }
+def _same_filesystem(source, destination):
+    """Check if a source file and a destination path share a filesystem"""
+    return (
+        os.stat(source).st_dev ==
+        os.stat(os.path.dirname(destination)).st_dev
     )
 
-    # Build maps based on jpegs
-    Map.build_maps(args.map_dir, db, respect_db=not args.overwrite_db)
-    Map.set_missing_ids()
 
-    # copy images to campaign folder
-    Map.copy_maps(overwrite=args.overwrite_images)
+def _zip_mtime_ns(info):
+    """Return the modification time of a zip archive member"""
+    return int(time.mktime(info.date_time + (0, 0, -1))) * 10 ** 9
+
+
+# Public Functions
+
+def main():
+    args = _parse_args()
 
-    if not args.disable_saving:
-        # save sidecar files
-        Map.save_all_sidecar_files()
+    logging.basicConfig()
+    logger.setLevel(args.log_level)
 
-    # Update DB
-    db.update_db(Map.maps.values())
+    if args.batch:
+        _run_batch(args)
+        return
 
-    # Save DB
-    db.save_db()
+    stats = IngestStats()
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        ingested = _ingest(args, stats)
+        if args.gc_images and ingested is not None:
+            _collect_orphan_images(args, stats, *ingested[1:])
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            logger.info("Saved profile to %s", args.profile)
+        stats.log_summary()
+        if args.stats_json:
+            stats.save(args.stats_json)
+
+    if args.watch and ingested is not None:
+        session, db, manifest = ingested
+        watcher = LibraryWatcher(
+            session, args.map_dir, db, manifest, jobs=args.jobs,
+            check=args.copy_check, link_mode=args.link_mode,
+            splice=not args.full_db_write,
+            save_sidecars=not args.disable_saving, debounce=args.debounce
+        )
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            logger.info("Stopped watching %s", args.map_dir)
 
 
 # Main